@@ -0,0 +1,176 @@
+"""Client of annotation_server.py, as used by MessageTool in server mode.
+
+load-test runs many simulated annotators against a server: each leases
+messages, submits a table for each and hands them back as done until none
+are left. It writes sidecars and read marks, so point the server at a
+scratch copy of a folder.
+
+expiry-test lets one lease run out and checks that Next recovers: the
+handback is refused and a fresh lease is handed out. It waits for the
+server's ttl, so start that server with a short one (e.g. --ttl 2).
+
+    python annotation_client.py status URL
+    python annotation_client.py load-test URL [--clients 200] [--saves 2]
+    python annotation_client.py expiry-test URL
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ServerError(OSError):
+    """The server answered with an error; status 409 means the lease is gone.
+
+    Like urllib's own errors it is an OSError, so callers catch one type for
+    a server that is down and one that refuses a request.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(f"{message} (HTTP {status})")
+        self.status = status
+
+
+class AnnotationClient:
+    def __init__(self, url, client='', timeout=10):
+        self.url = url.rstrip('/')
+        self.client = client
+        self.timeout = timeout
+
+    def _call(self, method, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e).get('error', e.reason)
+            except ValueError:
+                message = e.reason
+            raise ServerError(e.code, message) from None
+
+    def status(self):
+        return self._call('GET', '/status')
+
+    def lease(self):
+        """The next message ({name, text, table_data, processed_text, lease, ttl}), or None."""
+        message = self._call('POST', '/lease', {'client': self.client})
+        return message if message.get('name') is not None else None
+
+    def renew(self, lease):
+        return self._call('POST', '/renew', {'lease': lease})
+
+    def submit(self, lease, table_data, processed_text, done=False):
+        return self._call('POST', '/submit', {'lease': lease, 'table_data': table_data,
+                                              'processed_text': processed_text, 'done': done})
+
+    def release(self, lease):
+        return self._call('POST', '/release', {'lease': lease})
+
+    def hand_back(self, lease, table_data, processed_text):
+        """Next: submit the message on screen as done; table_data None marks it read without a sidecar.
+
+        Returns None, or the server's reason when the lease is gone (it
+        expired past the ttl, or the server restarted): the table was not
+        accepted, and the lease is spent either way. Other errors leave the
+        lease as it was, so the handback can be tried again.
+        """
+        try:
+            self.submit(lease, table_data, processed_text, done=True)
+        except ServerError as e:
+            if e.status != 409:
+                raise
+            return str(e)
+        return None
+
+    def vocabulary(self):
+        return self._call('GET', '/vocabulary')
+
+    def add_terms(self, terms):
+        """terms maps vocabulary keys ('brands', ...) to lists of new terms."""
+        return self._call('POST', '/vocabulary', terms)
+
+
+def load_test(url, clients, saves):
+    # One thread per simulated annotator; returns (messages done, requests, errors, seconds)
+    done, requests, errors = [0], [0], []
+    lock = threading.Lock()
+
+    def annotate(number):
+        client = AnnotationClient(url, client=f"load-test-{number}")
+        count = calls = 0
+        try:
+            while True:
+                message = client.lease()
+                calls += 1
+                if message is None:
+                    break
+                row = ['WTB', message['name']]
+                for _ in range(saves):  # Autosaves while editing
+                    client.submit(message['lease'], [row], message['processed_text'])
+                    calls += 1
+                client.submit(message['lease'], [row], message['processed_text'], done=True)
+                calls += 1
+                count += 1
+        except OSError as e:
+            with lock:
+                errors.append(str(e))
+        with lock:
+            done[0] += count
+            requests[0] += calls
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(annotate, range(clients)))
+    return done[0], requests[0], errors, time.perf_counter() - start
+
+
+def expiry_test(url):
+    # What Next does after the lease expired; returns the failure, or None
+    client = AnnotationClient(url, client='expiry-test')
+    message = client.lease()
+    if message is None:
+        return "no message to lease"
+    time.sleep(message['ttl'] + 1)
+    refused = client.hand_back(message['lease'], [['WTB', message['name']]], message['processed_text'])
+    if refused is None:
+        return "the handback after the lease expired was accepted"
+    fresh = client.lease()
+    if fresh is None or fresh['lease'] == message['lease']:
+        return f"no fresh lease after the refused handback ({refused})"
+    client.release(fresh['lease'])
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Talk to an annotation server.")
+    parser.add_argument('command', choices=['status', 'load-test', 'expiry-test'])
+    parser.add_argument('url')
+    parser.add_argument('--clients', type=int, default=200, help="load-test: simulated annotators")
+    parser.add_argument('--saves', type=int, default=2, help="load-test: intermediate saves per message")
+    args = parser.parse_args(argv)
+
+    if args.command == 'status':
+        print(json.dumps(AnnotationClient(args.url).status(), indent=4))
+        return 0
+    if args.command == 'expiry-test':
+        failure = expiry_test(args.url)
+        print(f"Error: {failure}" if failure else "An expired lease was refused and a fresh one handed out")
+        return 1 if failure else 0
+    messages, requests, errors, elapsed = load_test(args.url, args.clients, args.saves)
+    for error in errors[:10]:
+        print(f"Error: {error}")
+    rate = requests / elapsed if elapsed > 0 else 0
+    print(f"{args.clients} clients annotated {messages} messages in {elapsed:.2f}s: "
+          f"{requests} requests ({rate:.0f}/s), {len(errors)} errors")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
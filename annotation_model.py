@@ -0,0 +1,172 @@
+import sys
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class TableListener:
+    """Change notifications of an AnnotationTable; override what is needed.
+
+    Every change comes as a pair around the change itself: the first call
+    sees the old cells, the second the new ones. Qt's begin/end model calls
+    need the structural pairs; the edit history needs cells_changing. Row
+    and column ranges are inclusive.
+    """
+
+    def rows_inserting(self, first, last):
+        pass
+
+    def rows_inserted(self, first, last):
+        pass
+
+    def rows_removing(self, first, last):
+        pass
+
+    def rows_removed(self, first, last):
+        pass
+
+    def cells_changing(self, first_row, last_row, first_col, last_col):
+        pass
+
+    def cells_changed(self, first_row, last_row, first_col, last_col):
+        pass
+
+    def table_resetting(self):
+        pass
+
+    def table_reset(self):
+        pass
+
+
+class AnnotationTable:
+    """The rows of the open message's table, without any Qt object.
+
+    Every row is a list of len(headers) cells. Cell strings are interned,
+    so the values repeated all over a table ('WTB', a brand, '') are
+    stored once. Rows dropped by set_rows() and remove_row() are kept in a
+    spare pool and refilled by later inserts. rows may be read directly
+    but only changed through the methods, which notify the listeners.
+    """
+
+    __slots__ = ('headers', 'rows', 'spare_rows', 'listeners')
+
+    def __init__(self, headers=()):
+        self.headers = list(headers)
+        self.rows = []
+        self.spare_rows = []
+        self.listeners = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def _notify(self, event, *args):
+        for listener in self.listeners:
+            getattr(listener, event)(*args)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _fill(self, target, values):
+        # Copy values into target, interned and fitted to the headers
+        width = len(self.headers)
+        try:
+            target[:] = map(sys.intern, values[:width])
+        except TypeError:  # A cell that is not a string (hand-edited sidecar)
+            target[:] = [_intern(value) for value in values[:width]]
+        if len(target) < width:
+            target.extend([""] * (width - len(target)))
+        return target
+
+    def snapshot(self):
+        """Copy of the rows, safe to keep or to hand to another thread."""
+        return [list(row) for row in self.rows]
+
+    def set_headers(self, headers):
+        self._notify('table_resetting')
+        self.headers = list(headers)
+        self.rows = []
+        self.spare_rows = []
+        self._notify('table_reset')
+
+    def set_rows(self, rows):
+        # Rows present before and after are rebound in place; only the
+        # difference is inserted or removed
+        kept = min(len(self.rows), len(rows))
+        if kept:
+            self._notify('cells_changing', 0, kept - 1, 0, len(self.headers) - 1)
+        for target, values in zip(self.rows, rows):
+            if target != values:  # Unchanged rows (a reloaded table) cost one comparison
+                self._fill(target, values)
+        if kept:
+            self._notify('cells_changed', 0, kept - 1, 0, len(self.headers) - 1)
+        if len(rows) < len(self.rows):
+            first, last = len(rows), len(self.rows) - 1
+            self._notify('rows_removing', first, last)
+            self.spare_rows.extend(self.rows[first:])
+            del self.rows[first:]
+            self._notify('rows_removed', first, last)
+        elif len(rows) > len(self.rows):
+            first, last = len(self.rows), len(rows) - 1
+            self._notify('rows_inserting', first, last)
+            for values in rows[first:]:
+                self.rows.append(self._fill(self.spare_rows.pop() if self.spare_rows else [], values))
+            self._notify('rows_inserted', first, last)
+
+    def append_row(self, values):
+        self.insert_rows(len(self.rows), [values])
+
+    def insert_rows(self, position, rows):
+        if not rows:
+            return
+        first, last = position, position + len(rows) - 1
+        self._notify('rows_inserting', first, last)
+        self.rows[position:position] = [self._fill(self.spare_rows.pop() if self.spare_rows else [], values)
+                                         for values in rows]
+        self._notify('rows_inserted', first, last)
+
+    def remove_row(self, row):
+        if not 0 <= row < len(self.rows):
+            return False
+        self.remove_rows(row, row)
+        return True
+
+    def remove_rows(self, first, last):
+        self._notify('rows_removing', first, last)
+        self.spare_rows.extend(self.rows[first:last + 1])
+        del self.rows[first:last + 1]
+        self._notify('rows_removed', first, last)
+
+    def set_cell(self, row, col, value):
+        """Returns False if the cell already holds value."""
+        cells = self.rows[row]
+        if cells[col] == value:
+            return False
+        self._notify('cells_changing', row, row, col, col)
+        cells[col] = _intern(value)
+        self._notify('cells_changed', row, row, col, col)
+        return True
+
+    def set_cells(self, cells):
+        """Write (row, col, value) triples with one notification for their bounding box."""
+        if not cells:
+            return
+        rows = [row for row, _, _ in cells]
+        cols = [col for _, col, _ in cells]
+        box = (min(rows), max(rows), min(cols), max(cols))
+        self._notify('cells_changing', *box)
+        for row, col, value in cells:
+            self.rows[row][col] = _intern(value)
+        self._notify('cells_changed', *box)
+
+    def set_column(self, col, value):
+        if not self.rows:
+            return
+        value = _intern(value)
+        self._notify('cells_changing', 0, len(self.rows) - 1, col, col)
+        for row in self.rows:
+            row[col] = value
+        self._notify('cells_changed', 0, len(self.rows) - 1, col, col)
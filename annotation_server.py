@@ -0,0 +1,456 @@
+"""Serve the messages of one folder to many MessageTool clients over HTTP.
+
+Clients lease the next message that is neither annotated (no sidecar) nor
+read, submit its table and processed text, and hand it back as done. The
+vocabulary (brand_category_color.json) and the read status are kept here
+for all of them. Sidecars are written in the folder in the layout the
+desktop tool reads, so either can open the folder afterwards. Messages
+leased by a desktop instance (.leases/) are not handed out, and the server
+takes such a lease for every message it hands out, renewed with the
+client's lease and released once its last write is on disk.
+
+A lease expires ttl seconds after it was taken or last renewed, and its
+message goes back to the front of the queue. Writes are collected and
+done together every flush_interval seconds on a worker thread, so a crash
+loses at most that much of the submitted work.
+
+Plain HTTP/1.1 with JSON bodies, on asyncio and the standard library:
+
+    GET  /status                      message, annotated, read, leased and queued counts
+    POST /lease       {client}        the next message with its lease, or {"name": null}
+    POST /renew       {lease}
+    POST /submit      {lease, table_data, processed_text, done}   table_data null with done: read, not annotated
+    POST /release     {lease}
+    GET  /vocabulary                  the shared lists
+    POST /vocabulary  {key: [terms]}  add terms to the shared lists
+
+Errors come back as {"error": ...} with a 4xx status; 409 means the lease
+expired or is unknown.
+
+    python annotation_server.py MESSAGES_FOLDER [--host 127.0.0.1] [--port 8765] [--ttl 300]
+        [--flush-interval 0.5] [--vocabulary brand_category_color.json] [--state annotation_server_state.json]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import asyncio
+import argparse
+from collections import deque
+
+from storage import atomic_write_json, merge_json_lists, load_sidecar, parse_sidecar
+from leases import LeaseManager
+
+VOCABULARY_KEYS = ('brands', 'categories', 'colors', 'product_names')
+MAX_BODY = 16 << 20
+IDLE_TIMEOUT = 60  # Seconds a keep-alive connection may sit unused
+RESCAN_SECONDS = 10  # An empty queue lists the folder again at most this often
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _write_batch(batch):
+    for path, (kind, data) in batch.items():
+        try:
+            if kind == 'merge':
+                merge_json_lists(path, data, encoding=None)
+            else:
+                atomic_write_json(path, data)
+        except Exception as e:
+            print(f"Error writing {path}: {e}")
+
+
+class WriteBatcher:
+    """Collects writes and does them together every interval seconds off the event loop.
+
+    Only the newest data per path is written; get() sees data that is not
+    on disk yet.
+    """
+
+    def __init__(self, interval=0.5, on_flushed=None):
+        self.interval = interval
+        self.on_flushed = on_flushed  # Called after every batch
+        self.pending = {}  # path -> (kind, data)
+        self.inflight = {}
+        self.batches = 0
+        self.writes = 0
+        self._lock = asyncio.Lock()
+
+    def submit(self, path, data, kind='json'):
+        self.pending[path] = (kind, data)
+
+    def get(self, path):
+        job = self.pending.get(path) or self.inflight.get(path)
+        return job[1] if job is not None else None
+
+    def cancel(self, path):
+        # Drops a write that is not in a running batch yet
+        self.pending.pop(path, None)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self.pending:
+                return
+            self.inflight, self.pending = self.pending, {}
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, _write_batch, self.inflight)
+                self.batches += 1
+                self.writes += len(self.inflight)
+            finally:
+                self.inflight = {}
+                if self.on_flushed is not None:
+                    self.on_flushed()
+
+
+class _Lease:
+    __slots__ = ('id', 'name', 'client', 'expires')
+
+    def __init__(self, name, client, expires):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.client = client
+        self.expires = expires
+
+
+class AnnotationServer:
+    def __init__(self, folder, ttl=300, flush_interval=0.5, vocabulary_path='brand_category_color.json',
+                 state_path='annotation_server_state.json'):
+        self.folder = folder
+        self.ttl = ttl
+        self.vocabulary_path = vocabulary_path
+        self.state_path = state_path
+        self.writer = WriteBatcher(flush_interval, on_flushed=self.release_written)
+        # The desktop tool's leases: checked, and taken for the messages handed out
+        self.file_leases = LeaseManager(folder, owner='annotation server', ttl=ttl)
+        self.unreleased = set()  # Handed back, but a write of theirs is not on disk yet
+        self.names = set()
+        self.annotated = set()
+        self.read = set()  # Full paths, like read_files in the desktop state
+        self.queue = deque()  # Names that may be handed out, in order
+        self.leases = {}  # lease id -> _Lease
+        self.leased = {}  # name -> lease id
+        self.vocabulary = {key: [] for key in VOCABULARY_KEYS}
+        self.known_terms = {key: set() for key in VOCABULARY_KEYS}
+        self.clients = 0
+        self.scanned = 0.0
+        self.routes = {
+            ('GET', '/status'): self.status,
+            ('POST', '/lease'): self.lease,
+            ('POST', '/renew'): self.renew,
+            ('POST', '/submit'): self.submit,
+            ('POST', '/release'): self.release,
+            ('GET', '/vocabulary'): self.get_vocabulary,
+            ('POST', '/vocabulary'): self.add_vocabulary,
+        }
+
+    # Folder state
+
+    def load(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as file:
+                self.read = set(json.load(file).get('read_files', []))
+        try:
+            with open(self.vocabulary_path, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            data = {}
+        for key in VOCABULARY_KEYS:
+            self.vocabulary[key] = list(dict.fromkeys(data.get(key, [])))
+            self.known_terms[key] = set(self.vocabulary[key])
+        self.add_messages(*self.list_folder())
+
+    def list_folder(self):
+        # Worker thread: (message names, names with a sidecar)
+        messages, sidecars = [], set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.txt'):
+                    messages.append(entry.name)
+                elif entry.name.endswith('.txt.json'):
+                    sidecars.add(entry.name[:-len('.json')])
+        return messages, sidecars
+
+    def add_messages(self, found, sidecars):
+        # Event loop: take in messages added since the last listing
+        self.scanned = time.monotonic()
+        self.annotated |= sidecars
+        for name in sorted(found):
+            if name not in self.names:
+                self.names.add(name)
+                if name not in self.annotated and self.path(name) not in self.read:
+                    self.queue.append(name)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def save_state(self):
+        self.writer.submit(self.state_path, {'read_files': sorted(self.read)})
+
+    def expire_leases(self):
+        now = time.monotonic()
+        expired = [lease for lease in self.leases.values() if lease.expires < now]
+        for lease in reversed(expired):
+            self.drop_lease(lease)
+            self.queue.appendleft(lease.name)  # First in line again
+
+    def drop_lease(self, lease):
+        del self.leases[lease.id]
+        del self.leased[lease.name]
+        if self.writer.get(self.path(lease.name) + '.json') is not None:
+            self.unreleased.add(lease.name)  # A desktop instance must not open it before the write
+        else:
+            self.file_leases.release(lease.name)
+
+    def release_written(self):
+        # After a batch: release the file leases of handed-back messages that are now on disk
+        for name in list(self.unreleased):
+            if name in self.leased:
+                self.unreleased.discard(name)  # Handed out again; the file lease stays
+            elif self.writer.get(self.path(name) + '.json') is None:
+                self.unreleased.discard(name)
+                self.file_leases.release(name)
+
+    def get_lease(self, body):
+        lease = self.leases.get(body.get('lease'))
+        if lease is None or lease.expires < time.monotonic():
+            raise RequestError(409, "lease expired or unknown")
+        return lease
+
+    def read_message(self, name):
+        # Worker thread: take the message's file lease and read it; None if a desktop instance holds it
+        if self.file_leases.acquire(name) is not None:
+            return None
+        with open(self.path(name), 'r', encoding='utf-8') as file:
+            text = file.read()
+        try:
+            table_data, processed_text = load_sidecar(self.path(name) + '.json')
+        except FileNotFoundError:
+            table_data, processed_text = [], ''
+        return text, table_data, processed_text
+
+    # Handlers: body dict in, (status, reply dict) out
+
+    async def status(self, body):
+        self.expire_leases()
+        return 200, {'messages': len(self.names), 'annotated': len(self.annotated), 'read': len(self.read),
+                     'leased': len(self.leases), 'queued': len(self.queue), 'clients': self.clients,
+                     'batches_written': self.writer.batches}
+
+    async def lease(self, body):
+        self.expire_leases()
+        if not self.queue and time.monotonic() - self.scanned > RESCAN_SECONDS:
+            self.scanned = time.monotonic()  # One listing for a crowd of clients finding the queue empty
+            self.add_messages(*await asyncio.get_running_loop().run_in_executor(None, self.list_folder))
+        skipped = []
+        try:
+            while self.queue:
+                name = self.queue.popleft()
+                if name in self.leased or name in self.annotated or self.path(name) in self.read:
+                    continue
+                # Taken before the file is read, so no other request hands it out meanwhile
+                lease = _Lease(name, str(body.get('client', '')), time.monotonic() + self.ttl)
+                self.leases[lease.id] = lease
+                self.leased[name] = lease.id
+                pending = self.writer.get(self.path(name) + '.json')
+                try:
+                    message = await asyncio.get_running_loop().run_in_executor(None, self.read_message, name)
+                except OSError as e:
+                    self.drop_lease(lease)
+                    print(f"Error reading {name}: {e}")
+                    continue
+                if message is None:  # Open in a desktop instance; try again later
+                    self.drop_lease(lease)
+                    skipped.append(name)
+                    continue
+                text, table_data, processed_text = message
+                if pending is not None:
+                    table_data, processed_text = parse_sidecar(pending)
+                return 200, {'name': name, 'text': text, 'table_data': table_data,
+                             'processed_text': processed_text, 'lease': lease.id, 'ttl': self.ttl}
+            return 200, {'name': None}
+        finally:
+            self.queue.extend(skipped)
+
+    async def renew_file_lease(self, lease):
+        # Also tells whether a desktop instance took the message over (after the file lease expired)
+        lost = await asyncio.get_running_loop().run_in_executor(None, self.file_leases.renew, [lease.name])
+        if self.leases.get(lease.id) is not lease:
+            raise RequestError(409, "lease expired or unknown")  # Meanwhile
+        if lost:
+            self.writer.cancel(self.path(lease.name) + '.json')
+            self.drop_lease(lease)
+            raise RequestError(409, "lease taken over by a desktop instance")
+
+    async def renew(self, body):
+        lease = self.get_lease(body)
+        await self.renew_file_lease(lease)
+        lease.expires = time.monotonic() + self.ttl
+        return 200, {'ttl': self.ttl}
+
+    async def submit(self, body):
+        lease = self.get_lease(body)
+        table_data = body.get('table_data')
+        processed_text = body.get('processed_text', '')
+        done = bool(body.get('done'))
+        if table_data is not None or not done:  # Done without a table: seen, but left unannotated
+            if (not isinstance(table_data, list) or not isinstance(processed_text, str)
+                    or not all(isinstance(row, list) and all(isinstance(cell, str) for cell in row)
+                               for row in table_data)):
+                raise RequestError(400, "table_data must be a list of rows of strings and processed_text a string")
+            await self.renew_file_lease(lease)  # Never write over a desktop instance's edits
+            self.writer.submit(self.path(lease.name) + '.json',
+                               {'table_data': table_data, 'processed_text': processed_text})
+            if done:
+                self.annotated.add(lease.name)
+        lease.expires = time.monotonic() + self.ttl
+        if done:
+            self.read.add(self.path(lease.name))
+            self.save_state()
+            self.drop_lease(lease)
+        return 200, {'name': lease.name}
+
+    async def release(self, body):
+        lease = self.get_lease(body)
+        self.drop_lease(lease)
+        if lease.name not in self.annotated:
+            self.queue.appendleft(lease.name)
+        return 200, {}
+
+    async def get_vocabulary(self, body):
+        return 200, self.vocabulary
+
+    async def add_vocabulary(self, body):
+        added = 0
+        for key, terms in body.items():
+            if key not in self.vocabulary or not isinstance(terms, list):
+                raise RequestError(400, f"unknown vocabulary list {key!r}")
+            for term in terms:
+                if isinstance(term, str) and term and term not in self.known_terms[key]:
+                    self.known_terms[key].add(term)
+                    self.vocabulary[key].append(term)
+                    added += 1
+        if added:
+            # Merged on write, so desktop instances adding to the same file keep their terms
+            self.writer.submit(self.vocabulary_path, {key: list(terms) for key, terms in self.vocabulary.items()},
+                               kind='merge')
+        return 200, {'added': added}
+
+    # HTTP
+
+    async def handle(self, reader, writer):
+        self.clients += 1
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY:
+                    status, reply, keep_alive = 413, {'error': "request body too large"}, False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, reply = await self.dispatch(method, target.split('?', 1)[0], body)
+                data = json.dumps(reply, ensure_ascii=False).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                             f"Content-Type: application/json; charset=utf-8\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass  # Client went away or sent something that is not HTTP
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for _, route_path in self.routes):
+                return 405, {'error': f"{method} not allowed on {path}"}
+            return 404, {'error': f"no such endpoint: {path}"}
+        try:
+            payload = json.loads(body) if body else {}
+            if not isinstance(payload, dict):
+                raise RequestError(400, "the body must be a JSON object")
+            return await handler(payload)
+        except ValueError:
+            return 400, {'error': "the body is not valid JSON"}
+        except RequestError as e:
+            return e.status, {'error': str(e)}
+        except Exception as e:
+            print(f"Error handling {method} {path}: {e}")
+            return 500, {'error': str(e)}
+
+    async def serve(self, host='127.0.0.1', port=8765, ready=None):
+        """Run until cancelled or SIGTERM; ready(port) is called once listening (port 0 picks a free one)."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.load)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows, or not the main thread: Ctrl+C still stops it
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        flusher = asyncio.create_task(self.writer.run())
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flusher.cancel()
+            await self.writer.flush()
+            self.file_leases.release_all()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a message folder to MessageTool clients.")
+    parser.add_argument('folder')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--ttl', type=int, default=300, help="Lease lifetime in seconds without renewal")
+    parser.add_argument('--flush-interval', type=float, default=0.5, help="Seconds between batched writes")
+    parser.add_argument('--vocabulary', default='brand_category_color.json', help="Shared vocabulary file")
+    parser.add_argument('--state', default='annotation_server_state.json', help="Read status file")
+    args = parser.parse_args(argv)
+
+    server = AnnotationServer(args.folder, args.ttl, args.flush_interval, args.vocabulary, args.state)
+
+    def ready(port):
+        print(f"Serving {args.folder} on http://{args.host}:{port}", flush=True)
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, ready))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass  # Pending writes were flushed on the way out
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,18 +2,515 @@ import sys
 import os
 import json
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QTextEdit, 
-                             QFileDialog, QWidget, QGridLayout, QLineEdit, QScrollArea, QStatusBar, QSizePolicy, QComboBox, QCompleter,QSplitter, QMenu, QAction
+                             QFileDialog, QWidget, QScrollArea, QStatusBar, QComboBox, QCompleter,QSplitter, QMenu, QAction,
+                             QTableView, QStyledItemDelegate, QAbstractItemView, QLineEdit,
+                             QDialog, QPlainTextEdit, QCheckBox, QShortcut
 )
-from PyQt5.QtGui import QFont, QColor, QPalette, QIcon
-from PyQt5.QtCore import Qt, QTimer, QSize, QEvent  # Import QEvent
+from PyQt5.QtGui import QFont, QColor, QPalette, QIcon, QKeySequence
+from PyQt5.QtCore import (Qt, QTimer, QSize, QObject, QAbstractTableModel, QAbstractListModel, QModelIndex, QStringListModel,
+                          QRunnable, QThreadPool, QFileSystemWatcher, QEvent, pyqtSignal)
+import time
+import socket
+from bisect import bisect_left
 from functools import partial
+from contextlib import nullcontext
+from storage import (BackgroundWriter, iter_message_names, read_headers, fit_row, table_export, export_names,
+                     annotator_name, user_state_path, shared_path, merge_json_entries)
+from vocabulary import CompletionIndex, count_sidecar_values
+from navigation import NavigationIndex
+from message_cache import MessageCache, Prefetcher
+from manifest import FolderManifest
+from preannotate import build_gazetteer
+from search_index import build_index, read_documents, document_terms
+from near_duplicates import build_duplicate_index
+from line_memory import LineMemory, placed_rows
+from instrumentation import metrics, count, timed
+from annotation_model import AnnotationTable, TableListener
+from edit_history import EditHistory
+from leases import LeaseManager
+
+
+class SaveScheduler(QObject):
+    """Coalesces bursts of save requests into a single write.
+
+    mark_dirty() restarts a short quiet-period timer; the write happens when
+    the edits stop for quiet_ms, or at the latest max_delay_ms after the first
+    unsaved change. flush() is a no-op while nothing is dirty.
+    """
+
+    def __init__(self, callback, quiet_ms=800, max_delay_ms=5000, parent=None):
+        super().__init__(parent)
+        self.callback = callback  # Returns True if something was written
+        self.quiet_ms = quiet_ms
+        self.max_delay_ms = max_delay_ms
+        self.dirty = False
+        self.pending = 0  # Requests merged into the next write
+        self.requests = 0
+        self.writes = 0
+        self.coalesced = 0
+        self.skipped = 0
+
+        self.quiet_timer = QTimer(self)
+        self.quiet_timer.setSingleShot(True)
+        self.quiet_timer.timeout.connect(self.flush)
+        self.max_timer = QTimer(self)
+        self.max_timer.setSingleShot(True)
+        self.max_timer.timeout.connect(self.flush)
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.pending += 1
+        self.requests += 1
+        self.quiet_timer.start(self.quiet_ms)
+        if not self.max_timer.isActive():
+            self.max_timer.start(self.max_delay_ms)
+
+    def flush(self, force=False):
+        self.quiet_timer.stop()
+        self.max_timer.stop()
+        if not self.dirty and not force:
+            return False
+        pending = self.pending
+        self.dirty = False
+        self.pending = 0
+        if self.callback():
+            self.writes += 1
+            self.coalesced += max(pending - 1, 0)
+            return True
+        self.skipped += 1
+        return False
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'skipped': self.skipped,
+        }
+
+
+class TaskSignals(QObject):
+    finished = pyqtSignal(object)
+
+
+class WriterSignals(QObject):
+    failed = pyqtSignal(object, object, str)  # path, (kind, data, encoding), error
+
+    def emit_failed(self, path, job, error):
+        # BackgroundWriter.on_error: called on the I/O thread, handled on the GUI thread
+        try:
+            self.failed.emit(path, job, error)
+        except RuntimeError:
+            pass  # The window was closed
+
+
+class BackgroundTask(QRunnable):
+    """Runs fn(*args) on the global QThreadPool; finished(result) arrives on the GUI thread."""
+
+    def __init__(self, fn, *args):
+        super().__init__()
+        self.fn = fn
+        self.args = args
+        self.signals = TaskSignals()
+
+    def run(self):
+        try:
+            result = self.fn(*self.args)
+        except Exception as e:
+            print(f"Error in background task {getattr(self.fn, '__name__', self.fn)}: {e}")
+            return
+        try:
+            self.signals.finished.emit(result)
+        except RuntimeError:
+            pass  # The window was closed while the task was running
+
+
+def digest_saved_messages(messages, headers):
+    # Background: [(name, search terms, line memory rows)] of saved messages,
+    # given as (name, text, table_data, processed_text, learn)
+    return [(name, document_terms(text, table_data, processed_text),
+             placed_rows(text, table_data, headers) if learn else {})
+            for name, text, table_data, processed_text, learn in messages]
+
+
+def call_server(fn, *args):
+    # For run_in_background: errors come back as (None, message), not as a silently failed task
+    try:
+        return fn(*args), None
+    except OSError as e:  # Includes annotation_client.ServerError
+        return None, str(e)
+
+
+class ScanSignals(QObject):
+    batch = pyqtSignal(int, list)  # generation, file names
+    finished = pyqtSignal(int, int)  # generation, total files
+    manifest = pyqtSignal(int, object)  # generation, FolderManifest
+
+
+class FolderScanTask(QRunnable):
+    """Streams the *.txt names of a folder in batches from a worker thread.
+
+    The first name is sent immediately so a file can be shown right away;
+    after that, batches go out every batch_interval seconds. If the
+    folder's manifest is still fresh, its names are sent as one batch
+    without listing the folder. Otherwise the manifest is refreshed after
+    the listing.
+    """
+
+    batch_interval = 0.1
+    max_batch = 5000
+
+    def __init__(self, folder, generation):
+        super().__init__()
+        self.folder = folder
+        self.generation = generation
+        self.cancelled = False
+        self.signals = ScanSignals()
+
+    def run(self):
+        try:
+            self.scan()
+        except RuntimeError:
+            pass  # The window was closed while scanning
+
+    def scan(self):
+        manifest = FolderManifest.load(self.folder)
+        if manifest.is_fresh():
+            # Nothing was added, removed or renamed since the manifest was saved
+            names = manifest.names()
+            self.signals.batch.emit(self.generation, names)
+            self.signals.finished.emit(self.generation, len(names))
+        else:
+            if not self.stream_names():
+                return
+            try:
+                manifest.refresh()
+                manifest.save()
+            except OSError as e:
+                print(f"Error updating manifest for {self.folder}: {e}")
+        if not self.cancelled:
+            self.signals.manifest.emit(self.generation, manifest)
+
+    def stream_names(self):
+        batch = []
+        total = 0
+        last_emit = 0
+        try:
+            for name in iter_message_names(self.folder):
+                if self.cancelled:
+                    return False
+                batch.append(name)
+                now = time.monotonic()
+                if total == 0 or len(batch) >= self.max_batch or now - last_emit >= self.batch_interval:
+                    total += len(batch)
+                    self.signals.batch.emit(self.generation, batch)
+                    batch = []
+                    last_emit = now
+        except OSError as e:
+            print(f"Error scanning {self.folder}: {e}")
+        if self.cancelled:
+            return False
+        if batch:
+            total += len(batch)
+            self.signals.batch.emit(self.generation, batch)
+        self.signals.finished.emit(self.generation, total)
+        return True
+
+
+class FileListModel(QAbstractListModel):
+    """Lazy "File N" labels for the file selector; nothing is built per file."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.count = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return f"File {index.row() + 1}"
+        return None
+
+    def set_count(self, count):
+        self.beginResetModel()
+        self.count = count
+        self.endResetModel()
+
+
+class AnnotationTableModel(QAbstractTableModel, TableListener):
+    """Qt view of an AnnotationTable; the view only paints what is visible.
+
+    The rows live in the table, which knows nothing about Qt. Changes made
+    there, by the view or by the tool, reach the view through the listener
+    calls. The column after the last header holds the per-row delete icon.
+    """
+
+    def __init__(self, table, parent=None):
+        super().__init__(parent)
+        self.table = table
+        self.delete_icon = None
+        table.subscribe(self)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.table.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.table.headers) + 1
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        if col == len(self.table.headers):
+            if role == Qt.DecorationRole:
+                if self.delete_icon is None:
+                    self.delete_icon = QIcon('icons/delete_icon.png')
+                return self.delete_icon
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.table.rows[row][col]
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid() or index.column() >= len(self.table.headers):
+            return False
+        return self.table.set_cell(index.row(), index.column(), value)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if index.column() == len(self.table.headers):
+            return Qt.ItemIsEnabled
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            headers = self.table.headers
+            return headers[section] if section < len(headers) else ''
+        return str(section + 1)
+
+    # TableListener
+    def rows_inserting(self, first, last):
+        self.beginInsertRows(QModelIndex(), first, last)
+
+    def rows_inserted(self, first, last):
+        self.endInsertRows()
+
+    def rows_removing(self, first, last):
+        self.beginRemoveRows(QModelIndex(), first, last)
+
+    def rows_removed(self, first, last):
+        self.endRemoveRows()
+
+    def cells_changed(self, first_row, last_row, first_col, last_col):
+        self.dataChanged.emit(self.index(first_row, first_col), self.index(last_row, last_col),
+                              [Qt.DisplayRole, Qt.EditRole])
+
+    def table_resetting(self):
+        self.beginResetModel()
+
+    def table_reset(self):
+        self.endResetModel()
+
+
+class ComboBoxDelegate(QStyledItemDelegate):
+    """Opens a QComboBox editor only for the cell being edited.
+
+    Every editor and completer of a column shares the same item model, so
+    opening an editor does not copy the vocabulary. Closed editors are kept
+    and handed out again instead of being deleted and rebuilt.
+    """
+
+    max_spare_editors = 2
+
+    def __init__(self, model, editable=False, on_commit=None, index_getter=None, parent=None):
+        super().__init__(parent)
+        self.model = model
+        self.editable = editable
+        self.on_commit = on_commit
+        self.index_getter = index_getter  # Returns the CompletionIndex for the column
+        self.spare_editors = []
+
+    def createEditor(self, parent, option, index):
+        while self.spare_editors:
+            combo_box = self.spare_editors.pop()
+            if combo_box.parent() is parent:
+                return combo_box
+            combo_box.deleteLater()
+        count('widgets_created')
+        combo_box = QComboBox(parent)
+        combo_box.setFont(QFont('Arial', 10))
+        combo_box.setModel(self.model)
+        if self.editable:
+            combo_box.setEditable(True)
+            # New terms go through on_commit, never straight into the shared model
+            combo_box.setInsertPolicy(QComboBox.NoInsert)
+            if self.index_getter is not None:
+                completer = IndexedCompleter(self.index_getter, combo_box)
+                combo_box.setCompleter(completer)
+                combo_box.lineEdit().textEdited.connect(completer.update_completions)
+            else:
+                combo_box.setCompleter(QCompleter(self.model, combo_box))
+        return combo_box
+
+    def destroyEditor(self, editor, index):
+        # The view has already hidden it
+        if len(self.spare_editors) < self.max_spare_editors:
+            self.spare_editors.append(editor)
+        else:
+            super().destroyEditor(editor, index)
+
+    def setEditorData(self, editor, index):
+        editor.setCurrentText(index.data(Qt.EditRole) or '')
+
+    def setModelData(self, editor, model, index):
+        text = editor.currentText()
+        if model.setData(index, text, Qt.EditRole) and self.on_commit:
+            self.on_commit(text)
+
+
+class IndexedCompleter(QCompleter):
+    """Shows the ranked top-k of a CompletionIndex instead of Qt's prefix filter."""
+
+    max_results = 15
+
+    def __init__(self, index_getter, parent=None):
+        super().__init__(parent)
+        self.index_getter = index_getter
+        self.results = QStringListModel(self)
+        self.setModel(self.results)
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.setCaseSensitivity(Qt.CaseInsensitive)
+
+    def update_completions(self, text):
+        self.results.setStringList(self.index_getter().complete(text, self.max_results))
+        if text:
+            self.complete()
+
+
+class StatsDialog(QDialog):
+    """Hidden window (Ctrl+Shift+M) over the instrumentation metrics."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Performance Stats')
+        self.resize(900, 500)
+        layout = QVBoxLayout(self)
+
+        self.record_box = QCheckBox('Record timings and counters', self)
+        self.record_box.setChecked(metrics.enabled)
+        self.record_box.toggled.connect(self.set_recording)
+        layout.addWidget(self.record_box)
+        self.capture_box = QCheckBox('Profile (cProfile + tracemalloc, slows the tool down)', self)
+        self.capture_box.setChecked(metrics.capturing)
+        self.capture_box.toggled.connect(self.set_capturing)
+        layout.addWidget(self.capture_box)
+
+        self.text = QPlainTextEdit(self)
+        self.text.setReadOnly(True)
+        self.text.setFont(QFont('Courier', 10))
+        self.text.setLineWrapMode(QPlainTextEdit.NoWrap)
+        layout.addWidget(self.text)
+
+        buttons = QHBoxLayout()
+        for label, callback in (('Refresh', self.refresh), ('Reset', self.reset),
+                                ('Export JSON...', self.export_json), ('Export Chrome trace...', self.export_trace)):
+            button = QPushButton(label, self)
+            button.clicked.connect(callback)
+            buttons.addWidget(button)
+        layout.addLayout(buttons)
+
+        # Only refreshes while the dialog is open
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.refresh_timer.start(1000)
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.refresh_timer.stop()
+        super().hideEvent(event)
+
+    def refresh(self):
+        if metrics.enabled or metrics.spans:
+            self.text.setPlainText(metrics.format_summary())
+        else:
+            self.text.setPlainText('Recording is off.')
+
+    def reset(self):
+        metrics.reset()
+        self.refresh()
+
+    def set_recording(self, enabled):
+        metrics.enabled = enabled
+        self.refresh()
+
+    def set_capturing(self, enabled):
+        if enabled:
+            metrics.start_capture()
+            return
+        paths = metrics.stop_capture()
+        if paths:
+            self.text.appendPlainText('\nProfile written to ' + ', '.join(paths))
+            self.refresh_timer.stop()  # Keep the paths visible until the next refresh
+            QTimer.singleShot(10000, self.resume_refresh)
+
+    def resume_refresh(self):
+        if self.isVisible():
+            self.refresh_timer.start(1000)
+
+    def export_json(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Metrics', 'metrics.json', 'JSON (*.json)')
+        if path:
+            metrics.export_json(path)
+
+    def export_trace(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export Chrome Trace', 'trace.json', 'JSON (*.json)')
+        if path:
+            metrics.export_chrome_trace(path)
+
 
 class MessageTool(QMainWindow):
+    # Editable table columns backed by a vocabulary list attribute
+    vocabulary_columns = {
+        "product name": "product_name_list",
+        "brand": "brand_list",
+        "category": "category_list",
+        "color": "color_list",
+    }
+    vocabulary_file_keys = {  # Keys of the lists in brand_category_color.json
+        "product_name_list": "product_names",
+        "brand_list": "brands",
+        "category_list": "categories",
+        "color_list": "colors",
+    }
+    gazetteer_lists = ("product_name_list", "brand_list", "color_list")  # Matched in messages to propose rows
+    gazetteer_recent_limit = 200  # Terms added since the gazetteer was built before it is built again
+
     def __init__(self):
         super().__init__()
+        self.startup_started = time.perf_counter()
+        self.first_paint_ms = None  # Time to first paint, once painted
+        self.startup_finished = False
 
         self.current_index = -1  # Özniteliği burada tanımlayın
 
+        # Debounced persistence: edits only mark the state dirty
+        self.last_saved = {}  # path -> last snapshot handed to the writer
+        self.failed_writes = {}  # path -> (snapshot, encoding) whose write failed; tried again on the next save
+        self.writer_signals = WriterSignals()
+        self.writer_signals.failed.connect(self.on_write_failed)
+        self.writer = BackgroundWriter(on_error=self.writer_signals.emit_failed,  # Disk I/O runs off the GUI thread
+                                       around=self.around_write)
+        self.message_cache = MessageCache()  # Parsed messages and sidecars, checked by mtime
+        self.prefetcher = Prefetcher(self.message_cache)
+        self.save_scheduler = SaveScheduler(self.save_state, parent=self)
+
         self.initUI()
         
         self.input_folder = ""
@@ -24,7 +521,7 @@ class MessageTool(QMainWindow):
 
         self.folder_indices = {}  # Dictionary to store the current index for each folder
        
-        self.read_files = []  # List to store read files
+        self.navigation = NavigationIndex()  # Read status and unread positions
 
         self.product_name_list = []  # List to store unique product names
 
@@ -32,7 +529,67 @@ class MessageTool(QMainWindow):
         self.category_list = []  # List to store category names
         self.color_list = []  # List to store color names
 
-        self.load_table_headers()
+        # One model per vocabulary column, shared by all editors and completers
+        self.offer_type_model = QStringListModel(["WTB", "WTS"], self)
+        self.vocabulary_models = {name: QStringListModel(self) for name in self.vocabulary_columns.values()}
+        self.completion_indexes = {}  # list name -> CompletionIndex, built when first needed
+        self.vocabulary_generation = 0  # Background builds from older lists are dropped
+        self.term_frequencies = {}  # list name -> Counter of uses in the loaded folder's sidecars
+        self.gazetteer = None  # Built in the background, then extended as terms are added
+        self.gazetteer_pending = False
+        self.proposals_partial = False  # Current proposals were made before the gazetteer was ready
+        self.line_memory = LineMemory.load()  # Rows last given to each message line
+        self.proposed_rows = None  # Pre-annotation of the current file, until edited
+        self.search_index = None  # SearchIndex of the open folder, once built
+        self.search_stale = set()  # Messages saved while the index was being built
+        # Saved messages wait here to be indexed and learned off the GUI thread; repeated saves coalesce
+        self.saved_messages = {}  # name -> (name, text, table_data, processed_text, learn)
+        self.saved_sequence = {}  # name -> digest pass that carries its latest save
+        self.digest_passes = 0
+        self.digest_timer = QTimer(self)
+        self.digest_timer.setSingleShot(True)
+        self.digest_timer.timeout.connect(self.digest_saved)
+        self.search_hits = []
+        self.duplicate_index = None  # Near-duplicate clusters of the open folder
+        self.duplicate_names = []  # Messages listed in duplicate_selector
+        self.background_tasks = set()  # Keeps running BackgroundTask signals alive
+        self.scan_task = None  # Running FolderScanTask, if any
+        self.scan_generation = 0  # Results from older scans are ignored
+        self.scan_target = None
+        self.scan_provisional = None
+        self.scan_started = 0.0
+
+        # Several annotators may share a folder: each message is edited under a lease
+        self.annotator = annotator_name()
+        self.state_path = user_state_path(self.annotator)
+        self.vocabulary_path = shared_path('brand_category_color.json')  # Next to line_memory.json
+        self.leases = None  # LeaseManager of the open folder
+        self.lease_holder = None  # Who else holds the message on screen; read-only while set
+        self.lease_timer = QTimer(self)
+        self.lease_timer.timeout.connect(self.renew_leases)
+
+        # Server mode (MESSAGETOOL_SERVER=http://host:port): messages are leased from annotation_server.py
+        server_url = os.environ.get('MESSAGETOOL_SERVER')
+        self.server = None
+        if server_url:
+            from annotation_client import AnnotationClient  # urllib costs startup time in folder mode
+            self.server = AnnotationClient(server_url, client=f"{self.annotator}@{socket.gethostname()}")
+        self.server_message = None  # The leased message on screen
+        self.server_submitted = None  # (table_data, processed_text) last sent for it
+        self.refused_table = None  # (name, (table_data, processed_text), reason) of a handback after the lease was lost
+
+        # Folder manifest, kept up to date by a watcher (or stat polling)
+        self.manifest = None
+        self.manifest_refreshing = False
+        self.folder_watcher = QFileSystemWatcher(self)
+        self.folder_watcher.directoryChanged.connect(self.on_folder_changed)
+        self.folder_refresh_timer = QTimer(self)
+        self.folder_refresh_timer.setSingleShot(True)
+        self.folder_refresh_timer.timeout.connect(self.refresh_manifest)
+        self.folder_poll_timer = QTimer(self)
+        self.folder_poll_timer.timeout.connect(self.poll_folder)
+
+        self.load_table_headers()  # The only place the table is built
 
         # Timer for auto save (initialize but do not start)
         self.timer = QTimer(self)
@@ -42,6 +599,10 @@ class MessageTool(QMainWindow):
         self.update_status()
         self.start_auto_save()
         self.initial_load_done = True  # Set flag to True after initial load
+        self.history.clear()  # Building the table and restoring state are not edits
+        # The folder scan and vocabulary indexes start after the first paint;
+        # this covers a window that is never painted (e.g. started minimized)
+        QTimer.singleShot(1000, self.finish_startup)
 
 
     def initUI(self):
@@ -124,7 +685,11 @@ class MessageTool(QMainWindow):
         self.processed_text.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         left_layout.addWidget(self.processed_text)
         self.processed_text.hide()  # Initially hide the processed text area
-        self.processed_text.textChanged.connect(self.save_state)  # Processed Text değişikliklerini kaydetmek için
+        self.processed_text.textChanged.connect(self.request_save)  # Processed Text değişikliklerini kaydetmek için
+        # Its edits go to the shared, bounded history instead of the document's own
+        self.processed_text.setUndoRedoEnabled(False)
+        self.processed_text.textChanged.connect(self.record_text_edit)
+        self.processed_text.installEventFilter(self)
 
 
         self.file_path_label = QLabel('')
@@ -150,68 +715,62 @@ class MessageTool(QMainWindow):
         self.next_button = self.create_icon_button('icons/next_icon.png', self.show_next_message)
         left_layout.addWidget(self.next_button)
 
+        # Full-text search; picking a hit moves the file selector to it
+        self.search_box = QLineEdit(self)
+        self.search_box.setPlaceholderText('Search: words, "phrase", -exclude, OR')
+        self.search_box.returnPressed.connect(self.run_search)
+        left_layout.addWidget(self.search_box)
+        self.search_results = QComboBox(self)
+        self.search_results_model = QStringListModel(self)
+        self.search_results.setModel(self.search_results_model)
+        self.search_results.view().setUniformItemSizes(True)
+        self.search_results.setSizeAdjustPolicy(QComboBox.AdjustToMinimumContentsLengthWithIcon)
+        self.search_results.activated.connect(self.open_search_result)
+        left_layout.addWidget(self.search_results)
+
         # QComboBox for file selection
         self.file_selector = QComboBox(self)
+        self.file_list_model = FileListModel(self)
+        self.file_selector.setModel(self.file_list_model)
+        self.file_selector.view().setUniformItemSizes(True)  # Do not measure every row
+        self.file_selector.setSizeAdjustPolicy(QComboBox.AdjustToMinimumContentsLengthWithIcon)
         self.file_selector.currentIndexChanged.connect(self.go_to_selected_file)
         left_layout.addWidget(self.file_selector)
 
         splitter.addWidget(left_container)
 
-        # Right container with layout
-        right_container = QWidget()
-        right_layout = QVBoxLayout(right_container)
-        right_layout.setSpacing(10)
-        right_layout.setContentsMargins(10, 10, 10, 10)
-
-        self.scroll_area = QScrollArea()
-        self.scroll_widget = QWidget()
-        self.table_layout = QGridLayout(self.scroll_widget)
-        self.scroll_area.setWidget(self.scroll_widget)
-        self.scroll_area.setWidgetResizable(True)
-        right_layout.addWidget(self.scroll_area)
-
-        button_layout = QHBoxLayout()
-        self.add_row_button = self.create_icon_button('icons/add_icon.png', self.add_table_row, 40)
-        button_layout.addWidget(self.add_row_button)
-
-        self.save_button = self.create_icon_button('icons/save_icon.png', self.save_state)
-        button_layout.addWidget(self.save_button)
-
-        self.export_button = self.create_icon_button('icons/export_icon.png', self.export_table)
-        button_layout.addWidget(self.export_button)
-
-        right_layout.addLayout(button_layout)
-
-        splitter.addWidget(right_container)
+        splitter.addWidget(self.create_right_widget())
         
         # Set initial sizes of the splitter
         splitter.setSizes([300, 900])  # Adjust these values to set the initial width of the left and right panels
 
         self.update_read_button()  # Initialize button and label text
 
+        # Not in any menu: opened by whoever investigates a report of the tool freezing
+        self.stats_dialog = None
+        QShortcut(QKeySequence('Ctrl+Shift+M'), self, self.show_stats_dialog)
+        # Every platform binding (Ctrl+Y and Ctrl+Shift+Z); QShortcut alone takes only the first
+        for keys in QKeySequence.keyBindings(QKeySequence.Undo):
+            QShortcut(keys, self, self.undo_edit)
+        for keys in QKeySequence.keyBindings(QKeySequence.Redo):
+            QShortcut(keys, self, self.redo_edit)
+
 
     def switch_view_mode(self):
         selected_mode = self.view_mode.currentText()
         if selected_mode == "Tablo":
-            self.scroll_area.show()
+            self.table_container.show()
             self.processed_text.hide()
         elif selected_mode == "Processed Text":
-            self.scroll_area.hide()
+            self.table_container.hide()
             self.processed_text.show()
             # Processed text kutusunu temizle ve yükle
             if 0 <= self.current_index < len(self.files):
+                self.save_scheduler.flush()  # Pending edits must reach the sidecar first
                 current_file = self.files[self.current_index]
                 file_path = os.path.join(self.input_folder, current_file + '.json')
-                if os.path.exists(file_path):
-                    with open(file_path, 'r', encoding='utf-8') as file:
-                        data = json.load(file)
-                        if isinstance(data, dict):
-                            processed_text = data.get('processed_text', '')
-                            self.processed_text.setText(processed_text)
-                        else:
-                            self.processed_text.setText('')
-                else:
-                    self.processed_text.setText('')
+                sidecar = self.read_sidecar(file_path)
+                self.processed_text.setText(sidecar[1] if sidecar is not None else '')
 
 
 
@@ -231,11 +790,9 @@ class MessageTool(QMainWindow):
     def export_processed_text(self):
         if 0 <= self.current_index < len(self.files):
             current_file = self.files[self.current_index]
-            file_path = os.path.join(self.input_folder, current_file)
             processed_content = self.processed_text.toPlainText()
-            output_path = os.path.join(self.output_folder, f"{os.path.splitext(current_file)[0]}_processed.txt")
-            with open(output_path, 'w', encoding='utf-8') as file:
-                file.write(processed_content)
+            output_path = os.path.join(self.output_folder, export_names(current_file)[1])
+            self.writer.submit_text(output_path, processed_content)
             self.status_bar.showMessage("Processed text exported successfully.", 5000)
 
 
@@ -257,9 +814,7 @@ class MessageTool(QMainWindow):
     
     def update_read_button(self):
         if 0 <= self.current_index < len(self.files):
-            file_name = self.files[self.current_index]
-            file_path = os.path.join(self.input_folder, file_name)
-            if file_path in self.read_files:
+            if self.navigation.is_read(self.current_index):
                 self.read_button.setText("Readed")
                 self.read_button.setStyleSheet("""
                     QPushButton {
@@ -315,9 +870,8 @@ class MessageTool(QMainWindow):
     def mark_as_read(self):
         if 0 <= self.current_index < len(self.files):
             file_name = self.files[self.current_index]
-            file_path = os.path.join(self.input_folder, file_name)
-            if file_path in self.read_files:
-                self.read_files.remove(file_path)
+            if self.navigation.is_read(self.current_index):
+                self.navigation.set_read(self.current_index, False)
                 self.read_button.setText("Not Readed")
                 self.read_button.setStyleSheet("""
                     QPushButton {
@@ -335,7 +889,7 @@ class MessageTool(QMainWindow):
                 self.read_label.setText("Not Readed")
                 self.status_bar.showMessage(f"Marked {file_name} as unread.", 5000)
             else:
-                self.read_files.append(file_path)
+                self.navigation.set_read(self.current_index)
                 self.read_button.setText("Readed")
                 self.read_button.setStyleSheet("""
                     QPushButton {
@@ -352,7 +906,7 @@ class MessageTool(QMainWindow):
                 """)
                 self.read_label.setText("Readed")
                 self.status_bar.showMessage(f"Marked {file_name} as read.", 5000)
-            self.save_state()  # Save state after marking as read/unread
+            self.request_save()  # Save state after marking as read/unread
 
 
 
@@ -376,31 +930,98 @@ class MessageTool(QMainWindow):
         right_layout.setSpacing(10)
         right_layout.setContentsMargins(10, 10, 10, 10)
 
-        self.scroll_area = QScrollArea()
-        self.scroll_widget = QWidget()
-        self.table_layout = QGridLayout(self.scroll_widget)
-        self.scroll_area.setWidget(self.scroll_widget)
-        self.scroll_area.setWidgetResizable(True)
-        right_layout.addWidget(self.scroll_area)
+        self.table_container = QWidget()
+        table_layout = QVBoxLayout(self.table_container)
+        table_layout.setContentsMargins(0, 0, 0, 0)
+
+        # Sets the Offer Type of every row at once
+        offer_type_layout = QHBoxLayout()
+        offer_type_label = QLabel('Offer Type')
+        offer_type_label.setFont(QFont('Arial', 10, QFont.Bold))
+        offer_type_layout.addWidget(offer_type_label)
+        self.offer_type_combo = QComboBox()
+        self.offer_type_combo.addItems(["WTB", "WTS"])
+        self.offer_type_combo.currentTextChanged.connect(self.update_all_offer_types)
+        offer_type_layout.addWidget(self.offer_type_combo)
+        offer_type_layout.addStretch()
+        table_layout.addLayout(offer_type_layout)
+
+        # Near-duplicates of the current message, whose rows can be copied over
+        duplicate_layout = QHBoxLayout()
+        duplicate_label = QLabel('Duplicates')
+        duplicate_label.setFont(QFont('Arial', 10, QFont.Bold))
+        duplicate_layout.addWidget(duplicate_label)
+        self.duplicate_selector = QComboBox()
+        self.duplicate_selector.setSizeAdjustPolicy(QComboBox.AdjustToContents)
+        duplicate_layout.addWidget(self.duplicate_selector)
+        self.copy_rows_button = QPushButton('Copy rows')
+        self.copy_rows_button.clicked.connect(self.copy_duplicate_rows)
+        duplicate_layout.addWidget(self.copy_rows_button)
+        duplicate_layout.addStretch()
+        table_layout.addLayout(duplicate_layout)
+
+        self.annotation_table = AnnotationTable()  # The rows themselves; the Qt model only presents them
+        self.table_model = AnnotationTableModel(self.annotation_table, parent=self)
+        undo_mb = float(os.environ.get('MESSAGETOOL_UNDO_MB', 8))
+        self.history = EditHistory(self.annotation_table, set_text=self.apply_history_text,
+                                   max_bytes=int(undo_mb * 2**20), on_change=self.update_undo_buttons)
+        self.table_model.dataChanged.connect(self.request_save)
+        self.table_view = QTableView()
+        self.table_view.setModel(self.table_model)
+        self.table_view.setFont(QFont('Arial', 10))
+        self.table_view.setAlternatingRowColors(True)
+        self.table_view.setEditTriggers(QAbstractItemView.AllEditTriggers)
+        self.table_view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table_view.horizontalHeader().setDefaultSectionSize(120)
+        self.table_view.verticalHeader().setDefaultSectionSize(40)
+        self.table_view.setIconSize(QSize(30, 30))
+        self.table_view.setStyleSheet("""
+            QTableView {
+                background-color: #FFFFFF;
+                alternate-background-color: #F9F9F9;
+                gridline-color: #BDBDBD;
+            }
+            QTableView::item:focus {
+                border: 2px solid #4A90E2;
+            }
+            QHeaderView::section {
+                background-color: #C8E6C9;
+                color: black;
+                padding: 10px;
+                border: 1px solid #BDBDBD;
+                font-family: 'Arial';
+                font-weight: bold;
+            }
+        """)
+        self.table_view.clicked.connect(self.on_table_clicked)
+        table_layout.addWidget(self.table_view)
+        right_layout.addWidget(self.table_container)
 
         button_layout = QHBoxLayout()
         self.add_row_button = self.create_icon_button('icons/add_icon.png', self.add_table_row, 40)
         button_layout.addWidget(self.add_row_button)
 
-        self.save_button = self.create_icon_button('icons/save_icon.png', self.save_state)
+        self.save_button = self.create_icon_button('icons/save_icon.png', self.save_now)
         button_layout.addWidget(self.save_button)
 
         self.export_button = self.create_icon_button('icons/export_icon.png', self.export_table)
         button_layout.addWidget(self.export_button)
 
-        right_layout.addLayout(button_layout)
+        self.undo_button = self.create_icon_button('icons/undo_icon.png', self.undo_edit)
+        self.undo_button.setToolTip(f"Undo ({QKeySequence(QKeySequence.Undo).toString(QKeySequence.NativeText)})")
+        button_layout.addWidget(self.undo_button)
 
-        return right_widget
+        self.redo_button = self.create_icon_button('icons/redo_icon.png', self.redo_edit)
+        self.redo_button.setToolTip(f"Redo ({QKeySequence(QKeySequence.Redo).toString(QKeySequence.NativeText)})")
+        button_layout.addWidget(self.redo_button)
+        self.update_undo_buttons()
 
-       
+        right_layout.addLayout(button_layout)
 
+        return right_widget
 
     def create_icon_button(self, icon_path, callback, size=40):
+        count('widgets_created')
         button = QPushButton(self)
         button.setIcon(QIcon(icon_path))
         button.setIconSize(QSize(size, size))
@@ -419,69 +1040,194 @@ class MessageTool(QMainWindow):
         return button
 
     def select_input_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, 'Select Input Folder')
+        if not folder:
+            return
+        self.save_scheduler.flush(force=True)  # Persist the outgoing file first
         # Mevcut klasörün indeksini kaydet
         if self.input_folder:
             self.folder_indices[self.input_folder] = self.current_index
 
-        self.input_folder = QFileDialog.getExistingDirectory(self, 'Select Input Folder')
-        self.load_files()
-        
-        # Yeni klasörün mevcut dosya indeksini yükle
-        if self.input_folder in self.folder_indices:
-            self.current_index = self.folder_indices[self.input_folder]
-        else:
-            self.current_index = 0 if self.files else -1  # Yeni klasör için indeks ayarla
-
-        self.show_message()
-        self.save_state()  # Yeni klasör yüklendikten sonra durumu kaydet
+        self.input_folder = folder
+        # Yeni klasörün mevcut dosya indeksini yükle (tarama bitince)
+        self.load_files(target_index=self.folder_indices.get(self.input_folder, 0))
         self.file_path_label.setText(f"Input Folder: {self.input_folder}")
         self.status_bar.showMessage("Input folder selected.", 5000)
 
     def go_to_selected_file(self):
         selected_index = self.file_selector.currentIndex()
-        if 0 <= selected_index < len(self.files):
+        if 0 <= selected_index < len(self.files) and selected_index != self.current_index:
+            self.save_scheduler.flush(force=True)
             self.current_index = selected_index
             self.show_message()
-            self.save_state()
+            self.request_save()
             self.status_bar.showMessage(f"Showing file {self.current_index + 1} of {len(self.files)}.", 5000)
 
 
 
-    def load_files(self):
+    @timed('load_files')
+    def load_files(self, target_index=None):
+        # Scans in the background; target_index is opened once the scan is
+        # complete (default: the first unread file)
         if self.input_folder:
-            all_files = sorted([f for f in os.listdir(self.input_folder) if f.endswith('.txt')])
-            self.files = all_files  # Update to load all files, including read files
-
-
-            # QComboBox'ı numaralarla doldurun
-            self.file_selector.clear()
-            for i in range(len(self.files)):
-                self.file_selector.addItem(f"File {i+1}")
-
-            # Set current_index to the first unread file
+            if self.scan_task is not None:
+                self.scan_task.cancelled = True
+            self.scan_generation += 1
+            self.scan_target = target_index
+            self.scan_provisional = None
+            self.files = []
+            self.current_index = -1
+            self.proposed_rows = None
+            self.navigation.set_files(self.input_folder, self.files)
+            self.set_file_selector_count(0)
+
+            self.digest_saved()  # Learn what was saved in the folder being left
+            self.manifest = None
+            self.search_index = None
+            self.search_stale.clear()
+            self.search_hits = []
+            self.search_results_model.setStringList([])
+            self.duplicate_index = None
+            task = FolderScanTask(self.input_folder, self.scan_generation)
+            task.signals.batch.connect(self.on_scan_batch)
+            task.signals.finished.connect(self.on_scan_finished)
+            task.signals.manifest.connect(self.on_manifest_ready)
+            self.scan_task = task
+            self.scan_started = time.perf_counter()
+            QThreadPool.globalInstance().start(task)
+            self.status_bar.showMessage("Scanning folder...")
+
+    def set_file_selector_count(self, count):
+        self.file_selector.blockSignals(True)
+        self.file_list_model.set_count(count)
+        self.file_selector.setCurrentIndex(self.current_index)
+        self.file_selector.blockSignals(False)
+
+    def on_scan_batch(self, generation, names):
+        if generation != self.scan_generation:
+            return
+        current_name = self.files[self.current_index] if 0 <= self.current_index < len(self.files) else None
+        self.files.extend(names)
+        self.files.sort()  # Timsort merges the sorted prefix with the new run
+        if current_name is not None:
+            self.current_index = bisect_left(self.files, current_name)
+        self.set_file_selector_count(len(self.files))
+        self.navigation.set_files(self.input_folder, self.files)  # Positions shifted; O(n) per batch
+        if current_name is None:
+            # Show something as soon as the first file is found
             self.current_index = 0
-            for i, file in enumerate(self.files):
-                if os.path.join(self.input_folder, file) not in self.read_files:
-                    self.current_index = i
-                    break
-
-            if self.files:
+            self.scan_provisional = self.files[0]
+            self.show_message()
+        self.status_bar.showMessage(f"Scanning folder: {len(self.files)} files found...")
+
+    def on_scan_finished(self, generation, total):
+        if generation != self.scan_generation:
+            return
+        self.scan_task = None
+        if metrics.enabled:
+            # load_files only starts the scan; this span covers it up to the last name
+            metrics.record('load_files.scan', self.scan_started, time.perf_counter() - self.scan_started)
+        current_name = self.files[self.current_index] if 0 <= self.current_index < len(self.files) else None
+        if self.files and current_name == self.scan_provisional:
+            # The user has not navigated away from the provisional file yet
+            if self.scan_target is not None and 0 <= self.scan_target < len(self.files):
+                target = self.scan_target
+            else:
+                first_unread = self.navigation.first_unread()
+                target = first_unread if first_unread is not None else 0
+            if target != self.current_index:
+                self.current_index = target
                 self.show_message()
-                self.update_status()
-                self.status_bar.showMessage(f"{len(self.files)} files loaded.", 5000)
             else:
-                self.current_index = -1  # Dosya yoksa geçersiz index
-                self.status_bar.showMessage("No txt files found in the selected folder.", 5000)
-            self.update_read_button()  # Read button textini güncelle
+                self.update_read_button()
 
+        if self.files:
+            self.update_status()
+            self.status_bar.showMessage(f"{len(self.files)} files loaded.", 5000)
+        else:
+            self.current_index = -1  # Dosya yoksa geçersiz index
+            self.show_message()
+            self.status_bar.showMessage("No txt files found in the selected folder.", 5000)
+        self.update_read_button()  # Read button textini güncelle
+        self.request_save()
+        self.load_term_frequencies()
+        self.build_search_index()
+
+    def on_manifest_ready(self, generation, manifest):
+        if generation != self.scan_generation:
+            return
+        self.manifest = manifest
+        self.watch_folder(manifest.folder)
+        # The manifest already holds each message's md5, the key of the MinHash cache
+        digests = {name: entry[2] for name, entry in manifest.messages.items()}
+        folder = self.input_folder
+        self.run_in_background(build_duplicate_index, partial(self.on_duplicates_ready, folder),
+                               folder, manifest.names(), digests)
+
+    def watch_folder(self, folder):
+        if self.folder_watcher.directories():
+            self.folder_watcher.removePaths(self.folder_watcher.directories())
+        if self.folder_watcher.addPath(folder):
+            self.folder_poll_timer.stop()
+        else:
+            self.folder_poll_timer.start(5000)  # No native watcher: poll the folder mtime
+
+    def on_folder_changed(self, path):
+        self.folder_refresh_timer.start(2000)  # Let bursts of changes settle
+
+    def poll_folder(self):
+        if self.manifest is not None and not self.manifest.is_fresh():
+            self.refresh_manifest()
+
+    def refresh_manifest(self):
+        if self.manifest is None:
+            return
+        if self.manifest_refreshing:
+            self.folder_refresh_timer.start(2000)
+            return
+        if self.manifest.is_fresh():
+            return  # Only our own saves changed the folder
+        self.manifest_refreshing = True
+        manifest = self.manifest
+        self.run_in_background(manifest.update, partial(self.apply_folder_changes, manifest))
+
+    def apply_folder_changes(self, manifest, changes):
+        self.manifest_refreshing = False
+        if manifest is not self.manifest:
+            return  # Another folder was opened meanwhile
+        # Our own saves are noted in the manifest as they are written (around_write), so these are someone else's
+        added, removed, changed, sidecars = changes
+        for name in changed:
+            self.message_cache.invalidate(os.path.join(self.input_folder, name))
+        for name in sidecars:
+            self.message_cache.invalidate(os.path.join(self.input_folder, name) + '.json')
+        if self.search_index is not None:
+            for name in removed:
+                self.search_index.remove(name)
+            stale = sorted(set(added).union(changed, sidecars))
+            if stale:
+                index = self.search_index
+                self.run_in_background(read_documents, partial(self.on_documents_read, index),
+                                       self.input_folder, stale)
+        if added or removed:
+            current_name = self.files[self.current_index] if 0 <= self.current_index < len(self.files) else None
+            self.files = manifest.names()
+            position = bisect_left(self.files, current_name) if current_name is not None else 0
+            current_removed = current_name is None or position >= len(self.files) or self.files[position] != current_name
+            self.current_index = min(position, len(self.files) - 1)
+            self.navigation.set_files(self.input_folder, self.files)
+            self.set_file_selector_count(len(self.files))
+            if current_removed:
+                self.show_message()
+            self.status_bar.showMessage(f"Folder changed: {len(added)} added, {len(removed)} removed.", 5000)
 
+    @timed('show_message')
     def show_message(self):
         if 0 <= self.current_index < len(self.files):
             file_path = os.path.join(self.input_folder, self.files[self.current_index])
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    content = file.read()
-                    self.message_text.setText(content)
+            content = self.message_cache.get_text(file_path)
+            if content is not None:
+                self.message_text.setText(content)
                 file_name = self.files[self.current_index]  # Sadece dosya adı
                 self.file_path_label.setText(f"Current File: {file_name}")  # Update file name label
                 self.update_status()
@@ -491,12 +1237,16 @@ class MessageTool(QMainWindow):
 
                 # Load table data for the current file
                 self.load_table_data_for_current_file()
+                self.update_duplicates()
+                self.prefetch_neighbours()
             else:
                 self.status_bar.showMessage(f"File not found: {file_path}", 5000)
         else:
             self.message_text.setText("")
             self.file_path_label.setText("")
-            self.processed_text.setText("")  # Temizle
+            with self.history.paused():
+                self.processed_text.setText("")  # Temizle
+            self.history.clear()
             self.update_status()
             self.update_read_button()
             self.status_bar.showMessage("No files to display.", 5000)
@@ -509,29 +1259,51 @@ class MessageTool(QMainWindow):
 
 
 
+    @timed('load_table_data')
     def load_table_data_for_current_file(self):
+        # Opening a message is not an edit; the history starts over with it
+        with self.history.paused():
+            self._load_table_data_for_current_file()
+        self.history.clear()
+        self.claim_current_message()
+
+    def _load_table_data_for_current_file(self):
         if 0 <= self.current_index < len(self.files):
             current_file = self.files[self.current_index]
             file_path = os.path.join(self.input_folder, current_file)
             table_data_path = file_path + '.json'
-            if os.path.exists(table_data_path):
-                with open(table_data_path, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                    if isinstance(data, list):  # Eğer data bir liste ise eski formatı dönüştür
-                        table_data = data
-                        processed_text = ''
-                    else:  # Eğer data bir sözlük ise yeni formatı kullan
-                        table_data = data.get('table_data', [])
-                        processed_text = data.get('processed_text', '')
-                    self.set_table_data(table_data)
-                    self.processed_text.setText(processed_text)  # Load the processed text for the current file
+            sidecar = self.read_sidecar(table_data_path)
+            self.proposed_rows = None
+            if sidecar is not None:
+                table_data, processed_text = sidecar
+                self.set_table_data(table_data)
+                self.processed_text.setText(processed_text)  # Load the processed text for the current file
+                # Nothing changed yet, so the next flush can skip this sidecar
+                self.last_saved[table_data_path] = {'table_data': self.get_table_data(), 'processed_text': processed_text}
             else:
-                self.set_table_data([])  # Clear the table if no data is found
                 self.processed_text.setText("")  # Clear processed text if no data is found
+                self.show_proposals()
         # Add default row if no data is present
-        if not self.table_data:
+        if self.table_model.rowCount() == 0:
             self.add_table_row()
 
+    def show_proposals(self):
+        # Unannotated message: reuse rows of known lines, propose the rest
+        content = self.current_message_text()
+        rows, remembered = self.propose_rows(content) if content else ([], 0)
+        self.set_table_data(rows)
+        if not rows:
+            self.add_table_row()
+        self.proposed_rows = self.get_table_data()
+        # Nothing is saved until the user edits: unreviewed proposals must not pass for annotations
+        saved = {'table_data': self.proposed_rows, 'processed_text': self.processed_text.toPlainText()}
+        if self.server_message is not None:
+            self.server_submitted = (saved['table_data'], saved['processed_text'])
+        else:
+            self.last_saved[os.path.join(self.input_folder, self.files[self.current_index]) + '.json'] = saved
+        if rows:
+            self.status_bar.showMessage(f"Pre-annotated {len(rows)} rows ({remembered} from line memory).", 5000)
+
 
 
 
@@ -539,501 +1311,512 @@ class MessageTool(QMainWindow):
                 
 
     
-    def get_table_data(self):
-        data = []
-        for row_data in self.table_data:
-            row = []
-            for item in row_data:
-                if isinstance(item, QComboBox):
-                    row.append(item.currentText())
-                elif isinstance(item, QLineEdit):
-                    row.append(item.text())
-            data.append(row)
-        return data
-
-    def set_table_data(self, data):
-        # Clear existing table data
-        for i in reversed(range(len(self.table_data))):
-            self.delete_table_row(i)
-
-        self.table_data = []
-        num_headers = len(self.headers)  # Number of headers
-
-        for row_position, row_data in enumerate(data):
-            # Ensure row_data has the same length as headers by truncating or padding with empty strings
-            if len(row_data) > num_headers:
-                row_data = row_data[:num_headers]  # Truncate extra columns
-            else:
-                row_data.extend([""] * (num_headers - len(row_data)))  # Pad with empty strings
-
-            row = []
-            for col in range(num_headers):
-                value = row_data[col]
-
-                if self.headers[col].lower() == "offer type":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(["WTB", "WTS"])
-                    combo_box.setCurrentText(value)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "product name":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.product_name_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.product_name_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_product_name_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "brand":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.brand_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.brand_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_brand_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "category":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.category_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.category_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_category_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "color":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.color_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.color_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_color_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                else:
-                    line_edit = QLineEdit()
-                    line_edit.setFont(QFont('Arial', 10))
-                    line_edit.setText(value)
-                    line_edit.setFixedHeight(40)
-                    line_edit.setFixedWidth(120)
-                    line_edit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    line_edit.installEventFilter(self)
-                    self.table_layout.addWidget(line_edit, row_position + 1, col)
-                    row.append(line_edit)
-
-            delete_button = self.create_icon_button('icons/delete_icon.png', partial(self.delete_table_row, row_position), size=40)
-            self.table_layout.addWidget(delete_button, row_position + 1, len(self.headers))
-
-            self.table_data.append(row)
-        self.status_bar.showMessage("State loaded.", 5000)
-
-
-
-
+    def current_message_text(self):
+        if self.server_message is not None:
+            return self.server_message['text']
+        return self.message_cache.get_text(os.path.join(self.input_folder, self.files[self.current_index]))
 
     def show_next_message(self):
+        if self.server is not None:
+            self.lease_server_message()
+            return
         if self.current_index < len(self.files) - 1:
-            self.current_index += 1
-            while self.current_index < len(self.files) and self.files[self.current_index] in self.read_files:
-                self.current_index += 1
+            self.save_scheduler.flush(force=True)
+            # Skip read files; if none are left ahead, just step to the next one
+            next_unread = self.navigation.next_unread(self.current_index)
+            while next_unread is not None and self.leased_by_other(next_unread):
+                next_unread = self.navigation.next_unread(next_unread)
+            self.current_index = next_unread if next_unread is not None else self.current_index + 1
             self.show_message()
-            self.save_state()
+            self.request_save()
             self.status_bar.showMessage(f"Showing file {self.current_index + 1} of {len(self.files)}.", 5000)
             self.file_selector.setCurrentIndex(self.current_index)  # QComboBox'ı güncelleyin
 
 
     def show_prev_message(self):
+        if self.server is not None:
+            self.status_bar.showMessage("The server hands out one message at a time; there is no previous one.", 5000)
+            return
         if self.current_index > 0:
-            self.current_index -= 1
-            while self.current_index >= 0 and self.files[self.current_index] in self.read_files:
-                self.current_index -= 1
+            self.save_scheduler.flush(force=True)
+            prev_unread = self.navigation.prev_unread(self.current_index)
+            while prev_unread is not None and self.leased_by_other(prev_unread):
+                prev_unread = self.navigation.prev_unread(prev_unread)
+            self.current_index = prev_unread if prev_unread is not None else self.current_index - 1
             self.show_message()
-            self.save_state()
+            self.request_save()
             self.status_bar.showMessage(f"Showing file {self.current_index + 1} of {len(self.files)}.", 5000)
             self.file_selector.setCurrentIndex(self.current_index)  # QComboBox'ı güncelleyin
 
     def load_table_headers(self):
-        config_file = 'config.conf'
-        if os.path.exists(config_file):
-            with open(config_file, 'r') as file:
-                headers = file.read().strip().split(',')
-                self.headers = headers
-                self.create_table()
-                if not self.table_data:  # Add an initial empty row if table_data is empty
-                    self.add_table_row()
+        headers = read_headers('config.conf')
+        if headers is not None:
+            self.headers = headers
+            self.create_table()
+            if self.table_model.rowCount() == 0:  # Add an initial empty row if table is empty
+                self.add_table_row()
 
     def create_table(self):
-        self.table_layout.setSpacing(0)
-        self.table_layout.setContentsMargins(0, 0, 0, 0)
-
+        self.annotation_table.set_headers(self.headers)
         for col, header in enumerate(self.headers):
             if header.lower() == "offer type":
-                header_widget = QWidget()
-                header_layout = QHBoxLayout(header_widget)
-                header_layout.setContentsMargins(0, 0, 0, 0)
-                
-                header_label = QLabel(header)
-                header_label.setFont(QFont('Arial', 10, QFont.Bold))
-                header_layout.addWidget(header_label)
-                header_label.setStyleSheet("""
-                    background-color: #C8E6C9;  
-                    color: black;  
-                    padding: 10px;
-                    border: 1px solid #BDBDBD;  
-                    border-radius: 5px;
-                    text-align: center;
-                    margin: 0;  
-                """)
-
-                header_combo = QComboBox()
-                header_combo.addItems(["WTB", "WTS"])
-                header_combo.currentTextChanged.connect(lambda: self.update_all_offer_types(header_combo.currentText()))
-                header_layout.addWidget(header_combo)
-
-                self.table_layout.addWidget(header_widget, 0, col)
+                delegate = ComboBoxDelegate(self.offer_type_model, parent=self.table_view)
+            elif header.lower() in self.vocabulary_columns:
+                list_name = self.vocabulary_columns[header.lower()]
+                delegate = ComboBoxDelegate(self.vocabulary_models[list_name], editable=True,
+                                            on_commit=getattr(self, 'update_' + list_name),
+                                            index_getter=partial(self.get_completion_index, list_name),
+                                            parent=self.table_view)
             else:
-                header_label = QLabel(header)
-                header_label.setFont(QFont('Arial', 10, QFont.Bold))
-                header_label.setStyleSheet("""
-                    background-color: #C8E6C9;  
-                    color: black;  
-                    padding: 10px;
-                    border: 1px solid #BDBDBD;  
-                    border-radius: 5px;
-                    text-align: center;
-                    margin: 0;  
-                """)
-                header_label.setFixedHeight(40)
-                header_label.setFixedWidth(120)
-                header_label.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                self.table_layout.addWidget(header_label, 0, col)
-
-        self.table_data = []
-
-
-            
+                delegate = None
+            self.table_view.setItemDelegateForColumn(col, delegate)
+        self.table_view.setColumnWidth(len(self.headers), 60)  # Delete column
 
     def update_all_offer_types(self, selected_value):
-        for row in self.table_data:
-            for col, item in enumerate(row):
-                if self.headers[col].lower() == "offer type":
-                    item.setCurrentText(selected_value)
+        with self.history.group():
+            for col, header in enumerate(self.headers):
+                if header.lower() == "offer type":
+                    self.annotation_table.set_column(col, selected_value)
 
     def add_table_row(self):
-        row_position = len(self.table_data)
-        row_data = []
-
+        # New rows take the Offer Type of the first row
         current_offer_type = None
-        for row in self.table_data:
-            for col, item in enumerate(row):
-                if self.headers[col].lower() == "offer type":
-                    current_offer_type = item.currentText()
-                    break
-            if current_offer_type:
+        for col, header in enumerate(self.headers):
+            if header.lower() == "offer type" and self.annotation_table.rows:
+                current_offer_type = self.annotation_table.rows[0][col]
                 break
 
-        if current_offer_type is None:
+        if not current_offer_type:
             current_offer_type = "WTB"
 
-        for col in range(len(self.headers)):
-            color = "#FFFFFF" if row_position % 2 == 0 else "#F9F9F9"
-            if self.headers[col].lower() == "offer type":
-                combo_box = QComboBox()
-                combo_box.setFont(QFont('Arial', 10))
-                combo_box.addItems(["WTB", "WTS"])
-                combo_box.setCurrentText(current_offer_type)
-                combo_box.setFixedHeight(40)
-                combo_box.setFixedWidth(120)
-                combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                combo_box.setStyleSheet(f"""
-                    padding: 0px;
-                    margin: 0px;
-                    border: 1px solid #BDBDBD;
-                    background-color: {color};
-                """)
-                combo_box.installEventFilter(self)
-                self.table_layout.addWidget(combo_box, row_position + 1, col)
-                row_data.append(combo_box)
-            elif self.headers[col].lower() == "product name":
-                combo_box = QComboBox()
-                combo_box.setFont(QFont('Arial', 10))
-                combo_box.addItems(self.product_name_list)
-                combo_box.setEditable(True)
-                combo_box.setFixedHeight(40)
-                combo_box.setFixedWidth(120)
-                combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                combo_box.setStyleSheet(f"""
-                    padding: 0px;
-                    border: 1px solid #BDBDBD;
-                    margin: 0px;
-                    background-color: {color};
-                """)
-                combo_box.installEventFilter(self)
-                completer = QCompleter(self.product_name_list, self)
-                combo_box.setCompleter(completer)
-                combo_box.lineEdit().editingFinished.connect(self.update_product_name_list)
-                self.table_layout.addWidget(combo_box, row_position + 1, col)
-                row_data.append(combo_box)
-            elif self.headers[col].lower() == "brand":
-                combo_box = QComboBox()
-                combo_box.setFont(QFont('Arial', 10))
-                combo_box.addItems(self.brand_list)
-                combo_box.setEditable(True)
-                combo_box.setFixedHeight(40)
-                combo_box.setFixedWidth(120)
-                combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                combo_box.setStyleSheet(f"""
-                    padding: 0px;
-                    border: 1px solid #BDBDBD;
-                    margin: 0px;
-                    background-color: {color};
-                """)
-                combo_box.installEventFilter(self)
-                completer = QCompleter(self.brand_list, self)
-                combo_box.setCompleter(completer)
-                combo_box.lineEdit().editingFinished.connect(self.update_brand_list)
-                self.table_layout.addWidget(combo_box, row_position + 1, col)
-                row_data.append(combo_box)
-            elif self.headers[col].lower() == "category":
-                combo_box = QComboBox()
-                combo_box.setFont(QFont('Arial', 10))
-                combo_box.addItems(self.category_list)
-                combo_box.setEditable(True)
-                combo_box.setFixedHeight(40)
-                combo_box.setFixedWidth(120)
-                combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                combo_box.setStyleSheet(f"""
-                    padding: 0px;
-                    border: 1px solid #BDBDBD;
-                    margin: 0px;
-                    background-color: {color};
-                """)
-                combo_box.installEventFilter(self)
-                completer = QCompleter(self.category_list, self)
-                combo_box.setCompleter(completer)
-                combo_box.lineEdit().editingFinished.connect(self.update_category_list)
-                self.table_layout.addWidget(combo_box, row_position + 1, col)
-                row_data.append(combo_box)
-            elif self.headers[col].lower() == "color":
-                combo_box = QComboBox()
-                combo_box.setFont(QFont('Arial', 10))
-                combo_box.addItems(self.color_list)
-                combo_box.setEditable(True)
-                combo_box.setFixedHeight(40)
-                combo_box.setFixedWidth(120)
-                combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                combo_box.setStyleSheet(f"""
-                    padding: 0px;
-                    border: 1px solid #BDBDBD;
-                    margin: 0px;
-                    background-color: {color};
-                """)
-                combo_box.installEventFilter(self)
-                completer = QCompleter(self.color_list, self)
-                combo_box.setCompleter(completer)
-                combo_box.lineEdit().editingFinished.connect(self.update_color_list)
-                self.table_layout.addWidget(combo_box, row_position + 1, col)
-                row_data.append(combo_box)
-            else:
-                line_edit = QLineEdit()
-                line_edit.setFont(QFont('Arial', 10))
-                line_edit.setFixedHeight(40)
-                line_edit.setFixedWidth(120)
-                line_edit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                line_edit.setStyleSheet(f"""
-                    padding: 0px;
-                    border: 1px solid #BDBDBD;
-                    margin: 0px;
-                    background-color: {color};
-                """)
-                line_edit.installEventFilter(self)
-                self.table_layout.addWidget(line_edit, row_position + 1, col)
-                row_data.append(line_edit)
-
-        delete_button = QPushButton()
-        delete_button.setIcon(QIcon('icons/delete_icon.png'))
-        delete_button.setIconSize(QSize(40, 40))
-        delete_button.setFixedSize(60, 60)
-        delete_button.setStyleSheet("""
-            border: 1px solid #BDBDBD;
-            margin: 0;
-            border-radius: 5px;
-        """)
-        delete_button.clicked.connect(partial(self.delete_table_row, row_position))
-        self.table_layout.addWidget(delete_button, row_position + 1, len(self.headers))
-
-        self.table_data.append(row_data)
-        self.update_delete_buttons()
-        self.save_state()
+        row_data = [current_offer_type if header.lower() == "offer type" else "" for header in self.headers]
+        self.annotation_table.append_row(row_data)
+        self.request_save()
         self.status_bar.showMessage("Row added.", 5000)
 
 
 
-
-
-
-
-    def update_product_name_list(self):
-        sender = self.sender()
-        if isinstance(sender, QLineEdit):
-            text = sender.text()
-            if text and text not in self.product_name_list:
-                self.product_name_list.append(text)
-                for row in self.table_data:
-                    for col, item in enumerate(row):
-                        if self.headers[col].lower() == "product name":
-                            completer = QCompleter(self.product_name_list, self)
-                            item.setCompleter(completer)
-
-
-    def update_offer_type(self, combo_box):
-        selected_value = combo_box.currentText()
-        for row in self.table_data:
-            for col, item in enumerate(row):
-                if self.headers[col].lower() == "offer type":
-                    item.setCurrentText(selected_value)
-
     def delete_table_row(self, row):
-        if 0 <= row < len(self.table_data):
-            # Remove all widgets in this row from the layout and delete them
-            for col in range(len(self.headers) + 1):  # Include the delete button column
-                item = self.table_layout.itemAtPosition(row + 1, col)
-                if item is not None:
-                    widget = item.widget()
-                    if widget:
-                        self.table_layout.removeWidget(widget)
-                        widget.deleteLater()
-
-            # Remove the row data from the list
-            self.table_data.pop(row)
-
-            # Move up all widgets in rows below the deleted row
-            for subsequent_row in range(row, len(self.table_data)):
-                for col in range(len(self.headers) + 1):
-                    item = self.table_layout.itemAtPosition(subsequent_row + 2, col)  # original position
-                    if item is not None:
-                        widget = item.widget()
-                        if widget:
-                            self.table_layout.removeWidget(widget)
-                            self.table_layout.addWidget(widget, subsequent_row + 1, col)
-
-            self.update_delete_buttons()
-            self.save_state()
+        if self.annotation_table.remove_row(row):
+            self.request_save()
             self.status_bar.showMessage("Row deleted.", 5000)
 
-    def update_delete_buttons(self):
-        for i in range(len(self.table_data)):
-            item = self.table_layout.itemAtPosition(i + 1, len(self.headers))
-            if item is not None:
-                delete_button = item.widget()
-                if delete_button:
-                    delete_button.clicked.disconnect()
-                    delete_button.clicked.connect(partial(self.delete_table_row, i))
-
-
+    def on_table_clicked(self, index):
+        if index.column() == len(self.headers) and self.lease_holder is None:  # Delete icon column
+            self.delete_table_row(index.row())
 
     def save_table(self):
-        table_data = self.get_table_data()
-        headers = self.headers
-
-        # Ensure each row has the correct number of columns
-        formatted_table_data = []
-        for row in table_data:
-            if len(row) == len(headers):
-                formatted_table_data.append({headers[i]: row[i] for i in range(len(headers))})
-            else:
-                print(f"Skipping row due to length mismatch: {row}")
-
-        export_data = {
-            "table_data": formatted_table_data
-        }
+        export_data = table_export(self.get_table_data(), self.headers)
 
         if self.output_folder:
-            file_path = os.path.join(self.output_folder, f"{os.path.splitext(self.files[self.current_index])[0]}.json")
-            with open(file_path, 'w', encoding='utf-8') as file:
-                json.dump(export_data, file, indent=4, ensure_ascii=False)
+            file_path = os.path.join(self.output_folder, export_names(self.files[self.current_index])[0])
+            self.writer.submit_json(file_path, export_data)
             self.status_bar.showMessage("Table saved successfully.", 5000)
         else:
             self.status_bar.showMessage("No output folder selected.", 5000)
 
 
+    def request_save(self):
+        # Mark the state dirty; SaveScheduler merges bursts into one write
+        if self.initial_load_done:
+            self.save_scheduler.mark_dirty()
+
+    def save_now(self):
+        self.save_scheduler.flush(force=True)
+        self.status_bar.showMessage("State saved.", 5000)
+
+    def write_json_if_changed(self, path, data, encoding='utf-8'):
+        # data is an immutable snapshot; skip it when it matches the last one
+        if self.last_saved.get(path) == data:
+            return False
+        self.writer.submit_json(path, data, encoding=encoding)
+        self.message_cache.invalidate(path)
+        self.last_saved[path] = data
+        return True
+
+    def on_write_failed(self, path, job, error):
+        kind, data, encoding = job
+        if kind == 'call':
+            self.status_bar.showMessage(f"Error: {error}", 10000)
+            return
+        if kind == 'json' and self.last_saved.get(path) is data:
+            # Not on disk, so it must not count as saved; unless a later save replaces it
+            del self.last_saved[path]
+            self.failed_writes[path] = (data, encoding)
+        elif kind == 'merge' and path == self.line_memory.path:
+            self.line_memory.dirty = True
+        self.status_bar.showMessage(f"Could not save {os.path.basename(path)}: {error}. "
+                                    f"It is tried again with the next save.", 15000)
+
+    def retry_failed_writes(self):
+        failed, self.failed_writes = self.failed_writes, {}
+        for path, (data, encoding) in failed.items():
+            if path not in self.last_saved:
+                self.write_json_if_changed(path, data, encoding=encoding)
+
+    def around_write(self, path):
+        # I/O thread: sidecars saved here are noted in the manifest, so they cost no rescan
+        manifest = self.manifest
+        folder, name = os.path.split(os.path.abspath(path))
+        if manifest is not None and folder == manifest.folder and name.endswith('.txt.json'):
+            return manifest.own_write(name[:-len('.json')])
+        return nullcontext()
+
+    def read_sidecar(self, path):
+        self.writer.wait(path)  # Never read behind a queued write
+        return self.message_cache.get_sidecar(path)
+
+    def prefetch_neighbours(self, count=3):
+        # Warm the files Next/Prev (and the unread jumps) are likely to open
+        positions = []
+        for offset in range(1, count + 1):
+            positions += [self.current_index + offset, self.current_index - offset]
+        position = self.current_index
+        for _ in range(count):
+            position = self.navigation.next_unread(position)
+            if position is None:
+                break
+            positions.append(position)
+        self.prefetcher.request([os.path.join(self.input_folder, self.files[i])
+                                 for i in dict.fromkeys(positions) if 0 <= i < len(self.files)])
+
+    @timed('save_state')
     def save_state(self):
         if self.initial_load_done:  # Only save state if the initial load is done
+            self.retry_failed_writes()  # Including sidecars of messages left since
             state = {
                 'current_index': self.current_index,
                 'table_data': self.get_table_data(),
                 'input_folder': self.input_folder,
                 'output_folder': self.output_folder,
-                'files': self.files,
-                'folder_indices': self.folder_indices,  # Add folder_indices to save state
-                'product_name_list': self.product_name_list,  # Save product name list
-                'brand_list': self.brand_list,  # Save brand list
-                'category_list': self.category_list,  # Save category list
-                'color_list': self.color_list,  # Save color list
-                'read_files': self.read_files,  # Save read files list
+                'files': list(self.files),
+                'folder_indices': dict(self.folder_indices),  # Add folder_indices to save state
+                'read_files': list(self.navigation.read_paths),  # Save read files list
                 'processed_text': self.processed_text.toPlainText()  # Save processed text regardless of view mode
             }
-            print("Saving state:", state)  # Debug print
-            with open('state.json', 'w') as file:
-                json.dump(state, file, ensure_ascii=False, indent=4)
+            written = self.write_json_if_changed(self.state_path, state, encoding=None)
 
             # Save table data for the current file
-            self.save_table_data_for_current_file()
-            self.status_bar.showMessage("State saved.", 5000)
-
-
-
-
-
-
+            written = self.save_table_data_for_current_file() or written
+            if written:
+                coalesced = self.save_scheduler.coalesced
+                self.status_bar.showMessage(f"State saved ({coalesced} writes coalesced).", 5000)
+            return written
+        return False
 
 
     def save_table_data_for_current_file(self):
-        if 0 <= self.current_index < len(self.files):
+        if self.server is not None:
+            return self.submit_to_server()
+        # A message leased by someone else is theirs to write
+        if 0 <= self.current_index < len(self.files) and self.lease_holder is None:
             current_file = self.files[self.current_index]
             file_path = os.path.join(self.input_folder, current_file)
             table_data = self.get_table_data()
             table_data_path = file_path + '.json'
-            with open(table_data_path, 'w', encoding='utf-8') as file:
-                json.dump({'table_data': table_data, 'processed_text': self.processed_text.toPlainText()}, file, ensure_ascii=False, indent=4)
+            data = {'table_data': table_data, 'processed_text': self.processed_text.toPlainText()}
+            written = self.write_json_if_changed(table_data_path, data)
+            if written:
+                if self.search_index is None:
+                    self.search_stale.add(current_file)
+                content = self.message_cache.get_text(file_path) or ''
+                # Unreviewed proposals are not worth remembering
+                self.queue_saved_message(current_file, content, data, bool(content) and table_data != self.proposed_rows)
+            return written
+        return False
+
+    def lease_server_message(self):
+        # Server mode: hand the message on screen back as done, then lease the next one
+        previous, self.server_message = self.server_message, None  # Nothing is submitted while switching
+        self.save_scheduler.flush(force=True)
+        self.next_button.setEnabled(False)
+        if previous is None:
+            self.run_in_background(call_server, self.on_server_message, self.server.lease)
+            return
+        data = (self.get_table_data(), self.processed_text.toPlainText())
+        if self.proposed_rows is not None and data == (self.proposed_rows, previous['processed_text']):
+            data = (None, '')  # Unedited proposals: hand it back read, not annotated
+        self.run_in_background(call_server, partial(self.on_handed_back, previous, data),
+                               self.server.hand_back, previous['lease'], *data)
+
+    def on_handed_back(self, previous, data, result):
+        refused, error = result
+        if error is not None:
+            self.server_message = previous  # The lease is still good; Next can be tried again
+            self.next_button.setEnabled(True)
+            self.status_bar.showMessage(f"Server: {error}", 10000)
+            return
+        if refused is not None and data[0] is not None:
+            # The lease was gone (e.g. expired during a sleep): the table is kept for the next message
+            self.refused_table = (previous['name'], data, refused)
+        self.run_in_background(call_server, self.on_server_message, self.server.lease)
+
+    def on_server_message(self, result):
+        message, error = result
+        self.next_button.setEnabled(True)
+        refused = None
+        if error is None and self.refused_table is not None:
+            refused, self.refused_table = self.refused_table, None
+            name, (table_data, processed_text), reason = refused
+            if message is not None and message['name'] == name:
+                # Leased again (an expired lease puts its message first in line): the edits carry over
+                message = dict(message, table_data=table_data, processed_text=processed_text)
+            else:
+                lines = ['\t'.join(self.headers)] + ['\t'.join(row) for row in table_data]
+                QApplication.clipboard().setText('\n'.join(lines) + (f"\n\n{processed_text}" if processed_text else ''))
+        # The message handed back is not ours any more, so it leaves the screen even on an error
+        self.server_message = message
+        self.server_submitted = (message['table_data'], message['processed_text']) if message else None
+        self.proposed_rows = None
+        self.message_text.setText(message['text'] if message else '')
+        self.file_path_label.setText(f"Current File: {message['name']} ({self.server.url})" if message else '')
+        if message is not None:
+            self.lease_timer.start(message['ttl'] * 1000 // 3)
+        else:
+            self.lease_timer.stop()
+        with self.history.paused():
+            self.processed_text.setText(message['processed_text'] if message else '')
+            if message is not None and not message['table_data']:
+                self.show_proposals()
+            else:
+                self.set_table_data(message['table_data'] if message else [])
+            if self.table_model.rowCount() == 0:
+                self.add_table_row()
+        self.history.clear()
+        if error is not None:
+            self.status_bar.showMessage(f"Server: {error}; press Next to try again.", 10000)
+        elif refused is not None and message is not None and message['name'] == refused[0]:
+            self.server_submitted = None  # Not on the server yet: submitted again now
+            self.submit_to_server()
+            self.status_bar.showMessage(f"{refused[0]} was not accepted ({refused[2]}); it was leased again "
+                                        f"with your table, which is now submitted.", 10000)
+        elif refused is not None:
+            self.status_bar.showMessage(f"{refused[0]} was not accepted ({refused[2]}); its table was copied "
+                                        f"to the clipboard.", 15000)
+        elif message is not None:
+            self.status_bar.showMessage(f"Leased {message['name']} from the server.", 5000)
+        else:
+            self.status_bar.showMessage("No unannotated messages left on the server.", 10000)
+
+    def submit_to_server(self):
+        if self.server_message is None:
+            return False
+        data = (self.get_table_data(), self.processed_text.toPlainText())
+        if data == self.server_submitted:
+            return False
+        self.server_submitted = data
+        self.queue_saved_message(self.server_message['name'], self.server_message['text'],
+                                 {'table_data': data[0], 'processed_text': data[1]}, data[0] != self.proposed_rows)
+        self.run_in_background(call_server, self.on_server_reply, self.server.submit, self.server_message['lease'], *data)
+        return True
+
+    def on_server_reply(self, result):
+        _, error = result
+        if error is not None:
+            self.status_bar.showMessage(f"Server: {error}", 10000)
+
+    def on_server_vocabulary(self, result):
+        vocabulary, error = result
+        if error is not None:
+            self.status_bar.showMessage(f"Server: {error}", 10000)
+            return
+        if self.merge_vocabulary({list_name: vocabulary.get(key, [])
+                                  for list_name, key in self.vocabulary_file_keys.items()}):
+            self.sync_vocabulary_models()
+            self.warm_vocabulary()
+
+    def claim_current_message(self):
+        # Lease the message on screen and release the one left behind; a
+        # message leased by another annotator opens read-only
+        name = self.files[self.current_index] if 0 <= self.current_index < len(self.files) else None
+        if self.leases is not None and self.leases.folder != self.input_folder:
+            self.release_leases()
+        if self.leases is None and name is not None:
+            self.leases = LeaseManager(self.input_folder)
+            self.lease_timer.start(self.leases.ttl * 1000 // 3)
+        holder = None
+        if self.leases is not None:
+            for other in list(self.leases.held):
+                if other != name and self.leases.leave(other):
+                    # Released on the I/O thread once the last save of that message is on disk
+                    self.writer.submit_call(partial(self.leases.release_left, other))
+            if name is not None:
+                try:
+                    holder = self.leases.acquire(name)
+                except OSError as e:
+                    print(f"Leases unavailable in {self.input_folder}: {e}")
+        self.set_lease_holder(holder)
+
+    def release_leases(self):
+        self.writer.flush()
+        self.leases.release_all()
+        self.leases = None
+        self.lease_timer.stop()
+
+    def set_lease_holder(self, holder):
+        self.lease_holder = holder
+        editable = holder is None
+        self.table_view.setEditTriggers(QAbstractItemView.AllEditTriggers if editable else QAbstractItemView.NoEditTriggers)
+        self.processed_text.setReadOnly(not editable)
+        for widget in (self.add_row_button, self.offer_type_combo, self.undo_button, self.redo_button):
+            widget.setEnabled(editable)
+        if editable:
+            self.update_undo_buttons()
+        else:
+            self.copy_rows_button.setEnabled(False)
+            self.status_bar.showMessage(f"{self.files[self.current_index]} is being annotated by {holder}; "
+                                        f"opened read-only.", 10000)
+
+    def leased_by_other(self, position):
+        if self.leases is None:
+            return False
+        try:
+            return self.leases.holder(self.files[position]) is not None
+        except OSError:
+            return False
+
+    def renew_leases(self):
+        if self.server is not None:
+            if self.server_message is not None:
+                self.run_in_background(call_server, self.on_server_reply, self.server.renew, self.server_message['lease'])
+            return
+        if self.leases is None:
+            return
+        try:
+            lost = self.leases.renew()
+        except OSError as e:
+            print(f"Error renewing leases: {e}")
+            return
+        if 0 <= self.current_index < len(self.files) and self.files[self.current_index] in lost:
+            # Expired (e.g. after a sleep) and taken over: the other annotator's edits win
+            self.set_lease_holder(self.leases.holder(self.files[self.current_index]) or 'another annotator')
+
+    def on_duplicates_ready(self, folder, index):
+        if index is None or folder != self.input_folder:
+            return
+        self.duplicate_index = index
+        self.update_duplicates()
+
+    def update_duplicates(self):
+        # Annotated duplicates first: those are the ones worth copying from
+        self.duplicate_selector.clear()
+        self.duplicate_names = []
+        if self.duplicate_index is not None and 0 <= self.current_index < len(self.files):
+            duplicates = self.duplicate_index.duplicates(self.files[self.current_index])
+            annotated = {name for _, name in duplicates if self.manifest is not None and self.manifest.is_annotated(name)}
+            for score, name in sorted(duplicates, key=lambda item: item[1] not in annotated):
+                self.duplicate_names.append(name)
+                self.duplicate_selector.addItem(f"{name} ({score:.0%}{', annotated' if name in annotated else ''})")
+        if not self.duplicate_names:
+            self.duplicate_selector.addItem("None found" if self.duplicate_index is not None else "Searching...")
+        self.duplicate_selector.setEnabled(bool(self.duplicate_names))
+        self.copy_rows_button.setEnabled(bool(self.duplicate_names) and self.lease_holder is None)
+
+    def copy_duplicate_rows(self):
+        row = self.duplicate_selector.currentIndex()
+        if not 0 <= row < len(self.duplicate_names):
+            return
+        name = self.duplicate_names[row]
+        self.save_scheduler.flush(force=True)  # The duplicate may be a file edited moments ago
+        sidecar = self.read_sidecar(os.path.join(self.input_folder, name) + '.json')
+        if sidecar is None or not sidecar[0]:
+            self.status_bar.showMessage(f"{name} has no table rows to copy.", 5000)
+            return
+        with self.history.group():  # An edit, unlike set_table_data(): one undo step
+            self.annotation_table.set_rows(sidecar[0])
+        self.request_save()
+        self.status_bar.showMessage(f"Copied {len(sidecar[0])} rows from {name}.", 5000)
+
+    def build_search_index(self):
+        if self.input_folder:
+            folder = self.input_folder
+            self.run_in_background(build_index, partial(self.on_search_index_ready, folder), folder)
+
+    def on_search_index_ready(self, folder, index):
+        if index is None or folder != self.input_folder:
+            return
+        # Sidecars saved during the build may have been read before their write
+        for name in self.search_stale:
+            path = os.path.join(folder, name)
+            self.writer.wait(path + '.json')
+            try:
+                index.index_file(name)
+            except (OSError, ValueError) as e:
+                print(f"Error indexing {name}: {e}")
+        self.search_stale.clear()
+        self.search_index = index
+        self.status_bar.showMessage(f"Search index ready ({len(index)} messages).", 5000)
+
+    def on_documents_read(self, index, documents):
+        if index is not self.search_index:
+            return
+        for name, key, terms in documents:
+            if name in self.manifest.messages:  # Not removed while it was read
+                index.add_document(name, terms, key)
+
+    def queue_saved_message(self, name, text, data, learn):
+        # Re-index a saved message from memory instead of re-reading it, and learn its
+        # rows (learn), a little later and off the GUI thread
+        self.saved_messages[name] = (name, text, data['table_data'], data['processed_text'], learn)
+        if not self.digest_timer.isActive():
+            self.digest_timer.start(2000)
+
+    def digest_saved(self, wait=False):
+        # wait: on the GUI thread, now (closing, or leaving the folder)
+        self.digest_timer.stop()
+        if not self.saved_messages:
+            return
+        messages = list(self.saved_messages.values())
+        self.saved_messages.clear()
+        self.digest_passes += 1
+        for name, *_ in messages:
+            self.saved_sequence[name] = self.digest_passes
+        callback = partial(self.on_saved_digested, self.search_index, self.digest_passes)
+        if wait:
+            callback(digest_saved_messages(messages, self.headers))
+        else:
+            self.run_in_background(digest_saved_messages, callback, messages, self.headers)
+
+    def on_saved_digested(self, index, sequence, results):
+        for name, terms, placed in results:
+            if self.saved_sequence.get(name) != sequence:
+                continue  # A later save of it is on its way
+            del self.saved_sequence[name]
+            if index is not None:
+                index.add_document(name, terms)
+            self.line_memory.update(placed)
+
+    def run_search(self):
+        query = self.search_box.text().strip()
+        if not query:
+            self.search_hits = []
+            self.search_results_model.setStringList([])
+            return
+        if self.search_index is None:
+            self.status_bar.showMessage("Search index is still being built...", 5000)
+            return
+        start = time.perf_counter()
+        self.search_hits = self.search_index.search(query)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.search_results_model.setStringList(self.search_hits)
+        self.status_bar.showMessage(f"{len(self.search_hits)} hits in {elapsed:.1f} ms.", 5000)
+        if self.search_hits:
+            self.search_results.setCurrentIndex(0)
+            self.open_search_result(0)
+
+    def open_search_result(self, row):
+        if 0 <= row < len(self.search_hits):
+            name = self.search_hits[row]
+            position = bisect_left(self.files, name)
+            if position < len(self.files) and self.files[position] == name:
+                self.file_selector.setCurrentIndex(position)  # Navigates through go_to_selected_file
 
 
 
 
     def load_external_data(self):
         try:
-            with open('brand_category_color.json', 'r') as file:
+            with open(self.vocabulary_path, 'r') as file:
                 data = json.load(file)
                 self.product_name_list = data.get('product_names', [])
                 self.brand_list = data.get('brands', [])
@@ -1049,160 +1832,69 @@ class MessageTool(QMainWindow):
 
 
     def load_state(self):
+        # Only reads the annotator's state file; the saved folder is scanned, and
+        # its current file and table shown, by finish_startup() after the first paint
         self.load_external_data()  # Load external data first
-        if os.path.exists('state.json'):
-            with open('state.json', 'r') as file:
+        state_path = user_state_path(self.annotator, existing=True)  # Or the state.json of older versions
+        if os.path.exists(state_path):
+            with open(state_path, 'r') as file:
                 state = json.load(file)
-                print("Loaded state:", state)  # Debug print
                 self.current_index = state.get('current_index', -1)
                 self.input_folder = state.get('input_folder', '')
                 self.output_folder = state.get('output_folder', '')
-                self.files = state.get('files', [])
                 self.folder_indices = state.get('folder_indices', {})  # Load folder_indices
-                self.product_name_list = state.get('product_name_list', [])
-                self.brand_list = state.get('brand_list', [])  # Load brand list
-                self.category_list = state.get('category_list', [])  # Load category list
-                self.color_list = state.get('color_list', [])  # Load color list
-                self.read_files = state.get('read_files', [])  # Load read files list
-                processed_text = state.get('processed_text', '')  # Load processed text
-
-                # Load table headers
-                self.load_table_headers()
-
-                # Set table data
-                self.set_table_data(state.get('table_data', []))
-
-                if self.input_folder:
-                    self.load_files()  # Load files after setting the state
-
-                self.processed_text.setText(processed_text)  # Load the processed text
-                
-                # Set the file selector to the current index
-                if 0 <= self.current_index < len(self.files):
-                    self.file_selector.setCurrentIndex(self.current_index)
-                    self.show_message()
+                # The shared vocabulary file is authoritative; older state files
+                # kept their own copy, whose extra terms are merged into it
+                if self.merge_vocabulary({list_name: state.get(list_name, [])
+                                          for list_name in self.vocabulary_columns.values()}):
+                    self.save_external_data()
+                self.navigation = NavigationIndex(state.get('read_files', []))  # Load read files list
+
+                if not self.input_folder:
+                    # Without a folder, the saved table is all there is to show
+                    self.set_table_data(state.get('table_data', []))
+                    self.processed_text.setText(state.get('processed_text', ''))
 
             self.start_auto_save()  # Start auto save after loading state
+        self.sync_vocabulary_models()
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_paint_ms is None:
+            now = time.perf_counter()
+            self.first_paint_ms = (now - self.startup_started) * 1000
+            if metrics.enabled:
+                metrics.record('startup.first_paint', self.startup_started, now - self.startup_started)
+            QTimer.singleShot(0, self.finish_startup)
+
+    def finish_startup(self):
+        if self.startup_finished:
+            return
+        self.startup_finished = True
+        if self.server is not None:
+            # Messages come from the server; no folder is scanned
+            self.run_in_background(call_server, self.on_server_vocabulary, self.server.vocabulary)
+            self.lease_server_message()
+        elif self.input_folder:
+            # The scan restores the saved position once the file list is complete
+            self.load_files(target_index=self.current_index if self.current_index >= 0 else None)
+        self.warm_vocabulary()
 
 
 
     def get_table_data(self):
-        data = []
-        for row_data in self.table_data:
-            row = []
-            for item in row_data:
-                if isinstance(item, QComboBox):
-                    row.append(item.currentText())
-                elif isinstance(item, QLineEdit):
-                    row.append(item.text())
-            data.append(row)
-        return data
-
+        return self.annotation_table.snapshot()
 
+    @timed('set_table_data')
     def set_table_data(self, data):
-        # Clear existing table data
-        for i in reversed(range(len(self.table_data))):
-            self.delete_table_row(i)
-
-        self.table_data = []
-        num_headers = len(self.headers)  # Number of headers
-
-        for row_position, row_data in enumerate(data):
-            # Ensure row_data has the same length as headers by truncating extra columns
-            row_data = row_data[:num_headers]
-            # Ensure row_data has the same length as headers by padding with empty strings
-            row_data += [""] * (num_headers - len(row_data))
-
-            row = []
-            for col in range(num_headers):
-                value = row_data[col]
-
-                if self.headers[col].lower() == "offer type":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(["WTB", "WTS"])
-                    combo_box.setCurrentText(value)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "product name":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.product_name_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.product_name_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_product_name_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "brand":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.brand_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.brand_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_brand_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "category":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.category_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.category_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_category_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                elif self.headers[col].lower() == "color":
-                    combo_box = QComboBox()
-                    combo_box.setFont(QFont('Arial', 10))
-                    combo_box.addItems(self.color_list)
-                    combo_box.setCurrentText(value)
-                    combo_box.setEditable(True)
-                    combo_box.setFixedHeight(40)
-                    combo_box.setFixedWidth(120)
-                    combo_box.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    combo_box.installEventFilter(self)
-                    completer = QCompleter(self.color_list, self)
-                    combo_box.setCompleter(completer)
-                    combo_box.lineEdit().editingFinished.connect(self.update_color_list)
-                    self.table_layout.addWidget(combo_box, row_position + 1, col)
-                    row.append(combo_box)
-                else:
-                    line_edit = QLineEdit()
-                    line_edit.setFont(QFont('Arial', 10))
-                    line_edit.setText(value)
-                    line_edit.setFixedHeight(40)
-                    line_edit.setFixedWidth(120)
-                    line_edit.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-                    line_edit.installEventFilter(self)
-                    self.table_layout.addWidget(line_edit, row_position + 1, col)
-                    row.append(line_edit)
-
-            delete_button = self.create_icon_button('icons/delete_icon.png', partial(self.delete_table_row, row_position), size=40)
-            self.table_layout.addWidget(delete_button, row_position + 1, len(self.headers))
-
-            self.table_data.append(row)
+        # Rows are fitted to the headers (truncated or padded) as they are copied in.
+        # The rows come from storage, so this is not an edit and ends the history
+        with self.history.paused():
+            self.annotation_table.set_rows(data)
+        self.history.clear()
+        # The view is not reset, so start the new table at the top without a selection
+        self.table_view.clearSelection()
+        self.table_view.scrollToTop()
         self.status_bar.showMessage("State loaded.", 5000)
 
 
@@ -1210,95 +1902,218 @@ class MessageTool(QMainWindow):
     def save_external_data(self):
         try:
             data = {
-                'brands': self.brand_list,
-                'categories': self.category_list,
-                'colors': self.color_list,
-                'product_names': self.product_name_list
+                'brands': list(self.brand_list),
+                'categories': list(self.category_list),
+                'colors': list(self.color_list),
+                'product_names': list(self.product_name_list)
             }
-            with open('brand_category_color.json', 'w') as file:
-                json.dump(data, file, indent=4)
-            print("External data saved.")
+            # Merged with what other annotators added since it was read
+            self.writer.submit_merge_json(self.vocabulary_path, data, encoding=None)
         except Exception as e:
             print(f"Error saving external data: {e}")
             
-    def update_product_name_list(self):
-        sender = self.sender()
-        if isinstance(sender, QLineEdit):
-            text = sender.text()
-            if text and text not in self.product_name_list:
-                self.product_name_list.append(text)
-                self.save_external_data()
-                self.save_state()
-                # Update all existing combo boxes for product name
-                for row in self.table_data:
-                    for col, item in enumerate(row):
-                        if self.headers[col].lower() == "product name" and isinstance(item, QComboBox):
-                            item.addItem(text)
-
-    def update_brand_list(self):
-        sender = self.sender()
-        if isinstance(sender, QLineEdit):
-            text = sender.text()
-            if text and text not in self.brand_list:
-                self.brand_list.append(text)
-                self.save_external_data() 
-                self.save_state()
-                # Update all existing combo boxes for brand_list
-                for row in self.table_data:
-                    for col, item in enumerate(row):
-                        if self.headers[col].lower() == "brand_list" and isinstance(item, QComboBox):
-                            item.addItem(text)
-
-    def update_category_list(self):
-        sender = self.sender()
-        if isinstance(sender, QLineEdit):
-            text = sender.text()
-            if text and text not in self.category_list:
-                self.category_list.append(text)
-                self.save_external_data()
-                self.save_state()
-                # Update all existing combo boxes for category_list
-                for row in self.table_data:
-                    for col, item in enumerate(row):
-                        if self.headers[col].lower() == "category_list" and isinstance(item, QComboBox):
-                            item.addItem(text)
-
-    def update_color_list(self):
-        sender = self.sender()
-        if isinstance(sender, QLineEdit):
-            text = sender.text()
-            if text and text not in self.color_list:
-                self.color_list.append(text)
-                self.save_external_data()
-                self.save_state()
-                # Update all existing combo boxes for color_list
-                for row in self.table_data:
-                    for col, item in enumerate(row):
-                        if self.headers[col].lower() == "color_list" and isinstance(item, QComboBox):
-                            item.addItem(text)
-
-
-    def eventFilter(self, source, event):
-        if event.type() == QEvent.FocusIn:
-            if isinstance(source, QLineEdit) or isinstance(source, QComboBox):
-                source.setStyleSheet("""
-                    padding: 5px;
-                    border: 2px solid #4A90E2;
-                    border-radius: 2px;
-                    text-align: center;
-                    margin: 0;
-                """)
-        elif event.type() == QEvent.FocusOut:
-            if isinstance(source, QLineEdit) or isinstance(source, QComboBox):
-                source.setStyleSheet("""
-                    padding: 5px;
-                    border: 1px solid #BDBDBD;
-                    border-radius: 2px;
-                    text-align: center;
-                    margin: 0;
-                """)
-        return super(MessageTool, self).eventFilter(source, event)
-
+    def add_vocabulary_term(self, list_name, text):
+        if not text:
+            return
+        index = self.get_completion_index(list_name)
+        if text in index:
+            index.bump(text)  # Used once more, rank it higher
+            return
+        getattr(self, list_name).append(text)
+        index.add(text, count=1)
+        if self.gazetteer is not None and list_name in self.gazetteer_lists:
+            self.gazetteer.add_term(self.vocabulary_label(list_name), text)
+            if self.gazetteer.recent_terms() > self.gazetteer_recent_limit:
+                self.build_gazetteer()  # Matching the recent terms apart gets slower as they grow
+        # Appending to the shared model updates every editor at once
+        model = self.vocabulary_models[list_name]
+        row = model.rowCount()
+        model.insertRows(row, 1)
+        model.setData(model.index(row), text)
+        self.save_external_data()
+        if self.server is not None:
+            self.run_in_background(call_server, self.on_server_reply, self.server.add_terms,
+                                   {self.vocabulary_file_keys[list_name]: [text]})
+        self.request_save()
+
+    def merge_vocabulary(self, terms_by_list):
+        # Append the terms not known yet (list name -> terms); returns whether there were any
+        added = False
+        for list_name, new_terms in terms_by_list.items():
+            terms = getattr(self, list_name)
+            known = set(terms)
+            extra = [term for term in dict.fromkeys(new_terms) if term not in known]
+            terms += extra
+            added = added or bool(extra)
+        return added
+
+    def sync_vocabulary_models(self):
+        # Call after the vocabulary lists are replaced wholesale
+        for list_name, model in self.vocabulary_models.items():
+            model.setStringList(getattr(self, list_name))
+        # Indexes and gazetteer are rebuilt from the new lists when next needed
+        self.vocabulary_generation += 1
+        self.completion_indexes = {}
+        self.gazetteer = None
+        self.gazetteer_pending = False
+
+    def get_completion_index(self, list_name):
+        index = self.completion_indexes.get(list_name)
+        if index is None:
+            # The column is edited before warm_vocabulary() got to it
+            index = CompletionIndex(getattr(self, list_name), self.term_frequencies.get(list_name))
+            self.completion_indexes[list_name] = index
+        return index
+
+    def warm_vocabulary(self):
+        # Build the gazetteer, then the completion indexes, off the GUI thread
+        self.get_gazetteer()
+        for list_name in self.vocabulary_models:
+            if list_name not in self.completion_indexes:
+                terms = list(getattr(self, list_name))
+                frequencies = self.term_frequencies.get(list_name)
+                callback = partial(self.on_completion_index_ready, self.vocabulary_generation, list_name,
+                                   len(terms), frequencies)
+                self.run_in_background(CompletionIndex, callback, terms, frequencies)
+
+    def on_completion_index_ready(self, generation, list_name, size, frequencies, index):
+        if generation != self.vocabulary_generation or list_name in self.completion_indexes:
+            return  # The lists were replaced, or the column was edited meanwhile
+        for term in getattr(self, list_name)[size:]:
+            index.add(term, count=1)
+        counter = self.term_frequencies.get(list_name)
+        if counter is not None and counter is not frequencies:
+            index.update_frequencies(counter)
+        self.completion_indexes[list_name] = index
+
+    def vocabulary_label(self, list_name):
+        return next(header for header, name in self.vocabulary_columns.items() if name == list_name)
+
+    def get_gazetteer(self):
+        # None until the background build is done
+        if self.gazetteer is None:
+            self.build_gazetteer()
+        return self.gazetteer
+
+    def build_gazetteer(self):
+        # Off the GUI thread; a gazetteer in use keeps serving until the new one replaces it
+        if not self.gazetteer_pending:
+            self.gazetteer_pending = True
+            vocabularies = [(self.vocabulary_label(list_name), list(getattr(self, list_name)))
+                            for list_name in self.gazetteer_lists]
+            sizes = [len(terms) for _, terms in vocabularies]
+            self.run_in_background(build_gazetteer, partial(self.on_gazetteer_ready, self.vocabulary_generation, sizes),
+                                   vocabularies)
+
+    def on_gazetteer_ready(self, generation, sizes, gazetteer):
+        if generation != self.vocabulary_generation:
+            return
+        self.gazetteer_pending = False
+        # Terms added while it was being built
+        for list_name, size in zip(self.gazetteer_lists, sizes):
+            gazetteer.add_terms(self.vocabulary_label(list_name), getattr(self, list_name)[size:])
+        self.gazetteer = gazetteer
+        if self.proposals_partial and self.proposed_rows is not None and self.get_table_data() == self.proposed_rows:
+            # The message on screen was opened too early for vocabulary proposals
+            with self.history.paused():
+                self.show_proposals()
+            self.history.clear()
+
+    def propose_rows(self, text):
+        # Lines seen in an earlier table get their rows back; other deal lines
+        # get one row of matched terms. Returns (rows, remembered row count).
+        rows = []
+        remembered = 0
+        gazetteer = self.get_gazetteer()
+        self.proposals_partial = gazetteer is None
+        proposals = dict(gazetteer.propose(text)) if gazetteer is not None else {}
+        for line in text.splitlines():
+            known = self.line_memory.lookup(line)
+            if known:
+                rows.extend(fit_row(row, len(self.headers)) for row in known)
+                remembered += len(known)
+            elif line in proposals:
+                proposal = proposals[line]
+                proposal.setdefault("offer type", "WTB")
+                rows.append([proposal.get(header.lower(), "") for header in self.headers])
+        return rows, remembered
+
+    def save_line_memory(self):
+        if self.line_memory.dirty:
+            # Merged with the lines other annotators learned since it was read
+            self.writer.submit_merge_json(self.line_memory.path, self.line_memory.snapshot(),
+                                          merge=merge_json_entries)
+            self.line_memory.dirty = False
+
+    def record_text_edit(self):
+        self.history.record_text(self.processed_text.toPlainText())
+
+    def apply_history_text(self, text, position):
+        self.processed_text.setPlainText(text)
+        cursor = self.processed_text.textCursor()
+        cursor.setPosition(min(position, len(text)))
+        self.processed_text.setTextCursor(cursor)
+
+    def undo_edit(self):
+        if self.history.undo():
+            self.request_save()
+            self.status_bar.showMessage("Undone.", 3000)
+
+    def redo_edit(self):
+        if self.history.redo():
+            self.request_save()
+            self.status_bar.showMessage("Redone.", 3000)
+
+    def update_undo_buttons(self):
+        self.undo_button.setEnabled(self.history.can_undo)
+        self.redo_button.setEnabled(self.history.can_redo)
+
+    def eventFilter(self, obj, event):
+        # A text edit claims Ctrl+Z even with its own undo off; leave it to the shortcuts
+        if obj is self.processed_text and event.type() == QEvent.ShortcutOverride and (
+                event.matches(QKeySequence.Undo) or event.matches(QKeySequence.Redo)):
+            return True
+        return super().eventFilter(obj, event)
+
+    def show_stats_dialog(self):
+        if self.stats_dialog is None:
+            self.stats_dialog = StatsDialog(self)
+        self.stats_dialog.show()
+        self.stats_dialog.raise_()
+
+    def run_in_background(self, fn, callback, *args):
+        task = BackgroundTask(fn, *args)
+        self.background_tasks.add(task)
+        task.signals.finished.connect(callback)
+        task.signals.finished.connect(lambda _: self.background_tasks.discard(task))
+        QThreadPool.globalInstance().start(task)
+        return task
+
+    def load_term_frequencies(self):
+        # Rank completions by how often each term is used in this folder
+        columns = {col: self.vocabulary_columns[header.lower()]
+                   for col, header in enumerate(self.headers) if header.lower() in self.vocabulary_columns}
+        if self.input_folder and columns:
+            self.run_in_background(count_sidecar_values, self.apply_term_frequencies, self.input_folder, columns)
+
+    def apply_term_frequencies(self, counters):
+        self.term_frequencies = counters
+        for list_name, counter in counters.items():
+            index = self.completion_indexes.get(list_name)
+            if index is not None:  # The others pick them up when built
+                index.update_frequencies(counter)
+
+    def update_product_name_list(self, text):
+        self.add_vocabulary_term('product_name_list', text)
+
+    def update_brand_list(self, text):
+        self.add_vocabulary_term('brand_list', text)
+
+    def update_category_list(self, text):
+        self.add_vocabulary_term('category_list', text)
+
+    def update_color_list(self, text):
+        self.add_vocabulary_term('color_list', text)
 
     def update_status(self):
         if self.files:
@@ -1307,8 +2122,50 @@ class MessageTool(QMainWindow):
             self.status_bar.showMessage("No files loaded", 5000)
 
     def auto_save(self):
-        print("Auto saving state")  # Debug print
-        self.save_state()
+        # Backstop for edits that never call request_save (e.g. typing in cells)
+        self.save_scheduler.flush(force=True)
+        self.save_line_memory()
+
+    def closeEvent(self, event):
+        # Commit a cell that is still being edited before the final flush
+        focused = QApplication.focusWidget()
+        if focused is not None:
+            focused.clearFocus()
+        if self.server_message is not None:
+            # Save the message and give it back, so another annotator can take it
+            message, self.server_message = self.server_message, None
+            data = (self.get_table_data(), self.processed_text.toPlainText())
+            try:
+                if data != self.server_submitted:  # Unedited proposals are not submitted
+                    self.server.submit(message['lease'], *data)
+                self.server.release(message['lease'])
+            except OSError as e:
+                print(f"Error handing back {message['name']}: {e}")
+        failed = len(self.writer.errors)
+        self.save_scheduler.flush(force=True)
+        self.digest_saved(wait=True)
+        self.save_line_memory()
+        self.writer.close()  # Barrier: wait until the last edit is on disk
+        for path, error in self.writer.errors[failed:]:
+            print(f"Error writing {path}: {error}")  # Too late for the status bar
+        if self.leases is not None:
+            self.leases.release_all()
+        self.prefetcher.stop()
+        if self.manifest is not None and self.manifest.dirty:
+            try:
+                self.manifest.save()  # Keeps the folder fresh for the next launch
+            except OSError as e:
+                print(f"Error saving manifest: {e}")
+        if self.search_index is not None and self.search_index.dirty:
+            try:
+                self.search_index.save()
+            except OSError as e:
+                print(f"Error saving search index: {e}")
+        if self.scan_task is not None:
+            self.scan_task.cancelled = True
+        if metrics.capturing:
+            metrics.stop_capture()  # A profile left running is still worth keeping
+        super().closeEvent(event)
 
     def start_auto_save(self):
      self.timer.start(7000)  # Auto save every 7 seconds
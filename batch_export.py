@@ -0,0 +1,111 @@
+"""Export every annotated message of a folder without starting the GUI.
+
+For each <name>.txt.json sidecar this writes <name>.json in the same
+{"table_data": [{header: value}]} shape as the table export, and
+<name>_processed.txt when the message has processed text. Outputs that
+are newer than both the sidecar and config.conf are skipped; a missing
+_processed.txt is out of date when the sidecar has processed text.
+
+    python batch_export.py INPUT_FOLDER OUTPUT_FOLDER [--workers N] [--force]
+"""
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import atomic_write_json, atomic_write_text, load_sidecar, read_headers, fit_row, table_export, export_names
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def export_sidecar(sidecar_path, output_folder, headers, config_mtime=0, force=False,
+                   tables=True, processed=True):
+    """Export one sidecar; returns (written, up_to_date, error)."""
+    message_name = os.path.basename(sidecar_path)[:-len('.json')]
+    table_name, processed_name = export_names(message_name)
+    table_path = os.path.join(output_folder, table_name)
+    processed_path = os.path.join(output_folder, processed_name)
+    try:
+        source_mtime = max(_mtime(sidecar_path) or 0, config_mtime)
+        stale = force or (tables and (_mtime(table_path) or 0) < source_mtime)
+        sidecar = None
+        if processed and not stale:
+            processed_mtime = _mtime(processed_path)
+            if processed_mtime is None:
+                # A message without processed text has no processed output to be missing
+                sidecar = load_sidecar(sidecar_path)
+                stale = bool(sidecar[1])
+            else:
+                stale = processed_mtime < source_mtime
+        if not stale:
+            return 0, 1, None
+
+        table_data, processed_text = sidecar or load_sidecar(sidecar_path)
+        written = 0
+        if tables:
+            rows = [fit_row(row, len(headers)) for row in table_data]
+            atomic_write_json(table_path, table_export(rows, headers))
+            written += 1
+        if processed and processed_text:
+            atomic_write_text(processed_path, processed_text)
+            written += 1
+        return written, 0, None
+    except (OSError, ValueError) as e:
+        return 0, 0, f"{sidecar_path}: {e}"
+
+
+def _export_one(args):
+    return export_sidecar(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export all sidecars of a message folder.")
+    parser.add_argument('input_folder')
+    parser.add_argument('output_folder')
+    parser.add_argument('--config', default='config.conf', help="Header file (default: config.conf)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument('--force', action='store_true', help="Rewrite outputs even if up to date")
+    parser.add_argument('--no-tables', action='store_true', help="Skip the table JSON exports")
+    parser.add_argument('--no-processed', action='store_true', help="Skip the _processed.txt exports")
+    args = parser.parse_args(argv)
+
+    headers = read_headers(args.config)
+    if headers is None:
+        print(f"Config file not found: {args.config}")
+        return 2
+    os.makedirs(args.output_folder, exist_ok=True)
+    config_mtime = _mtime(args.config) or 0
+
+    with os.scandir(args.input_folder) as entries:
+        sidecars = sorted(entry.path for entry in entries if entry.name.endswith('.txt.json'))
+    jobs = [(path, args.output_folder, headers, config_mtime, args.force,
+             not args.no_tables, not args.no_processed) for path in sidecars]
+
+    start = time.perf_counter()
+    written = up_to_date = 0
+    errors = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        chunksize = max(1, len(jobs) // (4 * (args.workers or 1)))
+        for files_written, skipped, error in executor.map(_export_one, jobs, chunksize=chunksize):
+            written += files_written
+            up_to_date += skipped
+            if error:
+                errors.append(error)
+    elapsed = time.perf_counter() - start
+
+    for error in errors:
+        print(f"Error: {error}")
+    rate = len(jobs) / elapsed if elapsed > 0 else 0
+    print(f"{len(jobs)} sidecars in {elapsed:.2f}s ({rate:.0f}/s): "
+          f"{written} files written, {up_to_date} up to date, {len(errors)} errors")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,469 @@
+"""Time the MessageTool hot paths on synthetic folders, without a display.
+
+For each size a folder of synthetic deal messages is generated under
+bench_corpus/ (reused by later runs): messages of 1-500 lines, a share of
+them with a sidecar holding one row per line, and vocabulary lists of
+--vocabulary terms each. The window runs under QT_QPA_PLATFORM=offscreen
+with bench_corpus/ as working directory, so state.json, the vocabulary
+and every cache of the real checkout are left alone. The auto-save timer
+is stopped so it cannot fire inside a measurement.
+
+Measured: startup (constructing the window), first_paint (from the start
+of construction to the first paint), load_files (cold, then with a fresh
+manifest; both until the manifest is ready), show_message, set_table_data
+and get_table_data at 1, 50 and 500 rows, save_state, add_table_row,
+delete_table_row, adding or re-using a vocabulary term, proposing rows
+right after a new term (propose_after_add), the folder refresh after a
+save (refresh_after_save) and every keystroke of misspelled product names
+in the autocomplete (complete_typo). Results are written as JSON. With a
+baseline file, every median is compared to the baseline's, and the run
+fails when one is more than --threshold slower (and slower by at least
+--min-delta-ms). The run also fails when first_paint misses
+--startup-target-ms or the p95 of complete_typo misses
+--keystroke-target-ms, baseline or not, and when a refresh after the
+tool's own save rescans the folder. Run with --vocabulary 50000 to check
+the autocomplete on a large vocabulary.
+
+    QT_QPA_PLATFORM=offscreen python benchmark.py [--sizes 1000,10000,100000]
+        [--output benchmark_results.json] [--baseline benchmark_baseline.json]
+        [--save-baseline] [--threshold 0.25] [--startup-target-ms 250] [--keystroke-target-ms 16]
+        [--repeat 5] [--samples 50]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import contextlib
+from statistics import median
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+os.environ.pop('MESSAGETOOL_SHARED_DIR', None)  # Shared files too stay under bench_corpus/
+
+from storage import atomic_write_json, read_headers, user_state_path  # noqa: E402
+
+CORPUS_DIR = 'bench_corpus'
+BASELINE_FILE = 'benchmark_baseline.json'
+RESULTS_FILE = 'benchmark_results.json'
+TABLE_SIZES = (1, 50, 500)
+STARTUP_TARGET_MS = 250  # Time to first paint, with 10k-term vocabulary lists
+KEYSTROKE_TARGET_MS = 16  # p95 of one autocomplete lookup: one frame
+
+_WORDS = ['galaxy', 'redmi', 'note', 'pro', 'max', 'ultra', 'lite', 'plus', 'mini', 'air', 'pad', 'book',
+          'watch', 'buds', 'edge', 'nova', 'spark', 'pixel', 'fold', 'flip', 'zen', 'neo', 'prime', 'go']
+_COLORS = ['black', 'white', 'blue', 'green', 'red', 'gold', 'silver', 'gray', 'purple', 'pink']
+
+
+def make_vocabulary(size, rng):
+    def terms(prefix, stem_words):
+        return [f"{prefix}{i} {' '.join(rng.sample(_WORDS, stem_words))}" for i in range(size)]
+    return {
+        'product_names': terms('P', 2),
+        'brands': terms('Brand', 1),
+        'categories': terms('Cat', 1),
+        'colors': [f"{rng.choice(_COLORS)}{i}" for i in range(size)],
+    }
+
+
+def random_row(headers, vocabulary, rng):
+    values = {
+        'offer type': rng.choice(('WTB', 'WTS')),
+        'product name': rng.choice(vocabulary['product_names']),
+        'upc': str(rng.randrange(10 ** 11, 10 ** 12)),
+        'pn': f"M{rng.randrange(1000, 9999)}LL/A",
+        'brand': rng.choice(vocabulary['brands']),
+        'category': rng.choice(vocabulary['categories']),
+        'color': rng.choice(vocabulary['colors']),
+        'quantity': str(rng.randrange(1, 500)),
+        'price': str(rng.randrange(50, 2000)),
+    }
+    return [values.get(header.strip().lower(), '') for header in headers]
+
+
+def row_line(row):
+    return ' '.join(value for value in row[1:] if value) + '$'
+
+
+def row_count(rng, max_rows=500):
+    # Log-uniform: most messages are short, a few run to max_rows lines
+    return min(max_rows, int(max_rows ** rng.random()))
+
+
+def make_corpus(folder, messages, headers, vocabulary, annotated=0.3, seed=0):
+    """Write the synthetic messages (and some sidecars) of one folder."""
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for i in range(messages):
+        rows = [random_row(headers, vocabulary, rng) for _ in range(row_count(rng))]
+        name = f"message_{i:06d}.txt"
+        with open(os.path.join(folder, name), 'w', encoding='utf-8') as file:
+            file.write(rows[0][0] + '\n' + '\n'.join(row_line(row) for row in rows) + '\n')
+        if rng.random() < annotated:
+            with open(os.path.join(folder, name + '.json'), 'w', encoding='utf-8') as file:
+                json.dump({'table_data': rows, 'processed_text': ''}, file, ensure_ascii=False)
+
+
+def prepare_corpus(root, sizes, headers, vocabulary_size, annotated, seed):
+    # Folders are regenerated only when their settings change
+    os.makedirs(root, exist_ok=True)
+    settings = {'vocabulary': vocabulary_size, 'annotated': annotated, 'seed': seed, 'headers': headers}
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    atomic_write_json(os.path.join(root, 'brand_category_color.json'), vocabulary)
+    with open(os.path.join(root, 'config.conf'), 'w') as file:
+        file.write(','.join(headers))
+    folders = {}
+    for size in sizes:
+        folder = os.path.join(root, f"messages_{size}")
+        marker = os.path.join(folder, '.corpus.json')
+        try:
+            with open(marker, 'r', encoding='utf-8') as file:
+                ready = json.load(file) == dict(settings, messages=size)
+        except (OSError, ValueError):
+            ready = False
+        if not ready:
+            print(f"Generating {size} messages in {folder}...")
+            shutil.rmtree(folder, ignore_errors=True)
+            make_corpus(folder, size, headers, vocabulary, annotated, seed + size)
+            atomic_write_json(marker, dict(settings, messages=size))
+        folders[size] = os.path.abspath(folder)
+    return folders, vocabulary
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'median_ms': round(median(times) * 1000, 4),
+        'p95_ms': round(times[min(len(times) - 1, int(len(times) * 0.95))] * 1000, 4),
+        'min_ms': round(times[0] * 1000, 4),
+    }
+
+
+class Bench:
+    """Drives one MessageTool window through the measured operations."""
+
+    def __init__(self, app, repeat, samples, rng):
+        self.app = app
+        self.repeat = repeat
+        self.samples = samples
+        self.rng = rng
+        self.tool = None
+
+    def settle(self):
+        # Let scans, background jobs and their callbacks finish, outside any measurement
+        from PyQt5.QtCore import QThreadPool
+        pool = QThreadPool.globalInstance()
+        while True:
+            self.app.processEvents()
+            if pool.activeThreadCount() == 0 and (self.tool is None or self.tool.scan_task is None):
+                self.app.processEvents()
+                if pool.activeThreadCount() == 0:
+                    break
+            time.sleep(0.005)
+        if self.tool is not None:
+            self.tool.writer.flush()
+
+    def startup(self):
+        from app6 import MessageTool
+        for path in (user_state_path(), 'state.json', 'line_memory.json'):
+            if os.path.exists(path):
+                os.remove(path)
+        start = time.perf_counter()
+        self.tool = MessageTool()
+        elapsed = time.perf_counter() - start
+        self.tool.timer.stop()
+        self.tool.show()
+        deadline = time.perf_counter() + 30
+        while self.tool.first_paint_ms is None and time.perf_counter() < deadline:
+            self.app.processEvents()
+        first_paint = self.tool.first_paint_ms
+        self.settle()
+        return [elapsed], [first_paint / 1000] if first_paint is not None else []
+
+    def load_files(self, folder):
+        self.tool.input_folder = folder
+        start = time.perf_counter()
+        self.tool.load_files()
+        # Up to the manifest, so a cold load includes hashing the messages like a fresh one includes reading it
+        while self.tool.scan_task is not None or self.tool.manifest is None:
+            self.app.processEvents()
+        elapsed = time.perf_counter() - start
+        self.settle()
+        return elapsed
+
+    def show_message(self):
+        tool = self.tool
+        indices = self.rng.sample(range(len(tool.files)), min(self.samples, len(tool.files)))
+        times = []
+        for i in indices:
+            tool.current_index = i
+            start = time.perf_counter()
+            tool.show_message()
+            times.append(time.perf_counter() - start)
+        return times
+
+    def table_rows(self, count, vocabulary):
+        return [random_row(self.tool.headers, vocabulary, self.rng) for _ in range(count)]
+
+    def timed(self, fn, *args):
+        times = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            fn(*args)
+            times.append(time.perf_counter() - start)
+        return times
+
+    def save_state(self, rows):
+        tool = self.tool
+        tool.set_table_data(rows)
+        times = []
+        for i in range(self.repeat):
+            # A changed cell, so the snapshot differs from the last one written
+            tool.table_model.setData(tool.table_model.index(0, 1), f"edit {i}")
+            start = time.perf_counter()
+            tool.save_state()
+            times.append(time.perf_counter() - start)
+            tool.writer.flush()
+        return times
+
+    def add_and_delete_rows(self, rows):
+        tool = self.tool
+        tool.set_table_data(rows)
+        added = []
+        for _ in range(self.samples):
+            start = time.perf_counter()
+            tool.add_table_row()
+            added.append(time.perf_counter() - start)
+        deleted = []
+        for _ in range(self.samples):
+            start = time.perf_counter()
+            tool.delete_table_row(0)
+            deleted.append(time.perf_counter() - start)
+        return added, deleted
+
+    def vocabulary_updates(self, size):
+        tool = self.tool
+        new, reused = [], []
+        for i in range(self.samples):
+            term = f"bench term {size} {i} {time.time_ns()}"
+            start = time.perf_counter()
+            tool.add_vocabulary_term('product_name_list', term)
+            new.append(time.perf_counter() - start)
+            tool.writer.flush()
+            start = time.perf_counter()
+            tool.add_vocabulary_term('product_name_list', self.rng.choice(tool.product_name_list))
+            reused.append(time.perf_counter() - start)
+        return new, reused
+
+    def refresh_after_save(self):
+        # A sidecar saved here must leave the folder fresh, so the watcher's refresh skips the rescan.
+        # Returns (times, rescans)
+        tool = self.tool
+        times, rescans = [], 0
+        for i in range(self.repeat):
+            tool.table_model.setData(tool.table_model.index(0, 1), f"refresh {i}")
+            tool.save_state()
+            tool.writer.flush()
+            start = time.perf_counter()
+            tool.refresh_manifest()
+            rescans += tool.manifest_refreshing
+            while tool.manifest_refreshing:
+                self.app.processEvents()
+            times.append(time.perf_counter() - start)
+        return times, rescans
+
+    def propose_after_add(self, size):
+        # The gazetteer must match a new product name at once, without a full rebuild
+        tool = self.tool
+        times = []
+        for i in range(self.samples):
+            term = f"fresh product {size} {i} {time.time_ns()}"
+            tool.add_vocabulary_term('product_name_list', term)
+            tool.writer.flush()  # The vocabulary write is not part of it
+            start = time.perf_counter()
+            tool.propose_rows(f"WTS {term} 10 pcs $5")
+            times.append(time.perf_counter() - start)
+        tool.writer.flush()
+        return times
+
+    def complete_typo(self):
+        # Every prefix of misspelled product names, so the trigram lookup runs as the prefix stops matching
+        from app6 import IndexedCompleter
+        index = self.tool.get_completion_index('product_name_list')
+        times = []
+        for _ in range(self.samples):
+            name = self.rng.choice(self.tool.product_name_list)
+            i = self.rng.randrange(1, len(name) - 1)
+            typo = name[:i] + name[i + 1:] if self.rng.random() < 0.5 else name[:i] + 'x' + name[i + 1:]
+            for end in range(1, len(typo) + 1):
+                start = time.perf_counter()
+                index.complete(typo[:end], IndexedCompleter.max_results)
+                times.append(time.perf_counter() - start)
+        return times
+
+    def close(self):
+        if self.tool is not None:
+            self.tool.close()
+            self.tool.deleteLater()
+            self.app.processEvents()
+            self.tool = None
+
+
+def run(folders, vocabulary, repeat, samples, seed):
+    # (results, failed checks)
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    results, failures = {}, []
+    for size, folder in folders.items():
+        bench = Bench(app, repeat, samples, random.Random(seed))
+        print(f"Benchmarking {size} messages...")
+        with contextlib.redirect_stdout(open(os.devnull, 'w')) as devnull:
+            try:
+                measured = {}
+                measured['startup'], measured['first_paint'] = bench.startup()
+                shutil.rmtree('manifests', ignore_errors=True)
+                measured['load_files_cold'] = [bench.load_files(folder)]
+                measured['load_files'] = [bench.load_files(folder) for _ in range(repeat)]
+                bench.show_message()  # Warm-up: message cache and gazetteer
+                bench.settle()
+                measured['show_message'] = bench.show_message()
+                for count in TABLE_SIZES:
+                    rows = bench.table_rows(count, vocabulary)
+                    measured[f'set_table_data[{count}]'] = bench.timed(bench.tool.set_table_data, rows)
+                    measured[f'get_table_data[{count}]'] = bench.timed(bench.tool.get_table_data)
+                rows = bench.table_rows(TABLE_SIZES[-1], vocabulary)
+                measured['save_state'] = bench.save_state(rows)
+                measured['refresh_after_save'], rescans = bench.refresh_after_save()
+                if rescans:
+                    failures.append(f"{size}/refresh_after_save: {rescans} of {repeat} refreshes rescanned the folder")
+                measured['add_table_row'], measured['delete_table_row'] = bench.add_and_delete_rows(rows)
+                measured['vocabulary_add'], measured['vocabulary_reuse'] = bench.vocabulary_updates(size)
+                measured['propose_after_add'] = bench.propose_after_add(size)
+                measured['complete_typo'] = bench.complete_typo()
+            finally:
+                bench.close()
+                devnull.close()
+        for name, times in measured.items():
+            results[f"{size}/{name}"] = summarize(times)
+    return results, failures
+
+
+def compare(results, baseline, threshold, min_delta_ms):
+    """(key, baseline ms, current ms) for every median beyond the threshold."""
+    regressions = []
+    for key, current in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        delta = current['median_ms'] - before['median_ms']
+        if delta > min_delta_ms and current['median_ms'] > before['median_ms'] * (1 + threshold):
+            regressions.append((key, before['median_ms'], current['median_ms']))
+    return regressions
+
+
+def print_report(results, baseline):
+    print(f"{'benchmark':32} {'median ms':>10} {'p95 ms':>10} {'baseline':>10} {'change':>8}")
+    for key, current in results.items():
+        before = baseline.get(key)
+        if before is not None and before['median_ms'] > 0:
+            change = f"{current['median_ms'] / before['median_ms'] - 1:+.0%}"
+            reference = f"{before['median_ms']:.3f}"
+        else:
+            change = reference = '-'
+        print(f"{key:32} {current['median_ms']:>10.3f} {current['p95_ms']:>10.3f} {reference:>10} {change:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MessageTool on synthetic folders.")
+    parser.add_argument('--sizes', default='1000,10000,100000', help="Folder sizes (default: 1000,10000,100000)")
+    parser.add_argument('--vocabulary', type=int, default=10000, help="Terms per vocabulary list (default: 10000)")
+    parser.add_argument('--annotated', type=float, default=0.3, help="Share of messages with a sidecar (default: 0.3)")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per measurement (default: 5)")
+    parser.add_argument('--samples', type=int, default=50, help="Messages shown, rows added, terms added (default: 50)")
+    parser.add_argument('--seed', type=int, default=1510)
+    parser.add_argument('--corpus', default=CORPUS_DIR, help=f"Folder for the generated corpora (default: {CORPUS_DIR})")
+    parser.add_argument('--config', default='config.conf', help="Header file (default: config.conf)")
+    parser.add_argument('--output', default=RESULTS_FILE, help=f"Results file (default: {RESULTS_FILE})")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help=f"Baseline to compare with (default: {BASELINE_FILE})")
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Allowed slowdown of a median (default: 0.25)")
+    parser.add_argument('--startup-target-ms', type=float, default=STARTUP_TARGET_MS,
+                        help=f"Longest allowed time to first paint (default: {STARTUP_TARGET_MS})")
+    parser.add_argument('--keystroke-target-ms', type=float, default=KEYSTROKE_TARGET_MS,
+                        help=f"Longest allowed p95 of complete_typo (default: {KEYSTROKE_TARGET_MS})")
+    parser.add_argument('--min-delta-ms', type=float, default=0.5,
+                        help="Slowdowns smaller than this are noise (default: 0.5)")
+    args = parser.parse_args(argv)
+
+    headers = read_headers(args.config)
+    if headers is None:
+        print(f"Config file not found: {args.config}")
+        return 2
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    # Paths are resolved before the benchmark moves into the corpus folder
+    output, baseline_path = os.path.abspath(args.output), os.path.abspath(args.baseline)
+    folders, vocabulary = prepare_corpus(args.corpus, sizes, headers, args.vocabulary, args.annotated, args.seed)
+
+    cwd = os.getcwd()
+    os.chdir(args.corpus)
+    try:
+        results, failures = run(folders, vocabulary, args.repeat, args.samples, args.seed)
+    finally:
+        os.chdir(cwd)
+
+    baseline = {}
+    if os.path.exists(baseline_path) and not args.save_baseline:
+        with open(baseline_path, 'r', encoding='utf-8') as file:
+            baseline = json.load(file).get('results', {})
+    regressions = compare(results, baseline, args.threshold, args.min_delta_ms)
+    slow_starts = [(key, args.startup_target_ms, result['median_ms']) for key, result in results.items()
+                   if key.endswith('/first_paint') and result['median_ms'] > args.startup_target_ms]
+    slow_keystrokes = [(key, args.keystroke_target_ms, result['p95_ms']) for key, result in results.items()
+                       if key.endswith('/complete_typo') and result['p95_ms'] > args.keystroke_target_ms]
+    document = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'vocabulary': args.vocabulary,
+            'annotated': args.annotated,
+            'repeat': args.repeat,
+            'samples': args.samples,
+        },
+        'results': results,
+        'regressions': [{'benchmark': key, 'baseline_ms': before, 'median_ms': after}
+                        for key, before, after in regressions],
+        'startup_target_ms': args.startup_target_ms,
+        'keystroke_target_ms': args.keystroke_target_ms,
+        'missed_targets': [{'benchmark': key, 'target_ms': target, 'median_ms': after}
+                           for key, target, after in slow_starts]
+                          + [{'benchmark': key, 'target_ms': target, 'p95_ms': after}
+                             for key, target, after in slow_keystrokes],
+        'failed_checks': failures,
+    }
+    atomic_write_json(output, document)
+    if args.save_baseline:
+        atomic_write_json(baseline_path, document)
+
+    print_report(results, baseline)
+    for key, before, after in regressions:
+        print(f"Regression: {key} {before:.3f} ms -> {after:.3f} ms")
+    for key, target, after in slow_starts:
+        print(f"Missed target: {key} {after:.1f} ms > {target:.0f} ms")
+    for key, target, after in slow_keystrokes:
+        print(f"Missed target: {key} p95 {after:.1f} ms > {target:.0f} ms")
+    for failure in failures:
+        print(f"Failed check: {failure}")
+    if not baseline and not args.save_baseline:
+        print(f"No baseline at {baseline_path}; run with --save-baseline to store one")
+    print(f"Results written to {output}" + (f" and {baseline_path}" if args.save_baseline else ""))
+    return 1 if regressions or slow_starts or slow_keystrokes or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
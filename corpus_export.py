@@ -0,0 +1,204 @@
+"""Stream a whole message folder into a sharded JSONL or CSV dataset.
+
+Each message becomes one JSONL record
+
+    {"file": ..., "read": ..., "text": ..., "rows": [{header: value}], "processed_text": ...}
+
+or, in CSV, one line per table row (file, read, row, <headers>, text,
+processed_text). Messages are processed one at a time and shards are
+closed as soon as they are full, so memory does not grow with message
+contents; only the sorted list of file names is held in memory.
+
+Shards are written as .part files and renamed when complete. Progress is
+kept in corpus.progress.json, so an interrupted run continues with the
+first unfinished shard. The progress file also holds a fingerprint of the
+exported file names; if messages were added or removed since, the shard
+boundaries would shift, so such a run must be restarted.
+
+    python corpus_export.py INPUT_FOLDER OUTPUT_FOLDER [--format jsonl|csv]
+        [--shard-size N] [--compress gzip|zstd] [--state state-USER.json]
+"""
+import io
+import os
+import sys
+import csv
+import gzip
+import json
+import time
+import hashlib
+import argparse
+
+from storage import atomic_write_json, iter_message_names, load_sidecar, read_headers, fit_row, user_state_path
+
+PROGRESS_FILE = 'corpus.progress.json'
+
+
+def open_shard(path, compress):
+    if compress == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if compress == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise SystemExit("zstd compression needs the 'zstandard' package")
+        raw = open(path, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw), encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def shard_name(number, fmt, compress):
+    suffix = {'gzip': '.gz', 'zstd': '.zst'}.get(compress, '')
+    return f"corpus-{number:05d}.{fmt}{suffix}"
+
+
+def read_message(folder, name, headers, read_paths):
+    path = os.path.join(folder, name)
+    with open(path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    table_data, processed_text = [], ''
+    if os.path.exists(path + '.json'):
+        table_data, processed_text = load_sidecar(path + '.json')
+    rows = [dict(zip(headers, fit_row(row, len(headers)))) for row in table_data]
+    return {
+        'file': name,
+        'read': os.path.abspath(path) in read_paths,
+        'text': text,
+        'rows': rows,
+        'processed_text': processed_text,
+    }
+
+
+class ShardWriter:
+    def __init__(self, output_folder, fmt, compress, headers):
+        self.output_folder = output_folder
+        self.fmt = fmt
+        self.compress = compress
+        self.headers = headers
+        self.file = None
+        self.csv = None
+        self.part_path = None
+        self.final_path = None
+
+    def open(self, number):
+        self.final_path = os.path.join(self.output_folder, shard_name(number, self.fmt, self.compress))
+        self.part_path = self.final_path + '.part'
+        self.file = open_shard(self.part_path, self.compress)
+        if self.fmt == 'csv':
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(['file', 'read', 'row'] + self.headers + ['text', 'processed_text'])
+
+    def write(self, record):
+        if self.fmt == 'jsonl':
+            self.file.write(json.dumps(record, ensure_ascii=False))
+            self.file.write('\n')
+            return
+        common = [record['file'], int(record['read'])]
+        tail = [record['text'], record['processed_text']]
+        if not record['rows']:
+            self.csv.writerow(common + [''] + [''] * len(self.headers) + tail)
+        for i, row in enumerate(record['rows']):
+            self.csv.writerow(common + [i] + [row[header] for header in self.headers] + tail)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.part_path, self.final_path)
+        self.file = None
+
+
+def names_digest(names):
+    digest = hashlib.sha1()
+    for name in names:
+        digest.update(name.encode('utf-8', 'surrogateescape'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def load_read_paths(state_file):
+    if not state_file or not os.path.exists(state_file):
+        return set()
+    with open(state_file, 'r') as file:
+        # MessageTool stores absolute paths; normalized on both sides so the folder may be given any way
+        return {os.path.abspath(path) for path in json.load(file).get('read_files', [])}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a message folder as a sharded dataset.")
+    parser.add_argument('input_folder')
+    parser.add_argument('output_folder')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--shard-size', type=int, default=10000, help="Messages per shard")
+    parser.add_argument('--compress', choices=['none', 'gzip', 'zstd'], default='none')
+    parser.add_argument('--config', default='config.conf', help="Header file (default: config.conf)")
+    parser.add_argument('--state', help="State file with the read_files list (default: your state-<user>.json)")
+    parser.add_argument('--annotated-only', action='store_true', help="Only messages that have a sidecar")
+    parser.add_argument('--restart', action='store_true', help="Ignore earlier progress and start over")
+    args = parser.parse_args(argv)
+
+    headers = read_headers(args.config)
+    if headers is None:
+        print(f"Config file not found: {args.config}")
+        return 2
+    if args.shard_size < 1:
+        print("--shard-size must be at least 1")
+        return 2
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    settings = {
+        'input_folder': os.path.abspath(args.input_folder),
+        'format': args.format,
+        'shard_size': args.shard_size,
+        'compress': args.compress,
+        'annotated_only': args.annotated_only,
+        'headers': headers,
+    }
+    names = sorted(iter_message_names(args.input_folder))
+    if args.annotated_only:
+        names = [name for name in names if os.path.exists(os.path.join(args.input_folder, name + '.json'))]
+    listing = {'count': len(names), 'sha1': names_digest(names)}
+
+    progress_path = os.path.join(args.output_folder, PROGRESS_FILE)
+    completed = 0
+    if os.path.exists(progress_path) and not args.restart:
+        with open(progress_path, 'r', encoding='utf-8') as file:
+            progress = json.load(file)
+        if progress.get('settings') != settings:
+            print("Output folder holds an export with different settings; use --restart to overwrite it.")
+            return 2
+        if progress.get('listing') != listing:
+            print("Messages were added or removed since the interrupted export; use --restart to start over.")
+            return 2
+        completed = progress.get('completed_shards', 0)
+
+    read_paths = load_read_paths(args.state or user_state_path(existing=True))
+    total_shards = (len(names) + args.shard_size - 1) // args.shard_size
+
+    start = time.perf_counter()
+    exported = 0
+    errors = []
+    writer = ShardWriter(args.output_folder, args.format, args.compress, headers)
+    for number in range(completed, total_shards):
+        writer.open(number)
+        for name in names[number * args.shard_size:(number + 1) * args.shard_size]:
+            try:
+                record = read_message(args.input_folder, name, headers, read_paths)
+            except (OSError, ValueError) as e:
+                errors.append(f"{name}: {e}")
+                continue
+            writer.write(record)
+            exported += 1
+        writer.close()
+        atomic_write_json(progress_path, {'settings': settings, 'listing': listing, 'completed_shards': number + 1})
+        print(f"Shard {number + 1}/{total_shards} written")
+    elapsed = time.perf_counter() - start
+
+    for error in errors:
+        print(f"Error: {error}")
+    if completed:
+        print(f"Resumed after {completed} completed shards")
+    rate = exported / elapsed if elapsed > 0 else 0
+    print(f"{exported} messages exported in {elapsed:.2f}s ({rate:.0f}/s), {len(errors)} errors")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from annotation_model import TableListener
+
+# Steps are lists of ops; an op is one of
+#   (CELLS, ((row, col, old, new), ...))  only the cells that really changed
+#   (INSERT, first_row, rows)             rows as tuples sharing the table's strings
+#   (REMOVE, first_row, rows)
+#   (TEXT, start, removed, inserted)      a splice of the processed text
+CELLS, INSERT, REMOVE, TEXT = range(4)
+MERGEABLE = (CELLS, TEXT)  # Row inserts and deletes always get a step of their own
+
+
+def _common_prefix(a, b):
+    # Binary search over slice comparisons: C speed, even for long texts
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix(a, b, limit):
+    low, high = 0, min(len(a), len(b), limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[-middle:] == b[-middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _op_size(op):
+    # Rough bytes held by an op; strings shared with the table count too,
+    # so the estimate errs on the large side
+    size = sys.getsizeof(op)
+    if op[0] == CELLS:
+        size += sys.getsizeof(op[1])
+        for cell in op[1]:
+            size += sys.getsizeof(cell) + sys.getsizeof(cell[2]) + sys.getsizeof(cell[3])
+    elif op[0] == TEXT:
+        size += sys.getsizeof(op[2]) + sys.getsizeof(op[3])
+    else:
+        size += sys.getsizeof(op[2])
+        for row in op[2]:
+            size += sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+    return size
+
+
+class _Step:
+    __slots__ = ('ops', 'size', 'time')
+
+    def __init__(self, op, size, now):
+        self.ops = [op]
+        self.size = size
+        self.time = now
+
+
+class EditHistory(TableListener):
+    """Undo and redo of the open message's table and processed text.
+
+    Steps store diffs, not snapshots: the cells that changed with their old
+    and new values, inserted or removed rows, and text splices. Undoing a
+    step costs the size of its change, not of the table. Edits of the same
+    kind less than group_seconds apart form one step, as do the changes
+    made inside group(). When the steps hold more than max_bytes the oldest
+    are dropped; the newest step is always kept.
+
+    Changes made while paused() (loading a message) are not recorded. The
+    history listens to the table by itself; text changes are reported with
+    record_text() and applied back through set_text(text, cursor position).
+    """
+
+    def __init__(self, table, set_text=None, max_bytes=8 << 20, group_seconds=0.5, on_change=None,
+                 clock=time.monotonic):
+        self.table = table
+        self.set_text = set_text
+        self.max_bytes = max_bytes
+        self.group_seconds = group_seconds
+        self.on_change = on_change
+        self.clock = clock
+        self.undo_steps = deque()
+        self.redo_steps = []
+        self.size = 0  # Bytes held by both stacks
+        self.text = ''  # The processed text as last seen
+        self.pause_depth = 0
+        self.group_depth = 0
+        self.sealed = True  # The next op starts a new step
+        self.changing = None  # Old cells between cells_changing and cells_changed
+        self.removing = None
+        table.subscribe(self)
+
+    @property
+    def can_undo(self):
+        return bool(self.undo_steps)
+
+    @property
+    def can_redo(self):
+        return bool(self.redo_steps)
+
+    @contextmanager
+    def paused(self):
+        self.pause_depth += 1
+        try:
+            yield
+        finally:
+            self.pause_depth -= 1
+
+    @contextmanager
+    def group(self):
+        """Record everything changed inside as one step of its own."""
+        if not self.group_depth:
+            self.sealed = True
+        self.group_depth += 1
+        try:
+            yield
+        finally:
+            self.group_depth -= 1
+            if not self.group_depth:
+                self.sealed = True
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps.clear()
+        self.size = 0
+        self.sealed = True
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def _push(self, op):
+        now = self.clock()
+        size = _op_size(op)
+        for step in self.redo_steps:
+            self.size -= step.size
+        self.redo_steps.clear()
+        top = self.undo_steps[-1] if self.undo_steps else None
+        if top is not None and not self.sealed and (
+                self.group_depth or (op[0] in MERGEABLE and top.ops[-1][0] == op[0]
+                                     and now - top.time <= self.group_seconds)):
+            merged = self._merge_text(top.ops[-1], op) if op[0] == TEXT else None
+            if merged is not None:
+                size = _op_size(merged) - _op_size(top.ops[-1])
+                top.ops[-1] = merged
+            else:
+                top.ops.append(op)
+            top.size += size
+            top.time = now
+        else:
+            self.undo_steps.append(_Step(op, size, now))
+        self.size += size
+        self.sealed = op[0] not in MERGEABLE and not self.group_depth
+        while self.size > self.max_bytes and len(self.undo_steps) > 1:
+            self.size -= self.undo_steps.popleft().size
+        self._changed()
+
+    @staticmethod
+    def _merge_text(last, op):
+        # Typing and backspacing arrive a character at a time; keep one splice
+        if last[0] != TEXT:
+            return None
+        _, start, removed, inserted = op
+        _, last_start, last_removed, last_inserted = last
+        if not removed and start == last_start + len(last_inserted):
+            return (TEXT, last_start, last_removed, last_inserted + inserted)
+        if not inserted and not last_inserted and start + len(removed) == last_start:
+            return (TEXT, start, removed + last_removed, '')
+        return None
+
+    # Table notifications
+
+    def cells_changing(self, first_row, last_row, first_col, last_col):
+        if not self.pause_depth:
+            self.changing = [tuple(row[first_col:last_col + 1]) for row in self.table.rows[first_row:last_row + 1]]
+
+    def cells_changed(self, first_row, last_row, first_col, last_col):
+        if self.pause_depth or self.changing is None:
+            return
+        old, self.changing = self.changing, None
+        cells = []
+        for row, old_row in enumerate(old, first_row):
+            new_row = tuple(self.table.rows[row][first_col:last_col + 1])
+            if new_row != old_row:  # Whole rows compare at C speed; most are unchanged
+                cells += [(row, col, before, after)
+                          for col, before, after in zip(range(first_col, last_col + 1), old_row, new_row)
+                          if before != after]
+        cells = tuple(cells)
+        if cells:
+            self._push((CELLS, cells))
+
+    def rows_removing(self, first, last):
+        if not self.pause_depth:
+            self.removing = tuple(map(tuple, self.table.rows[first:last + 1]))
+
+    def rows_removed(self, first, last):
+        if not self.pause_depth and self.removing is not None:
+            rows, self.removing = self.removing, None
+            self._push((REMOVE, first, rows))
+
+    def rows_inserted(self, first, last):
+        if not self.pause_depth:
+            self._push((INSERT, first, tuple(map(tuple, self.table.rows[first:last + 1]))))
+
+    def table_reset(self):
+        # New headers: the recorded cells no longer line up
+        self.clear()
+
+    # Text
+
+    def record_text(self, text):
+        """Record the processed text after a change as a splice of the previous one."""
+        old, self.text = self.text, text
+        if self.pause_depth or old == text:
+            return
+        start = _common_prefix(old, text)
+        end = _common_suffix(old, text, min(len(old), len(text)) - start)
+        self._push((TEXT, start, old[start:len(old) - end], text[start:len(text) - end]))
+
+    # Undo and redo
+
+    def undo(self):
+        if not self.undo_steps:
+            return False
+        step = self.undo_steps.pop()
+        with self.paused():
+            for op in reversed(step.ops):
+                self._apply(op, undo=True)
+        self.redo_steps.append(step)
+        self.sealed = True
+        self._changed()
+        return True
+
+    def redo(self):
+        if not self.redo_steps:
+            return False
+        step = self.redo_steps.pop()
+        with self.paused():
+            for op in step.ops:
+                self._apply(op, undo=False)
+        self.undo_steps.append(step)
+        self.sealed = True
+        self._changed()
+        return True
+
+    def _apply(self, op, undo):
+        kind = op[0]
+        if kind == CELLS:
+            self.table.set_cells([(row, col, old if undo else new) for row, col, old, new in op[1]])
+        elif kind == TEXT:
+            _, start, removed, inserted = op
+            if undo:
+                removed, inserted = inserted, removed
+            self.text = self.text[:start] + inserted + self.text[start + len(removed):]
+            if self.set_text is not None:
+                self.set_text(self.text, start + len(inserted))
+        elif (kind == INSERT) == undo:
+            self.table.remove_rows(op[1], op[1] + len(op[2]) - 1)
+        else:
+            self.table.insert_rows(op[1], op[2])
@@ -0,0 +1,194 @@
+"""Tag prices, quantities, specs, UPCs and part numbers with regex rules.
+
+Every message <name>.txt becomes <name>.json in the span format of
+deal-text-data/annotations:
+
+    {"classes": [...], "annotations": [[line, {"entities": [[start, end, label]]}]]}
+
+Blank lines are dropped. When rules overlap, the longer match wins. With
+--gold, every rule is also run over the hand-annotated lines and its
+precision is reported: exact span matches, and matches that at least
+overlap a gold span of the same label.
+
+    python extract_rules.py INPUT_FOLDER OUTPUT_FOLDER [--workers N]
+        [--gold deal-text-data/annotations] [--lowercase]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import atomic_write_text, iter_message_names
+
+CLASSES = ["PROD", "UPC", "COLOR", "NATION", "SPEC", "PN", "PRICE", "QTY", "LOC"]
+
+Rule = namedtuple('Rule', 'name label pattern validate')
+
+
+def gtin_check(code):
+    # GTIN check digit (UPC-A, EAN-13): weights 3,1,3,... from the right, excluding the check digit
+    digits = [int(char) for char in code if char.isdigit()]
+    total = sum(digit * (3 if i % 2 == 0 else 1) for i, digit in enumerate(reversed(digits[:-1])))
+    return (10 - total % 10) % 10 == digits[-1]
+
+
+def _rule(name, label, pattern, validate=None):
+    return Rule(name, label, re.compile(pattern, re.IGNORECASE), validate)
+
+
+_NUMBER = r'\d[\d.,]*\d|\d'
+RULES = [
+    _rule('price_currency_before', 'PRICE', rf'(?:[$€£]|\b(?:eur|euro|usd|aed)\b)\s?(?:{_NUMBER})'),
+    _rule('price_currency_after', 'PRICE', rf'\b(?:{_NUMBER})\s?(?:[$€£]|(?:eur|euros?|usd|aed|fcfa|frs|mil)\b)'),
+    _rule('qty_pieces', 'QTY', r'\b\d+\s?(?:pcs|pc|units?|p)\b'),
+    _rule('qty_times', 'QTY', r'\b\d+\s?x\b(?!\s?\d)|\bx\s?\d+\b'),
+    _rule('price_thousands', 'PRICE', r'\b\d{2,3}k\b'),
+    # Small "Nk" counts are quantities unless a display term follows (2k IPS, 5k retina)
+    _rule('qty_thousands', 'QTY', r'\b[1-3]k\b(?!\s?(?:ips|oled|retina|xdr|display|resolution|screen|monitor|\d))'),
+    _rule('qty_plus', 'QTY', r'\b\d+\+(?![\d\s]*\d)'),
+    _rule('spec_ram_storage', 'SPEC', r'\b\d{1,2}\s?[+/]\s?\d{2,4}\s?(?:gb|tb)?\b'),
+    _rule('spec_storage', 'SPEC', r'\b\d{1,4}\s?(?:gb|tb)\b'),
+    _rule('upc_gtin', 'UPC', r'\b\d{12,13}\b', gtin_check),
+    _rule('pn_apple', 'PN', r'\b[mf][a-z][a-z\d]{2}\d(?:(?:[a-z]{1,2})?/a)?\b'),
+    _rule('pn_samsung', 'PN', r'\bsm-[a-z]\d{3,4}[a-z]?\b'),
+    _rule('pn_model_code', 'PN', r'\b(?!i[3579]-)[a-z]{2,4}-[a-z]{0,2}\d{3,5}[a-z\d]{0,3}\b'),
+]
+RULE_LABELS = {rule.label for rule in RULES}
+
+
+def rule_matches(line, rules=RULES):
+    """Every rule hit in the line as (start, end, label, rule name)."""
+    matches = []
+    for rule in rules:
+        for match in rule.pattern.finditer(line):
+            if rule.validate is None or rule.validate(match.group()):
+                matches.append((match.start(), match.end(), rule.label, rule.name))
+    return matches
+
+
+def extract_line(line, rules=RULES):
+    # Longest match first; later matches overlapping a kept span are dropped
+    kept = []
+    for start, end, label, _ in sorted(rule_matches(line, rules), key=lambda m: (m[0] - m[1], m[0])):
+        if all(end <= other[0] or start >= other[1] for other in kept):
+            kept.append([start, end, label])
+    return sorted(kept)
+
+
+def message_lines(text, lowercase=False):
+    # The non-blank lines of a message, as annotated in the span format
+    lines = [line for line in text.split('\n') if line.strip()]
+    return [line.lower() for line in lines] if lowercase else lines
+
+
+def extract_text(text, lowercase=False):
+    annotations = [[line, {'entities': extract_line(line)}] for line in message_lines(text, lowercase)]
+    return {'classes': CLASSES, 'annotations': annotations}
+
+
+def extract_file(message_path, output_folder, lowercase=False):
+    """Write the spans of one message; returns (spans, error)."""
+    name = os.path.basename(message_path)[:-len('.txt')] + '.json'
+    try:
+        with open(message_path, 'r', encoding='utf-8', newline='') as file:
+            data = extract_text(file.read(), lowercase)
+        atomic_write_text(os.path.join(output_folder, name),
+                          json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+        return sum(len(entities['entities']) for _, entities in data['annotations']), None
+    except (OSError, ValueError) as e:
+        return 0, f"{message_path}: {e}"
+
+
+def trim_span(line, start, end):
+    # Hand annotations often include surrounding blanks
+    while start < end and line[start].isspace():
+        start += 1
+    while end > start and line[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def evaluate_file(gold_path):
+    """Per-rule (predicted, exact, overlap) counts against one hand-annotated file."""
+    counts = Counter()
+    with open(gold_path, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+    for item in data.get('annotations', []):
+        if not item:
+            continue
+        line, entities = item
+        gold = [(*trim_span(line, start, end), label) for start, end, label in entities['entities']
+                if label in RULE_LABELS]
+        counts.update(('gold', label) for _, _, label in gold)
+        for start, end, label, name in rule_matches(line):
+            counts[(name, 'predicted')] += 1
+            if (start, end, label) in gold:
+                counts[(name, 'exact')] += 1
+            if any(label == g_label and start < g_end and end > g_start for g_start, g_end, g_label in gold):
+                counts[(name, 'overlap')] += 1
+    return counts
+
+
+def _extract_one(args):
+    return extract_file(*args)
+
+
+def print_report(counts):
+    print(f"{'rule':24} {'label':6} {'hits':>6} {'exact':>7} {'overlap':>8}")
+    for rule in RULES:
+        predicted = counts[(rule.name, 'predicted')]
+        if not predicted:
+            print(f"{rule.name:24} {rule.label:6} {0:>6} {'-':>7} {'-':>8}")
+            continue
+        exact = counts[(rule.name, 'exact')] / predicted
+        overlap = counts[(rule.name, 'overlap')] / predicted
+        print(f"{rule.name:24} {rule.label:6} {predicted:>6} {exact:>7.1%} {overlap:>8.1%}")
+    print("Gold spans: " + ", ".join(f"{label} {counts[('gold', label)]}" for label in sorted(RULE_LABELS)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tag message lines with rule-based spans.")
+    parser.add_argument('input_folder')
+    parser.add_argument('output_folder')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument('--gold', help="Folder of hand annotations to measure rule precision against")
+    parser.add_argument('--lowercase', action='store_true', help="Lowercase lines, like the hand annotations")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.output_folder, exist_ok=True)
+    jobs = [(os.path.join(args.input_folder, name), args.output_folder, args.lowercase)
+            for name in sorted(iter_message_names(args.input_folder))]
+
+    start = time.perf_counter()
+    spans = 0
+    errors = []
+    counts = Counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        chunksize = max(1, len(jobs) // (4 * (args.workers or 1)))
+        for found, error in executor.map(_extract_one, jobs, chunksize=chunksize):
+            spans += found
+            if error:
+                errors.append(error)
+        if args.gold:
+            with os.scandir(args.gold) as entries:
+                gold_paths = sorted(entry.path for entry in entries if entry.name.endswith('.json'))
+            chunksize = max(1, len(gold_paths) // (4 * (args.workers or 1)))
+            for file_counts in executor.map(evaluate_file, gold_paths, chunksize=chunksize):
+                counts.update(file_counts)
+    elapsed = time.perf_counter() - start
+
+    for error in errors:
+        print(f"Error: {error}")
+    rate = len(jobs) / elapsed if elapsed > 0 else 0
+    print(f"{len(jobs)} messages in {elapsed:.2f}s ({rate:.0f}/s): {spans} spans, {len(errors)} errors")
+    if args.gold:
+        print_report(counts)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Low-overhead timing spans, counters and profiling captures.
+
+Recording is off unless MESSAGETOOL_METRICS=1 is set or it is switched on
+from the stats dialog (Ctrl+Shift+M). While off, span() hands out one
+shared no-op context manager and timed() functions make a single flag
+check before calling through.
+
+While on, every span keeps its lifetime count and total, and the last
+window durations for percentiles and a latency histogram. Spans are also
+kept as Chrome trace events (open the export in chrome://tracing or
+Perfetto). Spans and counters may be recorded from any thread.
+"""
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import threading
+import functools
+import tracemalloc
+from collections import Counter, deque
+from contextlib import nullcontext
+
+import storage  # Not from-imported: storage records its writes here
+
+HISTOGRAM_EDGES_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+CAPTURE_DIR = 'profiles'
+_NULL_SPAN = nullcontext()
+
+
+class _Span:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    """Span timings, counters and trace events of one process."""
+
+    def __init__(self, enabled=False, window=1024, max_events=200000):
+        self.enabled = enabled
+        self.window = window
+        self.origin = time.perf_counter()
+        self.counters = Counter()
+        self.spans = {}  # name -> [count, total seconds, max seconds, deque of recent durations]
+        self.events = deque(maxlen=max_events)  # (name, start, duration, thread id)
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        return _Span(self, name) if self.enabled else _NULL_SPAN
+
+    def record(self, name, start, duration):
+        # start is a time.perf_counter() value
+        with self._lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = [0, 0.0, 0.0, deque(maxlen=self.window)]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3].append(duration)
+            self.events.append((name, start, duration, threading.get_ident()))
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += amount
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.spans.clear()
+            self.events.clear()
+
+    def summary(self):
+        """{'counters': {...}, 'spans': {name: stats}} with times in ms."""
+        with self._lock:
+            spans = {name: (count, total, peak, sorted(recent))
+                     for name, (count, total, peak, recent) in self.spans.items()}
+            counters = dict(self.counters)
+        result = {}
+        for name, (count, total, peak, recent) in sorted(spans.items()):
+            histogram = Counter()
+            for duration in recent:
+                ms = duration * 1000
+                edge = next((edge for edge in HISTOGRAM_EDGES_MS if ms < edge), None)
+                histogram[f"<{edge}" if edge is not None else f">={HISTOGRAM_EDGES_MS[-1]}"] += 1
+            result[name] = {
+                'count': count,
+                'total_ms': round(total * 1000, 3),
+                'max_ms': round(peak * 1000, 3),
+                'p50_ms': round(recent[len(recent) // 2] * 1000, 3),
+                'p95_ms': round(recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1000, 3),
+                'histogram': dict(histogram),
+            }
+        return {'counters': counters, 'spans': result}
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f"{'span':28} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}  recent latencies"]
+        for name, stats in summary['spans'].items():
+            histogram = ' '.join(f"{bucket}:{n}" for bucket, n in stats['histogram'].items())
+            lines.append(f"{name:28} {stats['count']:>7} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} "
+                         f"{stats['max_ms']:>9.2f}  {histogram}")
+        if summary['counters']:
+            lines.append('')
+            lines += [f"{name:28} {value:>12}" for name, value in sorted(summary['counters'].items())]
+        return '\n'.join(lines)
+
+    def export_json(self, path):
+        storage.atomic_write_json(path, self.summary())
+
+    def export_chrome_trace(self, path):
+        with self._lock:
+            events = list(self.events)
+            counters = dict(self.counters)
+        pid = os.getpid()
+        trace = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                  'ts': round((start - self.origin) * 1e6, 1), 'dur': round(duration * 1e6, 1)}
+                 for name, start, duration, tid in events]
+        end = max((event['ts'] + event['dur'] for event in trace), default=0)
+        trace += [{'name': name, 'ph': 'C', 'pid': pid, 'ts': end, 'args': {name: value}}
+                  for name, value in counters.items()]
+        storage.atomic_write_text(path, json.dumps({'traceEvents': trace, 'displayTimeUnit': 'ms'}))
+
+    @property
+    def capturing(self):
+        return self.profiler is not None
+
+    def start_capture(self):
+        # cProfile sees the calling (GUI) thread; tracemalloc sees every allocation
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            tracemalloc.start(10)
+            self.profiler.enable()
+
+    def stop_capture(self, folder=CAPTURE_DIR, top=30):
+        """Stop a capture and write its .prof and allocation report; returns their paths."""
+        if self.profiler is None:
+            return []
+        self.profiler.disable()
+        profiler, self.profiler = self.profiler, None
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        os.makedirs(folder, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        profile_path = os.path.join(folder, f"profile-{stamp}.prof")
+        profiler.dump_stats(profile_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(top)
+        report.write(f"\nTop {top} allocation sites still held:\n")
+        for stat in snapshot.statistics('lineno')[:top]:
+            report.write(f"{stat}\n")
+        report_path = os.path.join(folder, f"profile-{stamp}.txt")
+        storage.atomic_write_text(report_path, report.getvalue())
+        return [profile_path, report_path]
+
+
+metrics = Metrics(enabled=os.environ.get('MESSAGETOOL_METRICS') == '1')
+
+
+def span(name):
+    return metrics.span(name)
+
+
+def count(name, amount=1):
+    metrics.count(name, amount)
+
+
+def timed(name):
+    """Decorator recording every call of the function as a span."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.record(name, start, time.perf_counter() - start)
+        return wrapper
+    return decorate
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+
+from storage import annotator_name
+
+LEASE_DIR = '.leases'
+
+
+def _process_alive(pid):
+    if os.name != 'posix' or not isinstance(pid, int):
+        return True  # Cannot tell (os.kill would end the process on Windows)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # Alive, owned by another user
+    return True
+
+
+class LeaseManager:
+    """Advisory leases on the messages of a folder shared by several annotators.
+
+    The lease of a message is <folder>/.leases/<message>.lease, created
+    exclusively (which, unlike fcntl locks, works on network shares) and
+    naming its owner. renew() keeps the held leases alive and must run well
+    within ttl seconds; a lease not renewed for ttl seconds has expired and
+    may be taken over, so a crashed instance frees its messages by itself
+    (at once for other instances on its machine). Expiry compares file
+    times with the local clock, so the annotators' clocks must agree to
+    well within ttl.
+
+    Every instance has its own token, so one user running two windows is
+    two lease holders. Leases only coordinate MessageTool instances; other
+    programs are not stopped from writing.
+
+    leave() marks a lease for release_left(), which may run later on
+    another thread (e.g. once the message's last save is on disk); taking
+    the lease again before then keeps it.
+    """
+
+    def __init__(self, folder, owner=None, ttl=300):
+        self.folder = folder
+        self.directory = os.path.join(folder, LEASE_DIR)
+        self.owner = owner or f"{annotator_name()}@{socket.gethostname()}"
+        self.ttl = ttl
+        self.host = socket.gethostname()
+        self.token = uuid.uuid4().hex
+        self.held = set()
+        self.leaving = set()  # Held until release_left()
+        self._lock = threading.Lock()  # release_left() runs on another thread
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.lease')
+
+    def _read(self, path):
+        # None when there is no lease; {} while it is being written or unreadable
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            return {}
+
+    def _expired(self, path, lease=None):
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                return True
+        except FileNotFoundError:
+            return True
+        # A lease left by a crashed instance on this machine need not wait out the ttl
+        return bool(lease) and lease.get('host') == self.host and not _process_alive(lease.get('pid'))
+
+    def holder(self, name):
+        """Owner of a live lease on name held by another instance, else None."""
+        path = self._path(name)
+        lease = self._read(path)
+        if lease is None or lease.get('token') == self.token or self._expired(path, lease):
+            return None
+        return lease.get('owner', 'another annotator')
+
+    def acquire(self, name):
+        """Take the lease of a message; returns None once held, else its holder.
+
+        Raises OSError if the folder does not allow leases (e.g. read-only).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self.leaving.discard(name)
+            return self._acquire(name)
+
+    def _acquire(self, name):
+        path = self._path(name)
+        record = json.dumps({'owner': self.owner, 'token': self.token, 'host': self.host, 'pid': os.getpid()})
+        for _ in range(3):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            except FileExistsError:
+                lease = self._read(path)
+                if lease is not None and lease.get('token') == self.token:
+                    self.held.add(name)
+                    return None
+                if not self._expired(path, lease):
+                    return (lease or {}).get('owner', 'another annotator')
+                self._break(path)
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(record)
+            self.held.add(name)
+            return None
+        return self.holder(name) or 'another annotator'
+
+    def _break(self, path):
+        # Move an expired lease aside; when several instances break it at
+        # once only one rename succeeds. If the lease was renewed or taken
+        # in the meantime, put it back.
+        aside = f"{path}.{self.token}"
+        try:
+            os.rename(path, aside)
+        except FileNotFoundError:
+            return
+        if not self._expired(aside, self._read(aside)) and not os.path.exists(path):
+            os.rename(aside, path)
+        else:
+            os.remove(aside)
+
+    def release(self, name):
+        with self._lock:
+            self._release(name)
+
+    def leave(self, name):
+        """Mark a held lease for release_left(); returns whether it was newly marked."""
+        with self._lock:
+            if name not in self.held or name in self.leaving:
+                return False
+            self.leaving.add(name)
+            return True
+
+    def release_left(self, name):
+        with self._lock:
+            if name in self.leaving:  # Not taken again since leave()
+                self._release(name)
+
+    def _release(self, name):
+        self.leaving.discard(name)
+        if name not in self.held:
+            return
+        self.held.discard(name)
+        path = self._path(name)
+        lease = self._read(path)
+        if lease is not None and lease.get('token') == self.token:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def release_all(self):
+        with self._lock:
+            for name in list(self.held):
+                self._release(name)
+
+    def renew(self, names=None):
+        """Refresh the held leases (or those of names); returns the names taken over by another instance."""
+        with self._lock:
+            return self._renew(self.held if names is None else self.held.intersection(names))
+
+    def _renew(self, names):
+        lost = []
+        for name in list(names):
+            path = self._path(name)
+            lease = self._read(path)
+            try:
+                if lease is None or lease.get('token') != self.token:
+                    raise FileNotFoundError(path)
+                os.utime(path)
+            except FileNotFoundError:
+                self.held.discard(name)
+                self.leaving.discard(name)
+                lost.append(name)
+        return lost
@@ -0,0 +1,216 @@
+"""Remember the table rows given to message lines and reuse them elsewhere.
+
+The memory maps each normalized line (lowercased, whitespace collapsed) to
+the rows that were last placed on it in a saved table. A row belongs to
+the line sharing most of its cell words, as placed by
+span_convert.place_rows. The memory is kept in line_memory.json, next to
+brand_category_color.json (see storage.shared_path). Saving merges the
+lines learned since loading into the file, so annotators sharing it keep
+each other's lines.
+
+learn fills the memory from every sidecar of a folder. apply writes a
+sidecar for each message that has none yet, filled with the remembered rows
+of its lines. Existing sidecars are never touched.
+
+    python line_memory.py learn FOLDER [--memory line_memory.json]
+    python line_memory.py apply FOLDER [--memory line_memory.json] [--workers N]
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import atomic_write_json, load_sidecar, read_headers, iter_message_names, merge_json_entries, shared_path
+from extract_rules import message_lines
+from preannotate import normalize_line
+from span_convert import place_rows
+
+MEMORY_FILE = shared_path('line_memory.json')
+
+
+def line_key(line):
+    normalized = normalize_line(line)
+    if not normalized:
+        return None
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def placed_rows(text, table_data, headers):
+    # {line key: rows placed on that line} for one saved table
+    lines = message_lines(text)
+    # Every cell but the Offer Type helps to find a row's line
+    columns = {header: col for col, header in enumerate(headers) if header.strip().lower() != 'offer type'}
+    placed = {}
+    for _, row, _, _, i in place_rows(lines, table_data, headers, columns):
+        if i is not None:
+            key = line_key(lines[i])
+            if key:
+                placed.setdefault(key, []).append(row)
+    return placed
+
+
+class LineMemory:
+    """Line hash -> rows last assigned to that line."""
+
+    version = 1
+
+    def __init__(self, path=MEMORY_FILE):
+        self.path = path
+        self.rows = {}
+        self.learned = {}  # The entries of rows updated since loading
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path=MEMORY_FILE):
+        memory = cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return memory
+        except (OSError, ValueError) as e:
+            print(f"Error loading {path}: {e}")
+            return memory
+        if data.get('version') == cls.version:
+            memory.rows = data.get('rows', {})
+        return memory
+
+    def snapshot(self):
+        # What save() merges into the file: every line learned since loading, so a
+        # newer snapshot replaces an older one. Stored row lists are replaced,
+        # never edited, so a shallow copy is enough.
+        return {'version': self.version, 'rows': dict(self.learned)}
+
+    def save(self):
+        merge_json_entries(self.path, self.snapshot())
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.rows)
+
+    def update(self, placed):
+        for key, rows in placed.items():
+            if self.rows.get(key) != rows:
+                self.rows[key] = rows
+                self.learned[key] = rows
+                self.dirty = True
+
+    def learn(self, text, table_data, headers):
+        """Remember the rows of a saved table; returns how many lines they cover."""
+        placed = placed_rows(text, table_data, headers)
+        self.update(placed)
+        return len(placed)
+
+    def lookup(self, line):
+        key = line_key(line)
+        return self.rows.get(key) if key else None
+
+    def recall(self, text):
+        """Remembered rows of all the lines of a message, in line order."""
+        rows = []
+        for line in message_lines(text):
+            remembered = self.lookup(line)
+            if remembered:
+                rows.extend(list(row) for row in remembered)
+        return rows
+
+
+def _read(folder, name):
+    with open(os.path.join(folder, name), 'r', encoding='utf-8') as file:
+        return file.read()
+
+
+def learn_file(folder, name, headers):
+    try:
+        table_data, _ = load_sidecar(os.path.join(folder, name + '.json'))
+        return placed_rows(_read(folder, name), table_data, headers), None
+    except (OSError, ValueError) as e:
+        return {}, f"{name}: {e}"
+
+
+_worker_memory = None
+
+
+def _init_worker(memory_path):
+    global _worker_memory
+    _worker_memory = LineMemory.load(memory_path)
+
+
+def apply_file(folder, name):
+    """Write a sidecar from remembered rows; returns (rows written, error)."""
+    sidecar_path = os.path.join(folder, name + '.json')
+    try:
+        if os.path.exists(sidecar_path):
+            return 0, None
+        rows = _worker_memory.recall(_read(folder, name))
+        if rows:
+            atomic_write_json(sidecar_path, {'table_data': rows, 'processed_text': ''})
+        return len(rows), None
+    except (OSError, ValueError) as e:
+        return 0, f"{name}: {e}"
+
+
+def _learn_one(args):
+    return learn_file(*args)
+
+
+def _apply_one(args):
+    return apply_file(*args)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Learn line annotations from a folder, or apply them to it.")
+    parser.add_argument('command', choices=['learn', 'apply'])
+    parser.add_argument('folder')
+    parser.add_argument('--memory', default=MEMORY_FILE, help=f"Memory file (default: {MEMORY_FILE})")
+    parser.add_argument('--config', default='config.conf', help="Header file (default: config.conf)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    errors = []
+    if args.command == 'learn':
+        headers = read_headers(args.config)
+        if headers is None:
+            print(f"Config file not found: {args.config}")
+            return 2
+        memory = LineMemory.load(args.memory)
+        with os.scandir(args.folder) as entries:
+            names = sorted(entry.name[:-len('.json')] for entry in entries if entry.name.endswith('.txt.json'))
+        jobs = [(args.folder, name, headers) for name in names]
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            chunksize = max(1, len(jobs) // (4 * (args.workers or 1)))
+            # Results arrive in name order, so later files win consistently
+            for placed, error in executor.map(_learn_one, jobs, chunksize=chunksize):
+                memory.update(placed)
+                if error:
+                    errors.append(error)
+        if memory.dirty:
+            memory.save()
+        summary = f"{len(jobs)} sidecars learned, {len(memory)} lines in memory"
+    else:
+        names = sorted(iter_message_names(args.folder))
+        jobs = [(args.folder, name) for name in names]
+        filled = rows = 0
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(args.memory,)) as executor:
+            chunksize = max(1, len(jobs) // (4 * (args.workers or 1)))
+            for written, error in executor.map(_apply_one, jobs, chunksize=chunksize):
+                rows += written
+                filled += bool(written)
+                if error:
+                    errors.append(error)
+        summary = f"{len(jobs)} messages checked, {filled} sidecars written with {rows} rows"
+    elapsed = time.perf_counter() - start
+
+    for error in errors:
+        print(f"Error: {error}")
+    print(f"{summary} in {elapsed:.2f}s, {len(errors)} errors")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from storage import atomic_write_text, load_sidecar
+
+MANIFEST_DIR = 'manifests'
+
+
+def manifest_path(folder, cache_dir=MANIFEST_DIR):
+    key = hashlib.sha1(os.path.abspath(folder).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.json')
+
+
+def file_digest(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sidecar_has_annotations(path):
+    # A sidecar counts as annotated once anything beyond the Offer Type
+    # column (or the processed text) has been filled in
+    try:
+        table_data, processed_text = load_sidecar(path)
+    except (OSError, ValueError):
+        return False
+    if processed_text.strip():
+        return True
+    return any(isinstance(cell, str) and cell.strip() for row in table_data for cell in row[1:])
+
+
+class FolderManifest:
+    """Cached listing of a message folder, stored under manifests/.
+
+    For every message it records size, mtime and content hash, plus the
+    size, mtime and annotated flag of its sidecar. If the folder's own
+    mtime has not changed since the last refresh, names() can be served
+    without listing the folder. Otherwise refresh() stats each entry and
+    only re-reads files that are new or whose size/mtime changed. The
+    tool's own sidecar writes go through own_write(), so saving does not
+    make the folder look changed.
+    """
+
+    def __init__(self, folder, cache_dir=MANIFEST_DIR):
+        self.folder = os.path.abspath(folder)
+        self.path = manifest_path(folder, cache_dir)
+        self.dir_mtime_ns = None
+        self.messages = {}  # name -> [size, mtime_ns, md5]
+        self.sidecars = {}  # message name -> [size, mtime_ns, annotated]
+        self.dirty = False
+        self.lock = threading.Lock()  # refresh() and own_write() run on different threads
+
+    @classmethod
+    def load(cls, folder, cache_dir=MANIFEST_DIR):
+        manifest = cls(folder, cache_dir)
+        try:
+            with open(manifest.path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return manifest
+        except (OSError, ValueError) as e:
+            print(f"Error loading manifest {manifest.path}: {e}")
+            return manifest
+        if data.get('folder') == manifest.folder:
+            manifest.dir_mtime_ns = data.get('dir_mtime_ns')
+            manifest.messages = data.get('messages', {})
+            manifest.sidecars = data.get('sidecars', {})
+        return manifest
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self.lock:
+            data = {
+                'folder': self.folder,
+                'dir_mtime_ns': self.dir_mtime_ns,
+                'messages': self.messages,
+                'sidecars': self.sidecars,
+            }
+            text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+            self.dirty = False
+        atomic_write_text(self.path, text)
+
+    def is_fresh(self):
+        try:
+            return self.dir_mtime_ns is not None and os.stat(self.folder).st_mtime_ns == self.dir_mtime_ns
+        except OSError:
+            return False
+
+    def names(self):
+        return sorted(self.messages)
+
+    def is_annotated(self, name):
+        sidecar = self.sidecars.get(name)
+        return bool(sidecar and sidecar[2])
+
+    @contextmanager
+    def own_write(self, name):
+        """Around this tool's write of a message's sidecar, on the writer's thread.
+
+        The sidecar's entry is updated afterwards, so refresh() does not
+        report it. If the folder was fresh before the write, and the write
+        is its last change (the folder's mtime equals the ctime the rename
+        gave the sidecar), the folder stays fresh. Otherwise, e.g. when
+        another annotator changed it meanwhile, the next check rescans.
+        """
+        fresh = self.is_fresh()
+        yield
+        path = os.path.join(self.folder, name + '.json')
+        try:
+            st = os.stat(path)
+            dir_mtime_ns = os.stat(self.folder).st_mtime_ns
+            annotated = sidecar_has_annotations(path)
+        except OSError:
+            return
+        with self.lock:
+            self.sidecars[name] = [st.st_size, st.st_mtime_ns, annotated]
+            if fresh and dir_mtime_ns == st.st_ctime_ns:
+                self.dir_mtime_ns = dir_mtime_ns
+            self.dirty = True
+
+    def refresh(self):
+        """Re-examine only new, removed or changed files.
+
+        Returns (added, removed, changed, sidecars): the names of the messages
+        added, removed or whose text changed, and of the messages whose
+        sidecar was written or deleted.
+        """
+        with self.lock:
+            return self._refresh()
+
+    def _refresh(self):
+        # Taken before listing so changes made during the scan are seen next time
+        dir_mtime_ns = os.stat(self.folder).st_mtime_ns
+        added, changed, sidecars = [], set(), set()
+        seen_messages, seen_sidecars = set(), set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.endswith('.txt'):
+                    seen_messages.add(name)
+                    try:
+                        st = entry.stat()
+                        old = self.messages.get(name)
+                        if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                            continue
+                        self.messages[name] = [st.st_size, st.st_mtime_ns, file_digest(entry.path)]
+                    except OSError:
+                        continue
+                    if old is None:
+                        added.append(name)
+                    else:
+                        changed.add(name)
+                elif name.endswith('.txt.json'):
+                    message_name = name[:-len('.json')]
+                    seen_sidecars.add(message_name)
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    old = self.sidecars.get(message_name)
+                    if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                        continue
+                    self.sidecars[message_name] = [st.st_size, st.st_mtime_ns, sidecar_has_annotations(entry.path)]
+                    sidecars.add(message_name)
+        removed = [name for name in self.messages if name not in seen_messages]
+        for name in removed:
+            del self.messages[name]
+        for name in [name for name in self.sidecars if name not in seen_sidecars]:
+            del self.sidecars[name]
+            sidecars.add(name)
+        changed = sorted(changed.difference(added))
+        sidecars = sorted(name for name in sidecars.difference(added) if name in self.messages)
+        if added or removed or changed or sidecars or dir_mtime_ns != self.dir_mtime_ns:
+            self.dirty = True
+        self.dir_mtime_ns = dir_mtime_ns
+        return added, removed, changed, sidecars
+
+    def update(self):
+        # Background refresh used by the folder watcher; saves only when something changed
+        try:
+            changes = self.refresh()
+        except OSError as e:
+            print(f"Error refreshing manifest for {self.folder}: {e}")
+            return [], [], [], []
+        if self.dirty:
+            self.save()
+        return changes
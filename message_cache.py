@@ -0,0 +1,134 @@
+import os
+import threading
+from collections import OrderedDict
+
+from storage import load_sidecar
+from instrumentation import span, count
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class MessageCache:
+    """Thread-safe LRU cache of message texts and parsed sidecars.
+
+    Entries are keyed by path and validated against (mtime, size) on every
+    lookup, so a file changed on disk is re-read. Memory use is capped by
+    max_bytes, estimated from file sizes. Cached sidecar rows are shared;
+    callers must copy them before editing.
+    """
+
+    sidecar_overhead = 4  # Parsed JSON takes roughly this many times its file size
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (kind, path) -> (stat_key, value, size)
+        self._lock = threading.Lock()
+
+    def get_text(self, path):
+        return self._get('text', path)
+
+    def get_sidecar(self, path):
+        # (table_data, processed_text), or None if the sidecar does not exist
+        return self._get('sidecar', path)
+
+    def _get(self, kind, path):
+        key = (kind, path)
+        stat_key = _stat_key(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and stat_key is not None and entry[0] == stat_key:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        if stat_key is None:
+            self.invalidate(path)
+            return None
+        try:
+            with span('io.read_' + kind):
+                if kind == 'text':
+                    with open(path, 'r', encoding='utf-8') as file:
+                        value = file.read()
+                    size = stat_key[1] + 64
+                else:
+                    value = load_sidecar(path)
+                    size = stat_key[1] * self.sidecar_overhead + 64
+        except FileNotFoundError:
+            self.invalidate(path)
+            return None
+        count('bytes_read', stat_key[1])
+        self._put(key, stat_key, value, size)
+        return value
+
+    def _put(self, key, stat_key, value, size):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (stat_key, value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def invalidate(self, path):
+        with self._lock:
+            for kind in ('text', 'sidecar'):
+                entry = self._entries.pop((kind, path), None)
+                if entry is not None:
+                    self.total_bytes -= entry[2]
+
+    def warm(self, message_path):
+        self.get_text(message_path)
+        self.get_sidecar(message_path + '.json')
+
+
+class Prefetcher:
+    """Warms a MessageCache on a background thread.
+
+    Each request() replaces the previous queue, so fast navigation never
+    builds up a backlog of files the user has already skipped past.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self._queue = []
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='Prefetcher', daemon=True)
+        self._thread.start()
+
+    def request(self, message_paths):
+        with self._cond:
+            self._queue = list(message_paths)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                path = self._queue.pop(0)
+            try:
+                self.cache.warm(path)
+            except (OSError, ValueError) as e:
+                print(f"Error prefetching {path}: {e}")
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join(1)
@@ -0,0 +1,97 @@
+import os
+
+
+class NavigationIndex:
+    """Read status of message files and fast next/previous-unread lookups.
+
+    read_paths is an insertion-ordered set of full paths (the format stored
+    in state.json). For the folder on screen, a Fenwick tree over the
+    unread flags counts the unread files before any position, so marking a
+    file and jumping to the next, previous or first unread file are all
+    O(log n). set_files() rebuilds the tree in O(n).
+    """
+
+    def __init__(self, read_paths=()):
+        self.read_paths = dict.fromkeys(read_paths)
+        self.folder = None
+        self.read_names = set()  # Names of the read files in folder
+        self.files = []
+        self.unread_flags = bytearray()
+        self.tree = [0]  # 1-based; tree[i] sums the flags of (i - lowbit(i), i]
+        self.unread_count = 0
+
+    def set_files(self, folder, files):
+        if folder != self.folder:
+            prefix = os.path.join(folder, '')
+            self.read_names = {path[len(prefix):] for path in self.read_paths if path.startswith(prefix)}
+        self.folder = folder
+        self.files = files
+        read_names = self.read_names
+        self.unread_flags = bytearray(name not in read_names for name in files)
+        tree = [0]
+        tree += self.unread_flags
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.unread_count = self.unread_flags.count(1)
+
+    def path(self, position):
+        return os.path.join(self.folder, self.files[position])
+
+    def is_read(self, position):
+        return self.path(position) in self.read_paths
+
+    def set_read(self, position, read=True):
+        path = self.path(position)
+        name = self.files[position]
+        if read:
+            self.read_paths[path] = None
+            self.read_names.add(name)
+        else:
+            self.read_paths.pop(path, None)
+            self.read_names.discard(name)
+        if self.unread_flags[position] == read:  # Unread flag set and now read, or the reverse
+            self.unread_flags[position] = not read
+            self._add(position, -1 if read else 1)
+
+    def _add(self, position, delta):
+        i = position + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+        self.unread_count += delta
+
+    def _count_before(self, position):
+        # Unread files at positions < position
+        total, i = 0, position
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _nth_unread(self, n):
+        # Position of the unread file with n unread files before it
+        position, remaining = 0, n + 1
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            if position + step < len(self.tree) and self.tree[position + step] < remaining:
+                position += step
+                remaining -= self.tree[position]
+            step >>= 1
+        return position
+
+    def unread_positions(self):
+        return [i for i, flag in enumerate(self.unread_flags) if flag]
+
+    def first_unread(self):
+        return self._nth_unread(0) if self.unread_count else None
+
+    def next_unread(self, position):
+        count = self._count_before(position + 1)
+        return self._nth_unread(count) if count < self.unread_count else None
+
+    def prev_unread(self, position):
+        count = self._count_before(position)
+        return self._nth_unread(count - 1) if count else None
@@ -0,0 +1,198 @@
+"""Group near-duplicate messages with MinHash and locality-sensitive hashing.
+
+Messages are normalized (lowercase, punctuation folded to spaces) and cut
+into character 5-grams. Each message gets a 64-value MinHash signature;
+signatures are cached by content md5 in minhash_cache.pkl, so a message
+is only hashed once however often it is reposted or renamed. LSH buckets
+(16 bands of 4 values) find candidate pairs, and pairs whose estimated
+similarity reaches the threshold are merged into clusters.
+
+    python near_duplicates.py FOLDER [--threshold 0.7] [--workers N]
+"""
+import os
+import re
+import sys
+import time
+import pickle
+import random
+import zlib
+import argparse
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import atomic_write_bytes, iter_message_names
+from manifest import file_digest
+
+CACHE_FILE = 'minhash_cache.pkl'
+NUM_PERM = 64
+SHINGLE_SIZE = 5
+_PRIME = (1 << 61) - 1
+_rng = random.Random(1510)  # Fixed seed: cached signatures must stay comparable
+PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME)) for _ in range(NUM_PERM)]
+_NON_WORD = re.compile(r'[\W_]+')
+POOL_MIN_FILES = 200  # Below this, starting worker processes costs more than it saves
+
+
+def normalize(text):
+    return _NON_WORD.sub(' ', text.lower()).strip()
+
+
+def signature(text):
+    text = normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        shingles = {text}
+    else:
+        shingles = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    return array('Q', [min((a * x + b) % _PRIME for x in hashes) for a, b in PERMUTATIONS])
+
+
+def similarity(first, second):
+    # Share of equal MinHash values: an estimate of the shingle Jaccard similarity
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+def file_signature(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return signature(file.read()).tobytes()
+    except (OSError, ValueError) as e:
+        print(f"Error hashing {path}: {e}")
+        return None
+
+
+def load_cache(cache_path=CACHE_FILE):
+    try:
+        with open(cache_path, 'rb') as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+        print(f"Error loading {cache_path}: {e}")
+        return {}
+
+
+def compute_signatures(folder, names, digests=None, cache_path=CACHE_FILE, workers=None):
+    """{name: signature}, hashing only contents missing from the cache."""
+    digests = dict(digests or {})
+    for name in names:
+        if name not in digests:
+            try:
+                digests[name] = file_digest(os.path.join(folder, name))
+            except OSError:
+                continue
+    cache = load_cache(cache_path)
+    missing = [name for name in names if name in digests and digests[name] not in cache]
+    paths = [os.path.join(folder, name) for name in missing]
+    if len(missing) >= POOL_MIN_FILES:
+        # spawn: forking a process that runs Qt threads is not safe
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            chunksize = max(1, len(paths) // (4 * (workers or os.cpu_count() or 1)))
+            results = list(executor.map(file_signature, paths, chunksize=chunksize))
+    else:
+        results = [file_signature(path) for path in paths]
+    for name, data in zip(missing, results):
+        if data is not None:
+            cache[digests[name]] = data
+    if missing:
+        atomic_write_bytes(cache_path, pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL))
+
+    signatures = {}
+    for name in names:
+        data = cache.get(digests.get(name))
+        if data is not None:
+            signatures[name] = array('Q')
+            signatures[name].frombytes(data)
+    return signatures
+
+
+class DuplicateIndex:
+    """LSH buckets over MinHash signatures, with the resulting clusters."""
+
+    max_bucket_pairs = 64
+
+    def __init__(self, signatures, bands=16, threshold=0.7):
+        self.signatures = signatures
+        self.threshold = threshold
+        self.cluster_of = {}  # name -> sorted names of its cluster (clustered names only)
+        rows = NUM_PERM // bands
+        buckets = {}
+        for name, sig in signatures.items():
+            for band in range(bands):
+                key = (band, hash(sig[band * rows:(band + 1) * rows].tobytes()))
+                buckets.setdefault(key, []).append(name)
+
+        parent = {}
+
+        def find(name):
+            root = name
+            while parent[root] != root:
+                root = parent[root]
+            while parent[name] != root:
+                parent[name], name = root, parent[name]
+            return root
+
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            # Large buckets (mass reposts) are only compared against their first member
+            pivots = members if len(members) <= self.max_bucket_pairs else members[:1]
+            for i, first in enumerate(pivots):
+                for other in members[i + 1:]:
+                    parent.setdefault(first, first)
+                    parent.setdefault(other, other)
+                    root_a, root_b = find(first), find(other)
+                    if root_a != root_b and similarity(signatures[first], signatures[other]) >= threshold:
+                        parent[root_b] = root_a
+        groups = {}
+        for name in parent:
+            groups.setdefault(find(name), []).append(name)
+        for members in groups.values():
+            if len(members) > 1:
+                members.sort()
+                for name in members:
+                    self.cluster_of[name] = members
+
+    def clusters(self):
+        seen = {}
+        for members in self.cluster_of.values():
+            seen[id(members)] = members
+        return sorted(seen.values(), key=len, reverse=True)
+
+    def duplicates(self, name):
+        """The other members of name's cluster as (similarity, name), most similar first."""
+        sig = self.signatures.get(name)
+        others = [(similarity(sig, self.signatures[other]), other)
+                  for other in self.cluster_of.get(name, ()) if other != name]
+        return sorted(others, key=lambda item: (-item[0], item[1]))
+
+
+def build_duplicate_index(folder, names, digests=None, threshold=0.7, workers=None, cache_path=CACHE_FILE):
+    return DuplicateIndex(compute_signatures(folder, names, digests, cache_path, workers), threshold=threshold)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List clusters of near-duplicate messages.")
+    parser.add_argument('folder')
+    parser.add_argument('--threshold', type=float, default=0.7, help="Minimum estimated similarity (default: 0.7)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument('--cache', default=CACHE_FILE, help=f"Signature cache (default: {CACHE_FILE})")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    names = sorted(iter_message_names(args.folder))
+    index = build_duplicate_index(args.folder, names, threshold=args.threshold,
+                                  workers=args.workers, cache_path=args.cache)
+    elapsed = time.perf_counter() - start
+    clusters = index.clusters()
+    for members in clusters[:10]:
+        print(f"{len(members)} messages: {', '.join(members[:4])}" + (" ..." if len(members) > 4 else ""))
+    clustered = sum(len(members) for members in clusters)
+    print(f"{len(names)} messages in {elapsed:.2f}s: {len(clusters)} clusters holding {clustered} messages")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
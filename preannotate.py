@@ -0,0 +1,165 @@
+import re
+from collections import deque
+
+OFFER_TYPE_PATTERN = re.compile(r'\b(wts|wtb|want to sell|want to buy)\b', re.IGNORECASE)
+OFFER_TYPES = {'wts': 'WTS', 'want to sell': 'WTS', 'wtb': 'WTB', 'want to buy': 'WTB'}
+
+
+def normalize_line(text):
+    return ' '.join(text.lower().split())
+
+
+class AhoCorasick:
+    """Multi-pattern matcher: finds every pattern occurrence in one pass.
+
+    Patterns can be added at any time. Until the first search they go into
+    the trie, whose failure links are built once. After that they go into a
+    small second automaton, rebuilt on the next search instead, so adding
+    one pattern never costs a build of the whole trie.
+    """
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]  # node -> [(pattern length, payload)]
+        self.report = [0]  # node -> nearest fail-chain node with output (0: none)
+        self.size = 0  # Patterns in the trie
+        self.stale = False
+        self.built = False
+        self.recent = None  # AhoCorasick of the patterns added after build()
+
+    def add(self, pattern, payload):
+        if self.built:
+            if self.recent is None:
+                self.recent = AhoCorasick()
+            self.recent.insert(pattern, payload)
+        else:
+            self.insert(pattern, payload)
+
+    def insert(self, pattern, payload):
+        # Into the trie itself; the failure links are rebuilt on the next search
+        node = 0
+        for char in pattern:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.report.append(0)
+                self.goto[node][char] = child
+            node = child
+        self.out[node].append((len(pattern), payload))
+        self.size += 1
+        self.stale = True
+
+    def build(self):
+        queue = deque()
+        for child in self.goto[0].values():
+            self.fail[child] = 0
+            self.report[child] = 0
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and char not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                target = self.fail[child]
+                self.report[child] = target if self.out[target] else self.report[target]
+        self.stale = False
+        self.built = True
+
+    def search(self, text):
+        # Yields (start, end, payload) for every occurrence
+        if self.stale:
+            self.build()
+        goto, fail, out, report = self.goto, self.fail, self.out, self.report
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = node if out[node] else report[node]
+            while match:
+                for length, payload in out[match]:
+                    yield i + 1 - length, i + 1, payload
+                match = report[match]
+        if self.recent is not None:
+            yield from self.recent.search(text)
+
+
+class Gazetteer:
+    """Finds vocabulary terms in message lines and proposes table rows.
+
+    Terms are matched case-insensitively on whole words. Terms shorter than
+    min_length characters, or with no letters or digits, are ignored.
+    """
+
+    min_length = 2
+
+    def __init__(self):
+        self.automaton = AhoCorasick()
+        self.patterns = set()
+
+    def add_term(self, label, term):
+        key = normalize_line(term)
+        if len(key) < self.min_length or not any(char.isalnum() for char in key):
+            return False
+        if (label, key) in self.patterns:
+            return False
+        self.patterns.add((label, key))
+        self.automaton.add(key, (label, term.strip()))
+        return True
+
+    def add_terms(self, label, terms):
+        for term in terms:
+            self.add_term(label, term)
+
+    def recent_terms(self):
+        # Terms added since the automaton was built, matched by its second automaton
+        recent = self.automaton.recent
+        return recent.size if recent is not None else 0
+
+    def match_line(self, line):
+        """Best term per label: longest whole-word match, leftmost on ties."""
+        text = normalize_line(line)
+        best = {}
+        for start, end, (label, term) in self.automaton.search(text):
+            if start > 0 and text[start - 1].isalnum():
+                continue
+            if end < len(text) and text[end].isalnum():
+                continue
+            current = best.get(label)
+            if current is None or (end - start, -start) > current[0]:
+                best[label] = ((end - start, -start), term)
+        return {label: term for label, (_, term) in best.items()}
+
+    def propose(self, text, product_label='product name', brand_label='brand'):
+        """(line, {label: term}) for each deal line; 'offer type' follows WTS/WTB markers."""
+        proposals = []
+        offer_type = None
+        for line in text.splitlines():
+            marker = OFFER_TYPE_PATTERN.search(line)
+            if marker:
+                offer_type = OFFER_TYPES[marker.group(1).lower()]
+            matches = self.match_line(line)
+            # A deal line names a product, or a brand next to some figures
+            if product_label in matches or (brand_label in matches and any(char.isdigit() for char in line)):
+                if offer_type:
+                    matches['offer type'] = offer_type
+                proposals.append((line, matches))
+        return proposals
+
+
+def build_gazetteer(vocabularies):
+    # Background job: vocabularies is [(label, terms)]; the automaton is
+    # built here so the first search does not pay for it
+    gazetteer = Gazetteer()
+    for label, terms in vocabularies:
+        gazetteer.add_terms(label, terms)
+    gazetteer.automaton.build()
+    return gazetteer
@@ -0,0 +1,295 @@
+import os
+import re
+import zlib
+import pickle
+import hashlib
+from array import array
+from itertools import accumulate
+
+from storage import atomic_write_bytes, load_sidecar
+
+INDEX_DIR = 'search_index'
+TOKEN_PATTERN = re.compile(r'\w+')
+QUERY_PATTERN = re.compile(r'(-?)"([^"]*)"?|(\S+)')
+
+
+def index_path(folder, cache_dir=INDEX_DIR):
+    key = hashlib.sha1(os.path.abspath(folder).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, key + '.idx')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def document_terms(text, table_data=(), processed_text=''):
+    # Words plus adjacent word pairs ("note 11s"), which answer phrase queries.
+    # Each field is tokenized on its own so pairs never span two cells.
+    fields = [text, processed_text]
+    fields += [cell for row in table_data for cell in row if isinstance(cell, str)]
+    terms = set()
+    for field in fields:
+        tokens = tokenize(field)
+        terms.update(tokens)
+        terms.update(a + ' ' + b for a, b in zip(tokens, tokens[1:]))
+    return terms
+
+
+def encode_postings(ids):
+    # Sorted doc ids as zlib-compressed gaps
+    gaps = array('I', [ids[0]])
+    gaps.extend(b - a for a, b in zip(ids, ids[1:]))
+    return zlib.compress(gaps.tobytes(), 1)
+
+
+def decode_postings(data):
+    gaps = array('I')
+    gaps.frombytes(zlib.decompress(data))
+    return accumulate(gaps)
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def file_terms(path):
+    """(stat key, terms) of a message and its sidecar, read from disk; needs no index."""
+    key = (_stat_key(path), _stat_key(path + '.json'))
+    with open(path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    table_data, processed_text = [], ''
+    if key[1] is not None:
+        try:
+            table_data, processed_text = load_sidecar(path + '.json')
+        except (OSError, ValueError) as e:
+            print(f"Error indexing sidecar of {os.path.basename(path)}: {e}")
+    return key, document_terms(text, table_data, processed_text)
+
+
+def read_documents(folder, names):
+    # Background job: [(name, stat key, terms)] for add_document, in the GUI thread
+    documents = []
+    for name in names:
+        try:
+            documents.append((name, *file_terms(os.path.join(folder, name))))
+        except (OSError, ValueError) as e:
+            print(f"Error indexing {name}: {e}")
+    return documents
+
+
+class SearchIndex:
+    """Inverted index over the messages of a folder, stored under search_index/.
+
+    Every message is a document made of its text, processed text and table
+    cells. Each term maps to the ids of the documents containing it, kept as
+    compressed gap lists; ids added since the last compaction stay in a
+    plain list until compact(). Re-indexing a message gives it a new id and
+    retires the old one, so postings are only ever appended to.
+
+    search() takes words (all must match), "quoted phrases", -excluded
+    words and OR between groups: redmi "note 11s" -pro OR 6934177720482.
+    Phrases match through adjacent word pairs, so a longer phrase may also
+    match a document that holds each of its pairs in different places.
+    """
+
+    version = 1
+
+    def __init__(self, folder, cache_dir=INDEX_DIR):
+        self.folder = os.path.abspath(folder)
+        self.path = index_path(folder, cache_dir)
+        self.names = []  # doc id -> message name, None once retired
+        self.ids = {}  # message name -> live doc id
+        self.stats = {}  # message name -> (message stat, sidecar stat), None to recheck
+        self.postings = {}  # term -> compressed doc ids
+        self.pending = {}  # term -> doc ids added since the last compaction
+        self.retired = 0
+        self.dirty = False
+
+    @classmethod
+    def load(cls, folder, cache_dir=INDEX_DIR):
+        index = cls(folder, cache_dir)
+        try:
+            with open(index.path, 'rb') as file:
+                data = pickle.load(file)
+        except FileNotFoundError:
+            return index
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+            print(f"Error loading search index {index.path}: {e}")
+            return index
+        if data.get('version') == cls.version and data.get('folder') == index.folder:
+            index.names = data['names']
+            index.ids = {name: i for i, name in enumerate(index.names) if name is not None}
+            index.stats = data['stats']
+            index.postings = data['postings']
+            index.retired = data['retired']
+        return index
+
+    def save(self):
+        self.compact()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        data = {
+            'version': self.version,
+            'folder': self.folder,
+            'names': self.names,
+            'stats': self.stats,
+            'postings': self.postings,
+            'retired': self.retired,
+        }
+        atomic_write_bytes(self.path, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_document(self, name, terms, key=None):
+        # key: the stats of the files the terms come from; None has refresh() re-read them
+        self.remove(name)
+        doc_id = len(self.names)
+        self.names.append(name)
+        self.ids[name] = doc_id
+        for term in terms:
+            self.pending.setdefault(term, []).append(doc_id)
+        self.stats[name] = key
+        self.dirty = True
+
+    def remove(self, name):
+        doc_id = self.ids.pop(name, None)
+        if doc_id is not None:
+            self.names[doc_id] = None
+            self.retired += 1
+            self.dirty = True
+        self.stats.pop(name, None)
+
+    def index_document(self, name, text, table_data=(), processed_text=''):
+        # For content already in memory (e.g. a sidecar that was just saved);
+        # the next refresh() re-reads the files once to record their stats
+        self.add_document(name, document_terms(text, table_data, processed_text))
+
+    def index_file(self, name):
+        key, terms = file_terms(os.path.join(self.folder, name))
+        self.add_document(name, terms, key)
+
+    def refresh(self):
+        """Index new and changed messages and drop removed ones; returns how many were indexed."""
+        messages, sidecars = {}, {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith('.txt'):
+                        st = entry.stat()
+                        messages[entry.name] = (st.st_mtime_ns, st.st_size)
+                    elif entry.name.endswith('.txt.json'):
+                        st = entry.stat()
+                        sidecars[entry.name[:-len('.json')]] = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    continue
+        indexed = 0
+        for name, message_key in messages.items():
+            if self.stats.get(name) == (message_key, sidecars.get(name)) and name in self.ids:
+                continue
+            try:
+                self.index_file(name)
+                indexed += 1
+            except (OSError, ValueError) as e:
+                print(f"Error indexing {name}: {e}")
+        for name in [name for name in self.ids if name not in messages]:
+            self.remove(name)
+        self.compact()
+        return indexed
+
+    def compact(self):
+        # Fold pending ids into the compressed lists; renumber once a quarter of the ids are retired
+        remap = None
+        if self.retired and self.retired * 4 > len(self.names):
+            remap = {}
+            names = []
+            for old_id, name in enumerate(self.names):
+                if name is not None:
+                    remap[old_id] = len(names)
+                    names.append(name)
+            terms = set(self.postings).union(self.pending)
+        else:
+            terms = list(self.pending)
+        for term in terms:
+            ids = self._term_ids(term)
+            if remap is not None:
+                ids = [remap[doc_id] for doc_id in ids if doc_id in remap]
+            if ids:
+                self.postings[term] = encode_postings(ids)
+            else:
+                self.postings.pop(term, None)
+        self.pending = {}
+        if remap is not None:
+            self.names = names
+            self.ids = {name: i for i, name in enumerate(names)}
+            self.retired = 0
+            self.dirty = True
+
+    def _term_ids(self, term):
+        ids = list(decode_postings(self.postings[term])) if term in self.postings else []
+        ids.extend(self.pending.get(term, ()))
+        return ids
+
+    def _phrase_ids(self, tokens):
+        terms = tokens if len(tokens) == 1 else [a + ' ' + b for a, b in zip(tokens, tokens[1:])]
+        result = None
+        for term in terms:
+            ids = set(self._term_ids(term))
+            result = ids if result is None else result & ids
+            if not result:
+                break
+        return result
+
+    def parse(self, query):
+        # [[(negated, tokens), ...], ...]: OR of groups whose parts must all match
+        groups = [[]]
+        negate_next = False
+        for match in QUERY_PATTERN.finditer(query):
+            negated, phrase, word = match.groups()
+            if word in ('OR', '|'):
+                groups.append([])
+                continue
+            if word in ('AND', 'NOT'):
+                negate_next = word == 'NOT'
+                continue
+            negated = bool(negated) or negate_next
+            negate_next = False
+            if word and word.startswith('-') and len(word) > 1:
+                negated, word = True, word[1:]
+            tokens = tokenize(phrase if phrase is not None else word)
+            if tokens:
+                groups[-1].append((negated, tokens))
+        return [group for group in groups if group]
+
+    def search(self, query):
+        """Sorted names of the matching messages."""
+        found = set()
+        for group in self.parse(query):
+            positive = [tokens for negated, tokens in group if not negated]
+            if not positive:
+                continue  # A group of exclusions alone would match nearly everything
+            ids = None
+            for tokens in positive:
+                matches = self._phrase_ids(tokens)
+                ids = matches if ids is None else ids & matches
+                if not ids:
+                    break
+            for tokens in (tokens for negated, tokens in group if negated):
+                if not ids:
+                    break
+                ids -= self._phrase_ids(tokens)
+            found |= ids
+        return sorted(name for name in (self.names[doc_id] for doc_id in found) if name is not None)
+
+
+def build_index(folder, cache_dir=INDEX_DIR):
+    # Background job: load the saved index, catch up with the folder, save it back
+    index = SearchIndex.load(folder, cache_dir)
+    index.refresh()
+    if index.dirty:
+        index.save()
+    return index
@@ -0,0 +1,287 @@
+"""Convert between span annotations and MessageTool table rows.
+
+to-rows reads span files (deal-text-data/annotations) and writes one
+<name>.txt.json sidecar per file. Every line with a PROD, UPC or PN span
+becomes a row. A line with only colors, quantities or prices becomes a
+variant row of the product above it. Labels without a table column
+(SPEC, NATION, LOC) are dropped.
+
+to-spans reads the sidecars of a message folder and locates each cell
+value in its message. A row is placed on the line sharing most of its
+words, searching forward from the previous row's line. The result is
+written as <name>.json in the span format.
+
+Spans that cannot be converted are reported as misalignments: spans
+outside their line, overlapping spans, values that are in no line, and
+variant lines with no product before them.
+
+    python span_convert.py to-rows ANNOTATIONS_FOLDER OUTPUT_FOLDER [--workers N] [--report issues.json]
+    python span_convert.py to-spans MESSAGES_FOLDER OUTPUT_FOLDER [--lowercase]
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from storage import atomic_write_json, atomic_write_text, load_sidecar, read_headers, fit_row
+from extract_rules import CLASSES, message_lines, trim_span
+from preannotate import OFFER_TYPE_PATTERN, OFFER_TYPES
+
+LABEL_COLUMNS = {
+    'PROD': 'product name',
+    'UPC': 'upc',
+    'PN': 'pn',
+    'COLOR': 'color',
+    'QTY': 'quantity',
+    'PRICE': 'price',
+}
+PRODUCT_LABELS = ('PROD', 'UPC', 'PN')  # A line naming one of these starts a new product
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def column_indices(headers):
+    positions = {header.strip().lower(): col for col, header in enumerate(headers)}
+    return {label: positions[column] for label, column in LABEL_COLUMNS.items() if column in positions}
+
+
+def spans_to_rows(annotations, headers, default_offer_type='WTB'):
+    """Table rows for one span file; returns (rows, issues, dropped label counts)."""
+    columns = column_indices(headers)
+    offer_col = next((col for col, header in enumerate(headers) if header.strip().lower() == 'offer type'), None)
+    rows, issues, dropped = [], [], Counter()
+    offer_type = default_offer_type
+    for number, item in enumerate(annotations, 1):
+        if not item:
+            continue
+        line, entities = item
+        marker = OFFER_TYPE_PATTERN.search(line)
+        if marker:
+            offer_type = OFFER_TYPES[marker.group(1).lower()]
+        values = {}
+        covered = []
+        for start, end, label in sorted(entities.get('entities', [])):
+            if not 0 <= start < end <= len(line):
+                issues.append(f"line {number}: {label} span [{start}, {end}] is outside the line")
+                continue
+            start, end = trim_span(line, start, end)
+            if start == end:
+                issues.append(f"line {number}: {label} span is blank")
+                continue
+            if any(start < other_end and end > other_start for other_start, other_end in covered):
+                issues.append(f"line {number}: {label} span {line[start:end]!r} overlaps another span")
+                continue
+            covered.append((start, end))
+            if label not in columns:
+                dropped[label] += 1
+                continue
+            values.setdefault(label, []).append(line[start:end])
+        if not values:
+            continue
+        if any(label in values for label in PRODUCT_LABELS):
+            row = [''] * len(headers)
+        elif rows:
+            # Variant line ("black 20"): same product as the row above
+            row = list(rows[-1])
+            for label in ('COLOR', 'QTY', 'PRICE'):
+                if label in columns:
+                    row[columns[label]] = ''
+        else:
+            issues.append(f"line {number}: {', '.join(sorted(values))} without a product")
+            continue
+        if offer_col is not None:
+            row[offer_col] = offer_type
+        for label, texts in values.items():
+            row[columns[label]] = ', '.join(texts)
+        rows.append(row)
+    return rows, issues, dropped
+
+
+def _find_free(line, value, taken):
+    # Offsets of value in line, preferring whole words and skipping taken ranges.
+    # Returns None if the value is missing; an identical taken span counts as found.
+    candidates = []
+    start = line.find(value)
+    while start >= 0:
+        end = start + len(value)
+        whole = (start == 0 or not line[start - 1].isalnum()) and (end == len(line) or not line[end].isalnum())
+        candidates.append((not whole, start, end))
+        start = line.find(value, start + 1)
+    for _, start, end in sorted(candidates):
+        if (start, end) in taken:
+            return start, end
+        if all(end <= other_start or start >= other_end for other_start, other_end in taken):
+            return start, end
+    return None
+
+
+def _parts(value, line):
+    # Cells joined from several spans ("black, white") are located part by part
+    if value in line:
+        return [value]
+    return [part.strip() for part in value.split(', ') if part.strip()]
+
+
+def place_rows(lines, rows, headers, columns=None):
+    """Yield (row number, row, values, inherited labels, line index) for each row with values.
+
+    columns maps labels to the cells used for placing (default: the span
+    columns). A row goes to the line sharing most of its words, where words
+    found in many rows (a brand on every row) count less than rare ones (a
+    model code). Ties go to the first line from the previous row's line on;
+    the index is None if no line shares any word.
+    """
+    if columns is None:
+        columns = column_indices(headers)
+    line_tokens = [set(WORD_PATTERN.findall(line.lower())) for line in lines]
+    prepared = []
+    previous = None
+    for number, row in enumerate(rows, 1):
+        row = fit_row(row, len(headers))
+        values = [(label, str(row[col]).strip()) for label, col in columns.items() if str(row[col]).strip()]
+        inherited = {label for label, col in columns.items() if previous is not None and row[col] == previous[col]}
+        previous = row
+        if values:
+            # Place variant rows by their own values, not the product they repeat
+            own = [value for label, value in values if label not in inherited] or [value for _, value in values]
+            tokens = set(WORD_PATTERN.findall(' '.join(own).lower()))
+            prepared.append((number, row, values, inherited, tokens))
+    frequency = Counter(token for *_, tokens in prepared for token in tokens)
+
+    cursor = 0
+    for number, row, values, inherited, tokens in prepared:
+        best = None
+        for offset in range(len(lines)):
+            i = (cursor + offset) % len(lines)
+            score = sum(1 / frequency[token] for token in tokens & line_tokens[i])
+            if score and (best is None or score > best[0]):
+                best = (score, i)
+        if best is not None:
+            cursor = best[1]
+        yield number, row, values, inherited, best[1] if best is not None else None
+
+
+def rows_to_spans(text, rows, headers, lowercase=False):
+    """Span document for one message; returns (document, issues)."""
+    lines = message_lines(text, lowercase)
+    folded = [line.lower() for line in lines]
+    entities = [[] for _ in lines]
+    taken = [set() for _ in lines]
+    issues = []
+    for number, _, values, inherited, i in place_rows(lines, rows, headers):
+        if i is None:
+            issues.append(f"row {number}: none of its values appear in the message")
+            continue
+        for label, value in values:
+            for part in _parts(value.lower(), folded[i]):
+                found = _find_free(folded[i], part, taken[i])
+                if found is None:
+                    # Variant rows repeat the product of the row above
+                    if label not in inherited:
+                        issues.append(f"row {number}: {label} {part!r} not found on line {i + 1}")
+                    continue
+                if found not in taken[i]:
+                    taken[i].add(found)
+                    entities[i].append([found[0], found[1], label])
+    annotations = [[line, {'entities': sorted(spans)}] for line, spans in zip(lines, entities)]
+    return {'classes': CLASSES, 'annotations': annotations}, issues
+
+
+def convert_annotation_file(path, output_folder, headers):
+    """Write the sidecar for one span file; returns (name, items, issues, dropped, error)."""
+    name = os.path.basename(path)
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        rows, issues, dropped = spans_to_rows(data.get('annotations', []), headers)
+        sidecar = name[:-len('.json')] + '.txt.json'
+        atomic_write_json(os.path.join(output_folder, sidecar), {'table_data': rows, 'processed_text': ''})
+        return name, len(rows), issues, dropped, None
+    except (OSError, ValueError) as e:
+        return name, 0, [], Counter(), f"{path}: {e}"
+
+
+def convert_sidecar_file(sidecar_path, output_folder, headers, lowercase=False):
+    """Write the span file for one sidecar and its message; returns (name, items, issues, dropped, error)."""
+    message_path = sidecar_path[:-len('.json')]
+    name = os.path.basename(message_path)
+    try:
+        table_data, _ = load_sidecar(sidecar_path)
+        with open(message_path, 'r', encoding='utf-8', newline='') as file:
+            text = file.read()
+        document, issues = rows_to_spans(text, table_data, headers, lowercase)
+        atomic_write_text(os.path.join(output_folder, name[:-len('.txt')] + '.json'),
+                          json.dumps(document, ensure_ascii=False, separators=(',', ':')))
+        spans = sum(len(entities['entities']) for _, entities in document['annotations'])
+        return name, spans, issues, Counter(), None
+    except (OSError, ValueError) as e:
+        return name, 0, [], Counter(), f"{sidecar_path}: {e}"
+
+
+def _convert_one(args):
+    function, *rest = args
+    return function(*rest)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert between span annotations and table rows.")
+    parser.add_argument('direction', choices=['to-rows', 'to-spans'])
+    parser.add_argument('input_folder')
+    parser.add_argument('output_folder')
+    parser.add_argument('--config', default='config.conf', help="Header file (default: config.conf)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument('--lowercase', action='store_true', help="to-spans: lowercase lines, like the hand annotations")
+    parser.add_argument('--report', help="Write every misalignment to this JSON file")
+    args = parser.parse_args(argv)
+
+    headers = read_headers(args.config)
+    if headers is None:
+        print(f"Config file not found: {args.config}")
+        return 2
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    with os.scandir(args.input_folder) as entries:
+        if args.direction == 'to-rows':
+            jobs = [(convert_annotation_file, entry.path, args.output_folder, headers)
+                    for entry in entries if entry.name.endswith('.json')]
+        else:
+            jobs = [(convert_sidecar_file, entry.path, args.output_folder, headers, args.lowercase)
+                    for entry in entries if entry.name.endswith('.txt.json')]
+    jobs.sort(key=lambda job: job[1])
+
+    start = time.perf_counter()
+    items = 0
+    errors = []
+    issues = {}
+    dropped = Counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        chunksize = max(1, len(jobs) // (4 * (args.workers or 1)))
+        for name, count, file_issues, file_dropped, error in executor.map(_convert_one, jobs, chunksize=chunksize):
+            items += count
+            dropped.update(file_dropped)
+            if file_issues:
+                issues[name] = file_issues
+            if error:
+                errors.append(error)
+    elapsed = time.perf_counter() - start
+
+    for error in errors:
+        print(f"Error: {error}")
+    for name, file_issues in list(issues.items())[:10]:
+        print(f"{name}: {file_issues[0]}" + (f" (+{len(file_issues) - 1} more)" if len(file_issues) > 1 else ""))
+    if args.report:
+        atomic_write_json(args.report, issues)
+    unit = 'rows' if args.direction == 'to-rows' else 'spans'
+    rate = len(jobs) / elapsed if elapsed > 0 else 0
+    print(f"{len(jobs)} files in {elapsed:.2f}s ({rate:.0f}/s): {items} {unit}, "
+          f"{sum(map(len, issues.values()))} misalignments in {len(issues)} files, {len(errors)} errors")
+    if dropped:
+        print("Labels without a column: " + ", ".join(f"{label} {count}" for label, count in sorted(dropped.items())))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,328 @@
+import os
+import re
+import json
+import time
+import getpass
+import tempfile
+import itertools
+import threading
+from contextlib import contextmanager, nullcontext
+
+import instrumentation
+
+
+def _target_mode(path):
+    # mkstemp creates 0600 files; keep the mode a plain open() would give
+    try:
+        return os.stat(path).st_mode & 0o777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def _atomic_write(path, data, mode, encoding=None):
+    # Write to a temp file in the same folder, then rename over the target so
+    # readers never see a half-written file
+    metrics = instrumentation.metrics
+    start = time.perf_counter() if metrics.enabled else None
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, _target_mode(path))
+        if start is not None:
+            metrics.count('bytes_written', os.path.getsize(tmp_path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    if start is not None:
+        metrics.count('files_written')
+        metrics.record('io.write', start, time.perf_counter() - start)
+
+
+def atomic_write_text(path, text, encoding='utf-8'):
+    _atomic_write(path, text, 'w', encoding)
+
+
+def atomic_write_bytes(path, data):
+    _atomic_write(path, data, 'wb')
+
+
+def atomic_write_json(path, data, encoding='utf-8'):
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=4), encoding=encoding)
+
+
+@contextmanager
+def file_lock(path, timeout=10.0, stale_after=60.0):
+    """Hold path + '.lock', created exclusively, while inside.
+
+    Unlike fcntl locks this works on network shares. A lock file older than
+    stale_after seconds was left by a crashed writer and is broken.
+    """
+    lock_path = path + '.lock'
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > stale_after:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{lock_path} is still held after {timeout:.0f}s")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+
+def merge_json_lists(path, data, encoding='utf-8'):
+    """Union the lists of data into the JSON object at path; returns the result.
+
+    Items already in the file keep their order and new ones are appended, so
+    annotators adding terms at the same time all keep theirs. Nothing is
+    written when the file already holds every item.
+    """
+    with file_lock(path):
+        try:
+            with open(path, 'r', encoding=encoding) as file:
+                current = json.load(file)
+        except FileNotFoundError:
+            current = {}
+        merged = dict(current)
+        for key, items in data.items():
+            existing = current.get(key, [])
+            known = set(existing)
+            merged[key] = existing + [item for item in dict.fromkeys(items) if item not in known]
+        if merged != current:
+            atomic_write_json(path, merged, encoding=encoding)
+    return merged
+
+
+def merge_json_entries(path, data, encoding='utf-8'):
+    """Merge the JSON object data one level deep into the object at path.
+
+    Nested objects are merged entry by entry, so every entry of data
+    replaces the file's and the entries written by other annotators stay;
+    other values are replaced.
+    """
+    with file_lock(path):
+        try:
+            with open(path, 'r', encoding=encoding) as file:
+                current = json.load(file)
+        except FileNotFoundError:
+            current = {}
+        merged = dict(current)
+        for key, value in data.items():
+            if isinstance(value, dict) and isinstance(current.get(key), dict):
+                merged[key] = {**current[key], **value}
+            else:
+                merged[key] = value
+        if merged != current:
+            atomic_write_json(path, merged, encoding=encoding)
+    return merged
+
+
+def shared_path(name):
+    # Files all annotators share: in MESSAGETOOL_SHARED_DIR, else the working directory
+    return os.path.join(os.environ.get('MESSAGETOOL_SHARED_DIR', ''), name)
+
+
+def annotator_name():
+    # MESSAGETOOL_USER, or the login name
+    name = os.environ.get('MESSAGETOOL_USER')
+    if not name:
+        try:
+            name = getpass.getuser()
+        except Exception:  # No login name, e.g. in some containers
+            name = 'annotator'
+    return name
+
+
+def user_state_path(user=None, existing=False):
+    """state-<user>.json in the shared directory (see shared_path).
+
+    With existing=True, the state.json of older versions, in the working
+    directory, if only that exists.
+    """
+    path = shared_path('state-' + re.sub(r'[^\w.-]', '_', user or annotator_name()) + '.json')
+    if existing and not os.path.exists(path) and os.path.exists('state.json'):
+        return 'state.json'
+    return path
+
+
+def read_headers(config_file='config.conf'):
+    # config.conf is a single comma-separated line of table headers
+    if not os.path.exists(config_file):
+        return None
+    with open(config_file, 'r') as file:
+        return file.read().strip().split(',')
+
+
+def fit_row(row, num_headers):
+    # Truncate extra columns and pad missing ones with empty strings
+    row = list(row[:num_headers])
+    row += [""] * (num_headers - len(row))
+    return row
+
+
+def table_export(table_data, headers):
+    # The {"table_data": [{header: value}, ...]} document of the table export
+    formatted_table_data = []
+    for row in table_data:
+        if len(row) == len(headers):
+            formatted_table_data.append(dict(zip(headers, row)))
+        else:
+            print(f"Skipping row due to length mismatch: {row}")
+    return {"table_data": formatted_table_data}
+
+
+def export_names(message_name):
+    # Output file names of the table and processed-text exports for a message
+    base = os.path.splitext(message_name)[0]
+    return base + '.json', base + '_processed.txt'
+
+
+def iter_message_names(folder):
+    # os.scandir streams entries instead of building the whole listing first
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.endswith('.txt'):
+                yield entry.name
+
+
+def parse_sidecar(data):
+    # Sidecars are either the old bare list of rows or
+    # {'table_data': [...], 'processed_text': '...'}
+    if isinstance(data, list):
+        return data, ''
+    if isinstance(data, dict):
+        return data.get('table_data', []), data.get('processed_text', '')
+    return [], ''
+
+
+def load_sidecar(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return parse_sidecar(json.load(file))
+
+
+class BackgroundWriter:
+    """Writes snapshots to disk on a dedicated I/O thread.
+
+    Only the newest snapshot per path is kept, so a burst of saves for the
+    same file costs one write. At most max_pending paths may be queued;
+    submit() blocks beyond that. flush() is the barrier used before exit.
+    submit_call() runs a function on the I/O thread once the writes queued
+    before it are done, so the GUI thread never waits for them. A failed
+    write is kept in errors and passed to on_error(path, job, message) on
+    the I/O thread, job being the (kind, data, encoding) that was submitted.
+    around(path), if given, returns a context manager entered around each
+    write on the I/O thread.
+    """
+
+    def __init__(self, max_pending=64, on_error=None, around=None):
+        self.max_pending = max_pending
+        self.on_error = on_error
+        self.around = around
+        self.errors = []
+        self.writes = 0
+        self._pending = {}  # path -> (kind, data, encoding), oldest first
+        self._inflight = set()
+        self._calls = itertools.count()  # Queue keys of submit_call() jobs
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='BackgroundWriter', daemon=True)
+        self._thread.start()
+
+    def submit_json(self, path, data, encoding='utf-8'):
+        # data must not be mutated after submission
+        self._submit(path, ('json', data, encoding))
+
+    def submit_text(self, path, text, encoding='utf-8'):
+        self._submit(path, ('text', text, encoding))
+
+    def submit_merge_json(self, path, data, encoding='utf-8', merge=merge_json_lists):
+        # Shared files: merged with the file's current content by merge(path, data, encoding);
+        # like every job, only the newest data per path is written
+        self._submit(path, ('merge', (merge, data), encoding))
+
+    def submit_call(self, fn):
+        # fn() runs once every write submitted before it is done (written or failed)
+        self._submit(('call', next(self._calls)), ('call', fn, None))
+
+    def _submit(self, path, job):
+        with self._cond:
+            while (len(self._pending) >= self.max_pending and path not in self._pending
+                   and not self._closed):
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("BackgroundWriter is closed")
+            self._pending.pop(path, None)
+            self._pending[path] = job
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                path = next(iter(self._pending))
+                kind, data, encoding = self._pending.pop(path)
+                self._inflight.add(path)
+                self._cond.notify_all()
+            try:
+                if kind == 'call':
+                    data()
+                else:
+                    with self.around(path) if self.around is not None else nullcontext():
+                        if kind == 'json':
+                            atomic_write_json(path, data, encoding=encoding)
+                        elif kind == 'merge':
+                            merge, items = data
+                            merge(path, items, encoding=encoding)
+                        else:
+                            atomic_write_text(path, data, encoding=encoding)
+                    self.writes += 1
+            except Exception as e:
+                self.errors.append((path, str(e)))
+                if self.on_error is not None:
+                    self.on_error(path, (kind, data, encoding), str(e))
+            finally:
+                with self._cond:
+                    self._inflight.discard(path)
+                    self._cond.notify_all()
+
+    def wait(self, path, timeout=None):
+        # Read-your-writes: block until no write for path is queued or running
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: path not in self._pending and path not in self._inflight, timeout)
+
+    def flush(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._inflight, timeout)
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
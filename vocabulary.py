@@ -0,0 +1,236 @@
+import os
+import math
+import heapq
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from itertools import groupby
+from operator import itemgetter
+
+from storage import load_sidecar
+
+
+def normalize_term(text):
+    # Case-insensitive, whitespace-insensitive lookup key
+    return ' '.join(text.casefold().split())
+
+
+def trigrams(key):
+    padded = f' {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _TrieNode:
+    __slots__ = ('children', 'ids', 'top')
+
+    def __init__(self):
+        self.children = {}
+        self.ids = []  # Terms whose key ends here
+        self.top = None  # Cached best ids of the subtree, None when stale
+
+
+class CompletionIndex:
+    """Autocomplete index over one vocabulary column.
+
+    A prefix trie answers "starts with" queries and a trigram index finds
+    substring and misspelled matches. Results are ranked by how often each
+    term was used. Every trie node caches the best ids of its subtree, so
+    repeated prefix lookups do not walk the whole subtree. add() and bump()
+    only invalidate the caches along one path. Fuzzy lookups only count the
+    rarest trigram postings and stop once no candidate left can make the
+    top k.
+    """
+
+    top_cache_size = 32
+    min_similarity = 0.6  # Share of the query's trigrams a fuzzy hit must contain
+    lookup_cost = 8  # Looking up one fuzzy candidate in the postings vs counting one id
+
+    def __init__(self, terms=(), frequencies=None):
+        self.terms = []  # id -> term
+        self.keys = []  # id -> normalized key
+        self.frequency = []  # id -> usage count
+        self.gram_counts = []  # id -> number of trigrams in the key
+        self.ids = {}  # term -> id
+        self.key_ids = defaultdict(list)  # normalized key -> ids
+        self.grams = defaultdict(list)  # trigram -> ids
+        self.root = _TrieNode()
+        for term in terms:
+            self.add(term)
+        if frequencies:
+            self.update_frequencies(frequencies)
+        self._top(self.root)  # Fill the caches now, while still off the GUI thread
+
+    def __contains__(self, term):
+        return term in self.ids
+
+    def __len__(self):
+        return len(self.terms)
+
+    def _rank(self, term_id):
+        return (self.frequency[term_id], -len(self.keys[term_id]), -term_id)
+
+    def _path(self, key):
+        node = self.root
+        yield node
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                return
+            yield node
+
+    def add(self, term, count=0):
+        if not term or term in self.ids:
+            return False
+        key = normalize_term(term)
+        term_id = len(self.terms)
+        self.terms.append(term)
+        self.keys.append(key)
+        self.frequency.append(count)
+        self.ids[term] = term_id
+        self.key_ids[key].append(term_id)
+
+        node = self.root
+        node.top = None
+        for char in key:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = _TrieNode()
+            node = child
+            node.top = None
+        node.ids.append(term_id)
+
+        grams = trigrams(key)
+        self.gram_counts.append(len(grams))
+        for gram in grams:
+            self.grams[gram].append(term_id)
+        return True
+
+    def bump(self, term, count=1):
+        term_id = self.ids.get(term)
+        if term_id is None:
+            return False
+        self.frequency[term_id] += count
+        for node in self._path(self.keys[term_id]):
+            node.top = None
+        return True
+
+    def update_frequencies(self, counts):
+        # counts: {term: uses}; values that differ only in case or spacing
+        # from a known term count towards that term
+        for term, count in counts.items():
+            if term in self.ids:
+                self.bump(term, count)
+            else:
+                ids = self.key_ids.get(normalize_term(term))
+                if ids:
+                    self.bump(self.terms[ids[0]], count)
+
+    def _top(self, node):
+        if node.top is None:
+            if not node.ids and len(node.children) == 1:
+                # Most nodes are inner letters of a single term: share the list of the node below
+                node.top = self._top(next(iter(node.children.values())))
+            else:
+                candidates = list(node.ids)
+                for child in node.children.values():
+                    candidates.extend(self._top(child))
+                node.top = heapq.nlargest(self.top_cache_size, candidates, key=self._rank)
+        return node.top
+
+    def complete(self, text, k=10, fuzzy=True):
+        key = normalize_term(text)
+        node = self.root
+        for char in key:
+            node = node.children.get(char)
+            if node is None:
+                break
+        if node is not None:
+            if k <= self.top_cache_size:
+                result = self._top(node)[:k]
+            else:
+                result = heapq.nlargest(k, self._subtree_ids(node), key=self._rank)
+        else:
+            result = []
+        if len(result) >= k or not fuzzy or len(key) < 2:
+            return [self.terms[i] for i in result]
+
+        # Fill up with substring/typo matches from the trigram index. A term
+        # sharing `needed` of the query's trigrams is in at least one of any
+        # len - needed + 1 of their postings, so only the rarest ones are
+        # counted and the best candidates are looked up in the others, until
+        # no one left can make the top k
+        query_grams = trigrams(key)
+        needed = math.ceil(len(query_grams) * self.min_similarity)
+        postings = sorted((self.grams.get(gram, ()) for gram in query_grams), key=len)
+        split = len(postings) - needed + 1
+        shared = Counter()
+        for ids in postings[:split]:
+            shared.update(ids)
+        others = postings[split:]
+        others_size = sum(map(len, others))
+        seen = set(result)
+        wanted = k - len(result)
+        scored = []  # Min-heap of the best `wanted`
+        for count, group in groupby(shared.most_common(), key=itemgetter(1)):
+            if count + len(others) < (scored[0][0] if len(scored) == wanted else needed):
+                break
+            group = [term_id for term_id, _ in group if term_id not in seen]
+            if self.lookup_cost * len(group) > others_size:
+                # Too many to look up one by one: count the others for all of them at once
+                totals = Counter(dict.fromkeys(group, count))
+                members = set(group)
+                for ids in others:
+                    totals.update(members.intersection(ids))
+                candidates, pending = totals.most_common(), ()
+            else:
+                candidates, pending = [(term_id, count) for term_id in group], others
+            for term_id, count in candidates:
+                bar = scored[0][0] if len(scored) == wanted else needed
+                for j, ids in enumerate(pending):
+                    if count + len(pending) - j < bar:
+                        break
+                    # Ids are added in order, so every posting is sorted
+                    i = bisect_left(ids, term_id)
+                    if i < len(ids) and ids[i] == term_id:
+                        count += 1
+                if count < bar:
+                    if pending:
+                        continue
+                    break  # Sorted by count
+                jaccard = count / (len(query_grams) + self.gram_counts[term_id] - count)
+                item = (count, jaccard, self.frequency[term_id], -term_id)
+                if len(scored) < wanted:
+                    heapq.heappush(scored, item)
+                elif item > scored[0]:
+                    heapq.heapreplace(scored, item)
+        for item in sorted(scored, reverse=True):
+            result.append(-item[3])
+        return [self.terms[i] for i in result]
+
+    def _subtree_ids(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield from node.ids
+            stack.extend(node.children.values())
+
+
+def count_sidecar_values(folder, columns):
+    """Count how often each cell value occurs in the *.txt.json sidecars.
+
+    columns maps a table column index to a name; returns {name: Counter}.
+    """
+    counters = {name: Counter() for name in columns.values()}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.txt.json'):
+                continue
+            try:
+                table_data, _ = load_sidecar(entry.path)
+            except (OSError, ValueError) as e:
+                print(f"Error reading {entry.path}: {e}")
+                continue
+            for row in table_data:
+                for col, name in columns.items():
+                    if col < len(row) and isinstance(row[col], str) and row[col].strip():
+                        counters[name][row[col]] += 1
+    return counters